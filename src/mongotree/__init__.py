@@ -23,4 +23,9 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
-from mongotree import *
\ No newline at end of file
+import sys
+
+from .mongotree import *
+
+if sys.version_info >= (3, 5):
+    from .aio import AsyncMongoTree
@@ -0,0 +1,164 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .mongotree import MongoTree
+
+
+class AsyncMongoTree(object):
+    """An asyncio front end to MongoTree (Python 3.5+).
+
+    Every method is a coroutine. The blocking database calls run on a thread
+    pool so they do not stall the event loop, and lookups that do not depend
+    on each other (the $in batches of a tree level or of a wide children
+    array) run concurrently.
+    """
+
+    # MongoTree methods that are run on the thread pool as they are.
+    BLOCKING_METHODS = ('ensure_indexes', 'get_node_by_objectid',
+                        'get_node_by_path', 'path_exists', 'get_dotgraph',
+                        'node_count', 'subtree_count', 'get_roots', 'upsert',
+                        'upsert_many', 'flush', 'remove', 'get_parent',
+                        'get_ancestors', 'get_depth', 'get_subtree',
+                        'get_descendants', 'count_descendants',
+                        'map_roots', 'traverse_roots', 'snapshot',
+                        'top_paths', 'migrate_ancestors', 'get_leaf_nodes',
+                        'get_obj', 'diff', 'sync_to', 'fromXml')
+
+    def __init__(self, tree=None, max_workers=16, **kwargs):
+        """Initialization routines.
+
+        Arguments:
+            tree (MongoTree): The tree to wrap. Default: a MongoTree built
+                with kwargs.
+            max_workers (int): The number of threads running database calls.
+        """
+        self.tree = tree or MongoTree(**kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __getattr__(self, name):
+        if name not in self.BLOCKING_METHODS:
+            raise AttributeError(name)
+
+        method = getattr(self.tree, name)
+
+        @functools.wraps(method)
+        async def coroutine(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+
+        return coroutine
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the tree (flushing buffered hits) and stop the thread
+        pool."""
+        await self._run(self.tree.close)
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, function, *args, **kwargs):
+        """Run a blocking function on the thread pool."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(function, *args, **kwargs))
+
+    async def _find_by_objectids(self, object_ids, projection=None):
+        """Fetch nodes by ObjectId, running the $in batches concurrently.
+
+        Arguments:
+            object_ids (list of bson.objectid.ObjectId): The ids to fetch.
+            projection (dict): The fields to read. Default: all.
+
+        Returns:
+            list of nodes, in the order of object_ids.
+        """
+        batch_size = self.tree.IN_BATCH_SIZE
+        batches = [object_ids[i:i + batch_size]
+                   for i in range(0, len(object_ids), batch_size)]
+
+        def fetch(batch):
+            return list(self.tree._find_by_objectids(batch,
+                                                     projection=projection))
+
+        results = await asyncio.gather(*[self._run(fetch, batch)
+                                         for batch in batches])
+
+        return [node for nodes in results for node in nodes]
+
+    async def get_children(self, path, skip=0, limit=None, fields=None):
+        """Get all children of a node. See MongoTree.get_children()."""
+        if limit is not None or self.tree.cache is not None:
+            return await self._run(self.tree.get_children, path, skip=skip,
+                                   limit=limit, fields=fields)
+
+        node = await self.get_node_by_path(path, fields=['children'])
+        if not node:
+            return []
+
+        return await self._find_by_objectids(node['children'][skip:],
+                                             self.tree._projection(fields))
+
+    async def traverse(self, node, function=None, fields=None):
+        """Traverse the tree, optionally running a function on each node.
+
+        See MongoTree.traverse(). Each level of the subtree is fetched with
+        concurrent $in batches; function runs on the event loop.
+
+        Returns:
+            list. A list of all nodes that were traversed.
+        """
+        projection = self.tree._projection(fields, 'children')
+        descendants = {}
+        frontier = list(node['children'])
+
+        while frontier:
+            next_frontier = []
+            for child in await self._find_by_objectids(frontier, projection):
+                if child['_id'] not in descendants:
+                    descendants[child['_id']] = child
+                    next_frontier.extend(child['children'])
+            frontier = next_frontier
+
+        def children_of(node):
+            return [descendants[child] for child in node['children']
+                    if child in descendants]
+
+        nodes = []
+        for node in self.tree._walk_preorder(node, children_of):
+            nodes.append(node)
+            if function:
+                function(node)
+
+        return nodes
@@ -0,0 +1,147 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import os
+import pymongo
+import threading
+
+from .memory import MemoryCollection
+
+
+# Process-wide MongoClients, keyed by (pid, uri, pool size). Every client
+# holds its own connection pool, so backends pointing at the same URI share
+# one. The pid keeps forked processes from reusing their parent's sockets.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(uri, pool_size=100):
+    """Get the shared MongoClient for a URI, creating it on first use.
+
+    Arguments:
+        uri (string): A mongodb:// connection URI.
+        pool_size (int): The maximum number of pooled connections.
+
+    Returns:
+        pymongo.MongoClient.
+    """
+    key = (os.getpid(), uri, pool_size)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = pymongo.MongoClient(uri, maxPoolSize=pool_size)
+            _clients[key] = client
+    return client
+
+
+def close_clients():
+    """Close all shared MongoClients of this process."""
+    with _clients_lock:
+        for key in [key for key in _clients if key[0] == os.getpid()]:
+            _clients.pop(key).close()
+
+
+class MongoBackend(object):
+    """Stores the nodes of trees in a MongoDB collection."""
+
+    def __init__(self, host='localhost', port=27017, db_name='mongotree',
+                 uri=None, collection='treefoo', pool_size=100,
+                 write_concern=None, read_preference=None,
+                 secondary_reads=False):
+        """Initialization routines.
+
+        Arguments:
+            host (string): Hostname that is serving the MongoDB instance.
+            port (integer): The port to connect to host on.
+            db_name (string): The database name on the MongoDB instance. A
+                database named in the uri takes precedence.
+            uri (string): The connection URI for the mongodb instance.
+            collection (string): The collection the nodes are stored in.
+                Objects stored apart from their nodes (see separate_objs of
+                MongoTree) go to the collection named collection + '_objs'.
+            pool_size (int): The maximum number of pooled connections of the
+                client shared by all backends using the same URI.
+            write_concern (dict): Write concern options, e.g.
+                {'w': 'majority', 'wtimeout': 5000}. Default: the client's.
+            read_preference (pymongo.ReadPreference): Where reads go.
+                Default: the primary.
+            secondary_reads (bool): Let the read-only helpers (counts,
+                traversals, subtrees, ...) read from secondaries.
+        """
+        if not uri:
+            uri = 'mongodb://%s:%d/' % (host, port)
+
+        # Enough to build an equivalent backend, e.g. in a worker process.
+        self.options = {'uri': uri, 'db_name': db_name,
+                        'collection': collection, 'pool_size': pool_size,
+                        'write_concern': write_concern,
+                        'read_preference': read_preference,
+                        'secondary_reads': secondary_reads}
+
+        self.client = get_client(uri, pool_size=pool_size)
+        # The client parsed the uri once already, database included.
+        self.db = self.client.get_default_database(db_name)
+
+        options = {}
+        if write_concern:
+            options['write_concern'] = pymongo.WriteConcern(**write_concern)
+        if read_preference:
+            options['read_preference'] = read_preference
+
+        self.collection = self.db.get_collection(collection, **options)
+        self.obj_collection = self.db.get_collection(collection + '_objs',
+                                                     **options)
+
+        # The collection used by read-only helpers, which tolerate the lag
+        # of a secondary.
+        self.read_collection = self.collection
+        if secondary_reads:
+            self.read_collection = self.collection.with_options(
+                read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
+
+    def drop(self):
+        """Remove all nodes (of every tree) from the backend."""
+        self.collection.drop()
+        self.obj_collection.drop()
+
+
+class MemoryBackend(object):
+    """Stores the nodes of trees in process memory, which is handy for tests,
+    benchmarks and short-lived jobs."""
+
+    def __init__(self):
+        """Initialization routines."""
+        self.client = None
+        self.db = None
+        self.collection = MemoryCollection()
+        self.read_collection = self.collection
+        self.obj_collection = MemoryCollection()
+
+    def drop(self):
+        """Remove all nodes (of every tree) from the backend."""
+        self.collection.drop()
+        self.obj_collection.drop()
@@ -0,0 +1,394 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+# Benchmarks of MongoTree operations on synthetic trees. Run with:
+#
+#     python -m mongotree.bench [--backend memory|mongo] [--scale 1000]
+#                               [--output results.json]
+#
+# Every workload builds a fresh tree from generated paths, then times the
+# public methods on it. For each method the results hold the ops/sec, the
+# round trips (collection calls), documents and bytes read per op, the
+# p50/p99 latency and the peak memory allocated by a second run of (up to)
+# memory_sample ops, traced with tracemalloc where available.
+from __future__ import print_function
+
+from bisect import bisect
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from .backends import MemoryBackend, MongoBackend
+from .instrument import Instrumentation
+from .mongotree import MongoTree
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+# Workloads.
+
+def weighted_choice(rnd, items, cumulative):
+    """Pick one of items, given their cumulative weights."""
+    return items[bisect(cumulative, rnd.random() * cumulative[-1])]
+
+
+def zipf_weights(n, s=1.0):
+    """Return the cumulative Zipf weights of n ranks."""
+    cumulative, total = [], 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** s
+        cumulative.append(total)
+    return cumulative
+
+
+def deep_paths(n, depth=50, seed=1):
+    """Paths hanging off one long chain, at random depths."""
+    rnd = random.Random(seed)
+    return [['deep'] + ['l%d' % level for level in range(rnd.randint(1, depth))]
+            + ['leaf%d' % i] for i in range(n)]
+
+
+def wide_paths(n, roots=3):
+    """A few roots with a very wide fan-out."""
+    return [['wide%d' % (i % roots), 'c%d' % i] for i in range(n)]
+
+
+def sql_paths(n, seed=1):
+    """Tokenized SQL statements, with Zipf distributed verbs, tables and
+    columns, like a query log."""
+    rnd = random.Random(seed)
+
+    verbs = ['select', 'insert', 'update', 'delete']
+    verb_weights = [0.7, 0.85, 0.95, 1.0]
+    tables = ['t%d' % i for i in range(200)]
+    table_weights = zipf_weights(len(tables))
+    columns = ['c%d' % i for i in range(60)]
+    column_weights = zipf_weights(len(columns))
+    ops = ['=', '<', '>', 'in', 'like']
+
+    def column():
+        return weighted_choice(rnd, columns, column_weights)
+
+    paths = []
+    for i in range(n):
+        verb = weighted_choice(rnd, verbs, verb_weights)
+        table = weighted_choice(rnd, tables, table_weights)
+        if verb == 'select':
+            path = ['select'] + sorted(set(column() for _ in
+                                           range(rnd.randint(1, 4))))
+            path += ['from', table]
+        elif verb == 'insert':
+            path = ['insert', 'into', table, 'values']
+        elif verb == 'update':
+            path = ['update', table, 'set', column()]
+        else:
+            path = ['delete', 'from', table]
+        if verb != 'insert' and rnd.random() < 0.8:
+            path += ['where', column(), rnd.choice(ops), '?']
+        paths.append(path)
+    return paths
+
+
+WORKLOADS = {
+    'deep': deep_paths,
+    'wide': wide_paths,
+    'sql': sql_paths,
+}
+
+
+def to_xml(paths):
+    """Return an XML document with an element path for each path."""
+    root = {}
+    for path in paths:
+        node = root
+        for token in path:
+            node = node.setdefault(token, {})
+
+    def render(children):
+        return ''.join('<%s>%s</%s>' % (tag, render(child), tag)
+                       for tag, child in children.items())
+
+    # Tokens are not all valid tag names; wrap them in a known element.
+    def tag(token):
+        return 't_%s' % ''.join(c if c.isalnum() else '_' for c in token)
+
+    def rename(children):
+        return dict((tag(token), rename(child))
+                    for token, child in children.items())
+
+    return '<doc>%s</doc>' % render(rename(root))
+
+
+# Measuring.
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100.0 *
+                                                  (len(values) - 1))))]
+
+
+def measure(method, ops, instrumentation, memory_sample=100,
+            memory_ops=None):
+    """Run a list of zero argument callables and describe their cost.
+
+    Arguments:
+        method (string): The name of the measured method.
+        ops (list): The callables.
+        instrumentation (Instrumentation): The instrumentation of the trees
+            the ops use.
+        memory_sample (int): How many ops to repeat under tracemalloc.
+        memory_ops (callable): Returns fresh ops, equivalent to ops, to run
+            under tracemalloc instead of repeating ops, for ops that change
+            the tree. Called before tracing starts.
+
+    Returns:
+        dict. The measurements of method.
+    """
+    latencies = []
+    instrumentation.reset()
+
+    started = timer()
+    for op in ops:
+        start = timer()
+        op()
+        latencies.append(timer() - start)
+    seconds = timer() - started
+
+    calls = instrumentation.queries
+    stats = instrumentation.stats().values()
+    docs = sum(stat['docs'] for stat in stats)
+    size = sum(stat['bytes'] for stat in stats)
+    latencies.sort()
+
+    peak = None
+    if tracemalloc is not None and memory_sample:
+        if memory_ops is not None:
+            ops = memory_ops()
+        tracemalloc.start()
+        for op in ops[:memory_sample]:
+            op()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    n = len(latencies)
+    return {'method': method, 'ops': n, 'seconds': seconds,
+            'ops_per_sec': n / seconds if seconds else None,
+            'round_trips_per_op': float(calls) / n if n else None,
+            'docs_per_op': float(docs) / n if n else None,
+            'bytes_per_op': float(size) / n if n else None,
+            'p50_ms': percentile(latencies, 50) * 1000 if n else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if n else None,
+            'peak_memory_bytes': peak}
+
+
+def run_workload(name, paths, make_tree, memory_sample=100, seed=1):
+    """Build a tree from paths and measure its public methods.
+
+    Arguments:
+        name (string): The name of the workload.
+        paths (list): The paths of the tree.
+        make_tree (callable): Returns an empty MongoTree for an identifier
+            and an Instrumentation.
+        memory_sample (int): How many ops to repeat under tracemalloc.
+
+    Returns:
+        list of dicts, one per method.
+    """
+    rnd = random.Random(seed)
+    instrumentation = Instrumentation()
+    tree = make_tree('bench-%s' % name, instrumentation)
+    results = []
+
+    def run(method, ops, memory_ops=None):
+        result = measure(method, ops, instrumentation, memory_sample,
+                         memory_ops)
+        result['workload'] = name
+        results.append(result)
+
+    # The ops of methods that change the tree are not the same ops when
+    # repeated (upserts of existing paths, removes of removed nodes), so
+    # their memory is sampled on a fresh tree in the state they were timed.
+    def fresh_tree(method, setup_paths=()):
+        copy = make_tree('bench-%s-%s' % (name, method), Instrumentation())
+        if setup_paths:
+            copy.upsert_many(setup_paths)
+        return copy
+
+    def sample(items, n):
+        items = list(items)
+        return rnd.sample(items, min(n, len(items)))
+
+    half = len(paths) // 2
+
+    def upserts(tree):
+        return [lambda p=p: tree.upsert(p) for p in paths[:half]]
+    run('upsert', upserts(tree), lambda: upserts(fresh_tree('upsert')))
+
+    batches = [paths[i:i + 100] for i in range(half, len(paths), 100)]
+
+    def bulk_upserts(tree):
+        return [lambda b=b: tree.upsert_many(b) for b in batches]
+    run('upsert_many', bulk_upserts(tree),
+        lambda: bulk_upserts(fresh_tree('upsert_many', paths[:half])))
+
+    lookups = sample(paths, 200)
+    run('get_node_by_path',
+        [lambda p=p: tree.get_node_by_path(p) for p in lookups])
+    run('path_exists', [lambda p=p: tree.path_exists(p) for p in lookups])
+    parents = sample(set(tuple(p[:-1]) for p in paths if len(p) > 1), 200)
+    run('get_children', [lambda p=p: tree.get_children(list(p))
+                         for p in parents])
+    run('get_descendants', [lambda p=p: tree.get_descendants(list(p),
+                                                             max_depth=2)
+                            for p in parents[:50]])
+
+    roots = sample(tree.iter_roots(), 20)
+    run('traverse', [lambda r=r: tree.traverse(r) for r in roots])
+    run('get_leaf_nodes', [lambda r=r: tree.get_leaf_nodes(r)
+                           for r in roots])
+    run('node_count', [tree.node_count] * 20)
+    run('top_paths', [lambda: tree.top_paths(10)] * 20)
+    run('snapshot', [tree.snapshot] * 3)
+    run('get_dotgraph', [lambda: tree.get_dotgraph(max_nodes=1000)] * 3)
+
+    documents = [to_xml(paths[i:i + 100]) for i in range(0, len(paths), 100)]
+
+    def imports(tree):
+        return [lambda d=d: tree.fromXml(d) for d in documents[:10]]
+    run('fromXml', imports(make_tree('bench-%s-xml' % name, instrumentation)),
+        lambda: imports(fresh_tree('fromXml')))
+
+    def removes(tree):
+        removals = [tree.get_node_by_path(list(p)) for p in parents[:50]]
+        return [lambda n=n: tree.remove(n) for n in removals if n]
+    run('remove', removes(tree), lambda: removes(fresh_tree('remove', paths)))
+
+    return results
+
+
+def run(backend='memory', scale=1000, workloads=None, uri=None,
+        memory_sample=100, seed=1):
+    """Run the benchmarks.
+
+    Arguments:
+        backend (string): 'memory' or 'mongo'.
+        scale (int): The number of paths per workload.
+        workloads (list): Names from WORKLOADS. Default: all.
+        uri (string): The mongodb URI for the 'mongo' backend.
+        memory_sample (int): How many ops to repeat under tracemalloc.
+        seed (int): Seeds the workloads and samples.
+
+    Returns:
+        dict. {'meta': ..., 'results': [...]}, ready for json.
+    """
+    if backend == 'memory':
+        storage = MemoryBackend()
+    else:
+        storage = MongoBackend(uri=uri, db_name='mongotree_bench',
+                               collection='bench')
+
+    def make_tree(identifier, instrumentation):
+        tree = MongoTree(identifier=identifier, backend=storage,
+                         instrumentation=instrumentation)
+        tree.ensure_indexes()
+        return tree
+
+    results = []
+    try:
+        for name in workloads or sorted(WORKLOADS):
+            if name == 'wide':
+                paths = WORKLOADS[name](scale)
+            else:
+                paths = WORKLOADS[name](scale, seed=seed)
+            results.extend(run_workload(name, paths, make_tree,
+                                        memory_sample=memory_sample,
+                                        seed=seed))
+    finally:
+        storage.drop()
+
+    meta = {'backend': backend, 'scale': scale, 'seed': seed,
+            'python': platform.python_version(), 'time': time.time(),
+            'memory_traced': tracemalloc is not None and
+            bool(memory_sample)}
+    return {'meta': meta, 'results': results}
+
+
+def format_table(report):
+    """Return the results of a report as a text table."""
+    columns = ('workload', 'method', 'ops', 'ops_per_sec',
+               'round_trips_per_op', 'docs_per_op', 'bytes_per_op', 'p50_ms',
+               'p99_ms', 'peak_memory_bytes')
+    rows = [columns]
+    for result in report['results']:
+        rows.append(tuple(('%.2f' % result[c] if isinstance(result[c], float)
+                           else str(result[c])) for c in columns))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width) if i > 1 else
+                               cell.ljust(width)
+                               for i, (cell, width) in
+                               enumerate(zip(row, widths)))
+                     for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark MongoTree operations on synthetic trees.')
+    parser.add_argument('--backend', choices=('memory', 'mongo'),
+                        default='memory')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='paths per workload')
+    parser.add_argument('--workload', action='append',
+                        choices=sorted(WORKLOADS),
+                        help='run only this workload (repeatable)')
+    parser.add_argument('--memory-sample', type=int, default=100,
+                        help='ops repeated under tracemalloc, 0 to skip')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args(argv)
+
+    report = run(backend=args.backend, scale=args.scale,
+                 workloads=args.workload, uri=args.uri,
+                 memory_sample=args.memory_sample, seed=args.seed)
+
+    print(format_table(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
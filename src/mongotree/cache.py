@@ -0,0 +1,207 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from collections import OrderedDict
+
+import threading
+import time
+
+
+def synchronized(method):
+    """Run a method while holding the lock of its instance (self._lock)."""
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def copy_node(node):
+    """Return a copy of a node whose fields, and the children and ancestors
+    lists, can be changed without changing node. The values themselves
+    (ObjectIds, obj) are shared, so this costs no more than a list copy even
+    for nodes with many children or a large obj."""
+    node = dict(node)
+    for key in ('children', 'ancestors'):
+        if isinstance(node.get(key), list):
+            node[key] = list(node[key])
+    return node
+
+
+class NodeCache(object):
+    """A bounded, thread-safe LRU cache of nodes, looked up by ObjectId or
+    by (identifier, path), with an optional time to live."""
+
+    def __init__(self, size=1000, ttl=None):
+        """Initialization routines.
+
+        Arguments:
+            size (int): The maximum number of nodes to hold.
+            ttl (float): Seconds a node stays valid. Default: forever.
+        """
+        self.size = size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # _id -> (node, expiry time), least recently used first.
+        self._nodes = OrderedDict()
+        # (identifier, path) -> _id
+        self._paths = {}
+
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @synchronized
+    def stats(self):
+        """Return the counters of the cache.
+
+        Returns:
+            dict. The 'hits', 'misses', 'evictions' and current 'size'.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._nodes)}
+
+    @synchronized
+    def get_by_objectid(self, object_id):
+        """Return a copy of the cached node with an _id of object_id.
+
+        Arguments:
+            object_id (bson.objectid.ObjectId): The _id of the node.
+
+        Returns:
+            A dict representing a node || None on a miss.
+        """
+        entry = self._nodes.pop(object_id, None)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        node, expires = entry
+        if expires is not None and expires < time.time():
+            self._forget(node)
+            self.misses += 1
+            return None
+
+        # Re-insert to mark the node as the most recently used.
+        self._nodes[object_id] = entry
+        self.hits += 1
+
+        return copy_node(node)
+
+    @synchronized
+    def get_by_path(self, identifier, path):
+        """Return a copy of the cached node at a path.
+
+        Arguments:
+            identifier (string): The identifier of the tree.
+            path (string): The path of the node.
+
+        Returns:
+            A dict representing a node || None on a miss.
+        """
+        object_id = self._paths.get((identifier, path))
+
+        if object_id is None:
+            self.misses += 1
+            return None
+
+        return self.get_by_objectid(object_id)
+
+    @synchronized
+    def put(self, node):
+        """Add a node to the cache, evicting the least recently used node if
+        the cache is full.
+
+        Arguments:
+            node (dict): A dict representing a node.
+        """
+        self.invalidate_objectid(node['_id'])
+        self.invalidate_path(node['identifier'], node['path'])
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        self._nodes[node['_id']] = (copy_node(node), expires)
+        self._paths[(node['identifier'], node['path'])] = node['_id']
+
+        while len(self._nodes) > self.size:
+            _, (evicted, _) = self._nodes.popitem(last=False)
+            self._paths.pop((evicted['identifier'], evicted['path']), None)
+            self.evictions += 1
+
+    @synchronized
+    def invalidate_objectid(self, object_id):
+        """Drop the node with an _id of object_id from the cache.
+
+        Arguments:
+            object_id (bson.objectid.ObjectId): The _id of the node.
+        """
+        entry = self._nodes.get(object_id)
+        if entry is not None:
+            self._forget(entry[0])
+
+    @synchronized
+    def invalidate_path(self, identifier, path):
+        """Drop the node at a path from the cache.
+
+        Arguments:
+            identifier (string): The identifier of the tree.
+            path (string): The path of the node.
+        """
+        object_id = self._paths.get((identifier, path))
+        if object_id is not None:
+            self.invalidate_objectid(object_id)
+
+    @synchronized
+    def invalidate_prefix(self, identifier, prefix):
+        """Drop every node whose path starts with prefix from the cache.
+
+        Arguments:
+            identifier (string): The identifier of the tree.
+            prefix (string): The start of the paths to drop.
+        """
+        for key in list(self._paths):
+            if key[0] == identifier and key[1].startswith(prefix):
+                self.invalidate_objectid(self._paths[key])
+
+    @synchronized
+    def clear(self):
+        """Drop every node from the cache."""
+        self._nodes.clear()
+        self._paths.clear()
+
+    def _forget(self, node):
+        """Remove both index entries of a cached node."""
+        self._nodes.pop(node['_id'], None)
+        self._paths.pop((node['identifier'], node['path']), None)
@@ -0,0 +1,336 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from contextlib import contextmanager
+
+import bson
+import functools
+import inspect
+import logging
+import threading
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+logger = logging.getLogger('mongotree')
+
+# The collection methods that are one round trip to the server each.
+QUERY_METHODS = ('find', 'find_one', 'count_documents', 'aggregate',
+                 'bulk_write', 'update', 'update_one', 'update_many',
+                 'replace_one', 'insert_one', 'delete_one', 'delete_many',
+                 'create_index', 'index_information', 'drop')
+
+
+def operation(method):
+    """Attribute the collection access of a MongoTree method to it, when the
+    tree is instrumented. Calls made while another operation runs in the
+    same thread count towards that one. Generator methods, and methods that
+    return a generator, are one operation from the call to the last item
+    the generator yields."""
+    name = method.__name__
+
+    if inspect.isgeneratorfunction(method):
+        def wrapper(self, *args, **kwargs):
+            generator = method(self, *args, **kwargs)
+            if self.instrumentation is None:
+                return generator
+            return self.instrumentation.wrap_generator(name, generator)
+    else:
+        def wrapper(self, *args, **kwargs):
+            if self.instrumentation is None:
+                return method(self, *args, **kwargs)
+            return self.instrumentation.call(name, method, self, *args,
+                                             **kwargs)
+
+    return functools.wraps(method)(wrapper)
+
+
+class OperationStats(object):
+    """The cost of one (or, summed up, many) calls of a method."""
+
+    def __init__(self, method):
+        self.method = method
+        self.calls = 1
+        self.seconds = 0.0
+        self.queries = 0
+        self.docs = 0
+        self.bytes = 0
+        # Collection method -> [calls, seconds].
+        self.stages = {}
+
+    def add_query(self, stage, seconds):
+        """Count a collection call."""
+        self.queries += 1
+        self.add_time(stage, seconds, calls=1)
+
+    def add_time(self, stage, seconds, calls=0):
+        """Add time spent in a stage, e.g. reading a cursor."""
+        entry = self.stages.setdefault(stage, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+    def add(self, other):
+        """Add the counters of another OperationStats."""
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.queries += other.queries
+        self.docs += other.docs
+        self.bytes += other.bytes
+        for stage, (calls, seconds) in other.stages.items():
+            self.add_time(stage, seconds, calls)
+
+    def to_dict(self):
+        """Return the counters as a dict. The 'client' stage is the time
+        spent outside the collection calls."""
+        stages = dict((stage, {'calls': calls, 'seconds': seconds})
+                      for stage, (calls, seconds) in self.stages.items())
+        db_seconds = sum(seconds for calls, seconds in self.stages.values())
+        stages['client'] = {'calls': 0,
+                            'seconds': max(self.seconds - db_seconds, 0.0)}
+        return {'method': self.method, 'calls': self.calls,
+                'seconds': self.seconds, 'queries': self.queries,
+                'docs': self.docs, 'bytes': self.bytes, 'stages': stages}
+
+
+class Instrumentation(object):
+    """Counts the queries, returned documents and bytes of every public
+    MongoTree method, and times the collection calls they make.
+
+    Pass one to MongoTree(instrumentation=...), which then accesses its
+    collections through InstrumentedCollection proxies.
+    """
+
+    def __init__(self, callback=None, slow_ms=None, count_bytes=True):
+        """Initialization routines.
+
+        Arguments:
+            callback (callable): Called with OperationStats.to_dict() after
+                every operation, e.g. to feed a metrics system.
+            slow_ms (float): Log operations that take at least this many
+                milliseconds as warnings on the 'mongotree' logger.
+            count_bytes (bool): Measure the BSON size of returned documents.
+        """
+        self.callback = callback
+        self.slow_ms = slow_ms
+        self.count_bytes = count_bytes
+        self.queries = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def current(self):
+        """Return the OperationStats of the operation running in this thread
+        or None."""
+        return getattr(self._local, 'current', None)
+
+    @contextmanager
+    def operation(self, name):
+        """Run a block as an operation, unless one is running already."""
+        if self.current() is not None:
+            yield
+            return
+
+        stats = OperationStats(name)
+        self._local.current = stats
+        start = timer()
+        try:
+            yield
+        finally:
+            stats.seconds += timer() - start
+            self._local.current = None
+            self._finish(stats)
+
+    def call(self, name, function, *args, **kwargs):
+        """Run a function as an operation, unless one is running already. If
+        it returns a generator, the operation lasts until its last item."""
+        if self.current() is not None:
+            return function(*args, **kwargs)
+
+        stats = OperationStats(name)
+        self._local.current = stats
+        start = timer()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            stats.seconds += timer() - start
+            self._local.current = None
+            if not inspect.isgenerator(result):
+                self._finish(stats)
+
+        if inspect.isgenerator(result):
+            return self._iter_operation(stats, result)
+        return result
+
+    def wrap_generator(self, name, generator):
+        """Run a generator as one operation."""
+        if self.current() is not None:
+            return generator
+        return self._iter_operation(OperationStats(name), generator)
+
+    def _iter_operation(self, stats, generator):
+        try:
+            while True:
+                self._local.current = stats
+                start = timer()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    stats.seconds += timer() - start
+                    self._local.current = None
+                yield item
+        finally:
+            self._finish(stats)
+
+    def _finish(self, stats):
+        """Add up and report a finished operation."""
+        with self._lock:
+            if stats.method in self._totals:
+                self._totals[stats.method].add(stats)
+            else:
+                total = OperationStats(stats.method)
+                total.calls = 0
+                total.add(stats)
+                self._totals[stats.method] = total
+
+        report = None
+        if self.callback is not None:
+            report = stats.to_dict()
+            self.callback(report)
+
+        if self.slow_ms is not None and stats.seconds * 1000 >= self.slow_ms:
+            report = report or stats.to_dict()
+            logger.warning('slow %s: %.1f ms, %d queries, %d docs, '
+                           '%d bytes', report['method'],
+                           report['seconds'] * 1000, report['queries'],
+                           report['docs'], report['bytes'])
+
+    def record_query(self, stage, seconds):
+        """Count a collection call of the current operation."""
+        stats = self.current()
+        with self._lock:
+            self.queries += 1
+        if stats is not None:
+            stats.add_query(stage, seconds)
+        return stats
+
+    def record_docs(self, stats, docs):
+        """Count documents returned to an operation."""
+        if stats is None:
+            return
+        stats.docs += len(docs)
+        if self.count_bytes:
+            stats.bytes += sum(len(bson.BSON.encode(doc)) for doc in docs)
+
+    def stats(self):
+        """Return the summed up counters of every method.
+
+        Returns:
+            dict. Method name -> OperationStats.to_dict().
+        """
+        with self._lock:
+            return dict((method, total.to_dict())
+                        for method, total in self._totals.items())
+
+    def reset(self):
+        """Forget all counters."""
+        with self._lock:
+            self.queries = 0
+            self._totals = {}
+
+
+class InstrumentedCollection(object):
+    """A proxy of a collection that reports its calls to an
+    Instrumentation."""
+
+    def __init__(self, collection, instrumentation):
+        self._collection = collection
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in QUERY_METHODS:
+            return attr
+
+        instrumentation = self._instrumentation
+
+        def call(*args, **kwargs):
+            start = timer()
+            result = attr(*args, **kwargs)
+            stats = instrumentation.record_query(name, timer() - start)
+
+            if name == 'find':
+                return InstrumentedCursor(result, instrumentation, stats)
+            if name == 'aggregate':
+                return iter(InstrumentedCursor(result, instrumentation,
+                                               stats, stage='aggregate'))
+            if name == 'find_one' and result is not None:
+                instrumentation.record_docs(stats, [result])
+            return result
+
+        return call
+
+    def with_options(self, **kwargs):
+        return InstrumentedCollection(
+            self._collection.with_options(**kwargs), self._instrumentation)
+
+
+class InstrumentedCursor(object):
+    """A proxy of a cursor that counts the documents read from it and the
+    time spent fetching them."""
+
+    def __init__(self, cursor, instrumentation, stats, stage='find'):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+        self._stats = stats
+        self._stage = stage
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name not in ('sort', 'skip', 'limit', 'batch_size'):
+            return attr
+
+        def chain(*args, **kwargs):
+            self._cursor = attr(*args, **kwargs)
+            return self
+        return chain
+
+    def __iter__(self):
+        iterator = iter(self._cursor)
+        while True:
+            start = timer()
+            try:
+                doc = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                if self._stats is not None:
+                    self._stats.add_time(self._stage, timer() - start)
+            self._instrumentation.record_docs(self._stats, [doc])
+            yield doc
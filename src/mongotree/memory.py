@@ -0,0 +1,941 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from copy import deepcopy
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import bson
+import pymongo
+import re
+import threading
+
+from .cache import synchronized
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+# Stands in for a field that a document does not have.
+MISSING = object()
+
+# Characters that end the literal prefix of an anchored regex.
+REGEX_METACHARS = '.^$*+?{}[]|()'
+
+REGEX_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL,
+               'x': re.VERBOSE}
+
+
+class MemoryCollection(object):
+    """An in-memory stand-in for the parts of a pymongo Collection that
+    MongoTree uses.
+
+    Documents are kept in insertion order. Lookups on _id, on
+    (identifier, path) and on (identifier, parent) are served from dict
+    indexes, and path ranges or anchored path regexes from a sorted index of
+    the paths of each identifier. Everything else is a scan.
+
+    Single operations are atomic, as on a server, so the collection can be
+    shared by threads. Updates replace documents instead of changing them in
+    place, so open cursors are not affected by later writes.
+    """
+
+    def __init__(self):
+        """Initialization routines."""
+        self._lock = threading.RLock()
+        self.drop()
+
+    @synchronized
+    def drop(self):
+        """Remove all documents and indexes."""
+        self._seq = 0
+        # _id -> document, and _id -> insertion sequence number.
+        self._docs = OrderedDict()
+        self._seqs = {}
+        # (identifier, path) / (identifier, parent) -> set of _id.
+        self._by_path = {}
+        self._by_parent = {}
+        # identifier -> sorted list of (path, seq), and seq -> _id.
+        self._paths = {}
+        self._seq_ids = {}
+        self._indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def with_options(self, **kwargs):
+        """Return the collection; options have no meaning in memory."""
+        return self
+
+    # Indexes.
+
+    @synchronized
+    def create_index(self, keys, **options):
+        """Record an index. Lookups are always served by the built-in indexes.
+
+        Returns:
+            string. The name of the index.
+        """
+        if isinstance(keys, string_types):
+            keys = [(keys, pymongo.ASCENDING)]
+
+        name = options.pop('name', None)
+        if not name:
+            name = '_'.join('%s_%s' % key for key in keys)
+
+        info = {'key': list(keys)}
+        info.update(options)
+        self._indexes[name] = info
+
+        return name
+
+    @synchronized
+    def index_information(self):
+        """Return the recorded indexes, like pymongo does."""
+        return deepcopy(self._indexes)
+
+    # Reads.
+
+    def find(self, filter=None, projection=None):
+        """Return a MemoryCursor over the matching documents."""
+        return MemoryCursor(self._find(filter or {}), projection)
+
+    def find_one(self, filter=None, projection=None):
+        """Return the first matching document || None."""
+        for doc in self.find(filter, projection).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, filter):
+        """Return the number of matching documents."""
+        return len(self._find(filter))
+
+    def aggregate(self, pipeline):
+        """Run an aggregation pipeline of $match, $project, $group, $sort,
+        $skip and $limit stages.
+
+        Returns:
+            An iterator of the resulting documents.
+        """
+        # Let a leading $match use the indexes.
+        first = pipeline[0] if pipeline else {}
+        docs = [deepcopy(doc) for doc in self._find(first.get('$match', {}))]
+
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == '$match':
+                docs = [doc for doc in docs if match(doc, spec)]
+            elif name == '$project':
+                docs = [project_expression(doc, spec) for doc in docs]
+            elif name == '$group':
+                docs = group(docs, spec)
+            elif name == '$sort':
+                docs = sort(docs, list(spec.items()))
+            elif name == '$skip':
+                docs = docs[spec:]
+            elif name == '$limit':
+                docs = docs[:spec]
+            else:
+                raise NotImplementedError('MemoryCollection: unsupported '
+                                          'aggregation stage %s' % name)
+
+        return iter(docs)
+
+    # Writes.
+
+    def insert_one(self, document):
+        """Insert a document."""
+        doc = deepcopy(document)
+        doc.setdefault('_id', bson.ObjectId())
+        self._insert(doc)
+        document.setdefault('_id', doc['_id'])
+        return Result(inserted_id=doc['_id'])
+
+    def update_one(self, filter, update, upsert=False):
+        """Update the first matching document."""
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False):
+        """Update all matching documents."""
+        return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        """Replace the first matching document."""
+        return self._update(filter, replacement, upsert, multi=False)
+
+    def update(self, spec, document, upsert=False, multi=False):
+        """The legacy pymongo update()."""
+        self._update(spec, document, upsert, multi)
+
+    def delete_one(self, filter):
+        """Delete the first matching document."""
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter):
+        """Delete all matching documents."""
+        return self._delete(filter, multi=True)
+
+    def bulk_write(self, requests, ordered=True):
+        """Apply a list of pymongo write operations, in order.
+
+        Duplicate key errors are collected like pymongo does: an ordered bulk
+        stops at the first one, an unordered bulk goes on, and a
+        BulkWriteError with the details is raised at the end.
+
+        Returns:
+            A Result with the counts and upserted_ids of a BulkWriteResult.
+        """
+        counts = {'inserted_count': 0, 'matched_count': 0,
+                  'modified_count': 0, 'deleted_count': 0,
+                  'upserted_count': 0}
+        upserted_ids = {}
+        errors = []
+
+        for i, request in enumerate(requests):
+            try:
+                self._bulk_write_one(i, request, counts, upserted_ids)
+            except DuplicateKeyError as e:
+                errors.append({'index': i, 'code': 11000, 'errmsg': str(e),
+                               'op': request})
+                if ordered:
+                    break
+
+        if errors:
+            raise BulkWriteError({
+                'writeErrors': errors, 'writeConcernErrors': [],
+                'nInserted': counts['inserted_count'],
+                'nUpserted': counts['upserted_count'],
+                'nMatched': counts['matched_count'],
+                'nModified': counts['modified_count'],
+                'nRemoved': counts['deleted_count'],
+                'upserted': [{'index': i, '_id': _id}
+                             for i, _id in sorted(upserted_ids.items())]})
+
+        return Result(upserted_ids=upserted_ids, **counts)
+
+    # Internals.
+
+    def _bulk_write_one(self, i, request, counts, upserted_ids):
+        """Apply the request at index i of a bulk_write()."""
+        if isinstance(request, pymongo.InsertOne):
+            self.insert_one(request._doc)
+            counts['inserted_count'] += 1
+            return
+
+        if isinstance(request, (pymongo.DeleteOne, pymongo.DeleteMany)):
+            multi = isinstance(request, pymongo.DeleteMany)
+            result = self._delete(request._filter, multi)
+            counts['deleted_count'] += result.deleted_count
+            return
+
+        if isinstance(request, (pymongo.UpdateOne, pymongo.ReplaceOne)):
+            multi = False
+        elif isinstance(request, pymongo.UpdateMany):
+            multi = True
+        else:
+            raise NotImplementedError('MemoryCollection: unsupported '
+                                      'bulk operation %r' % request)
+
+        result = self._update(request._filter, request._doc,
+                              request._upsert, multi)
+        counts['matched_count'] += result.matched_count
+        counts['modified_count'] += result.modified_count
+        if result.upserted_id is not None:
+            upserted_ids[i] = result.upserted_id
+            counts['upserted_count'] += 1
+
+    @synchronized
+    def _find(self, filter):
+        """Return the matching documents (not copies) in insertion order."""
+        candidates = self._candidates(filter)
+
+        if candidates is None:
+            candidates = self._docs
+        else:
+            # Candidates can name documents that do not exist (e.g. an $in
+            # of dangling child ids).
+            candidates = sorted((_id for _id in candidates
+                                 if _id in self._docs), key=self._seqs.get)
+
+        return [self._docs[_id] for _id in candidates
+                if match(self._docs[_id], filter)]
+
+    def _candidates(self, filter):
+        """Use the built-in indexes to narrow down the documents that may
+        match filter.
+
+        Returns:
+            A collection of _ids || None if every document has to be checked.
+        """
+        if '_id' in filter:
+            cond = filter['_id']
+            if is_operator(cond):
+                if list(cond) == ['$in']:
+                    return set(cond['$in'])
+            else:
+                return [cond]
+
+        identifier = filter.get('identifier', MISSING)
+        if identifier is MISSING or is_operator(identifier):
+            return None
+
+        if 'path' in filter:
+            cond = filter['path']
+            if not is_operator(cond):
+                return self._by_path.get((identifier, cond), ())
+            if list(cond) == ['$in']:
+                ids = set()
+                for path in cond['$in']:
+                    ids.update(self._by_path.get((identifier, path), ()))
+                return ids
+            bounds = path_bounds(cond)
+            if bounds:
+                return self._path_range(identifier, *bounds)
+
+        if 'parent' in filter and not is_operator(filter['parent']):
+            return self._by_parent.get((identifier, filter['parent']), ())
+
+        return None
+
+    def _path_range(self, identifier, low, high):
+        """Return the _ids of the documents with low <= path < high."""
+        paths = self._paths.get(identifier, [])
+        start = bisect_left(paths, (low,))
+        end = bisect_left(paths, (high,)) if high is not None else len(paths)
+        return [self._seq_ids[seq] for _, seq in paths[start:end]]
+
+    @synchronized
+    def _insert(self, doc):
+        """Add a document and index it."""
+        if doc['_id'] in self._docs:
+            raise DuplicateKeyError(
+                'E11000 duplicate key error _id: %r' % (doc['_id'],))
+
+        self._seq += 1
+        self._docs[doc['_id']] = doc
+        self._seqs[doc['_id']] = self._seq
+        self._seq_ids[self._seq] = doc['_id']
+        self._index(doc)
+
+    def _index(self, doc):
+        """Add a document to the built-in indexes."""
+        identifier = doc.get('identifier')
+        if 'path' in doc:
+            self._by_path.setdefault((identifier, doc['path']),
+                                     set()).add(doc['_id'])
+            if isinstance(doc['path'], string_types):
+                insort(self._paths.setdefault(identifier, []),
+                       (doc['path'], self._seqs[doc['_id']]))
+        if 'parent' in doc:
+            self._by_parent.setdefault((identifier, doc['parent']),
+                                       set()).add(doc['_id'])
+
+    def _unindex(self, doc):
+        """Remove a document from the built-in indexes."""
+        identifier = doc.get('identifier')
+        if 'path' in doc:
+            self._by_path.get((identifier, doc['path']),
+                              set()).discard(doc['_id'])
+            if isinstance(doc['path'], string_types):
+                paths = self._paths[identifier]
+                entry = (doc['path'], self._seqs[doc['_id']])
+                del paths[bisect_left(paths, entry)]
+        if 'parent' in doc:
+            self._by_parent.get((identifier, doc['parent']),
+                                set()).discard(doc['_id'])
+
+    @synchronized
+    def _update(self, filter, update, upsert, multi):
+        """Apply an update (or replacement) document."""
+        docs = self._find(filter)
+        if not multi:
+            docs = docs[:1]
+
+        modified = 0
+        for doc in docs:
+            new_doc = deepcopy(doc)
+            apply_update(new_doc, update, filter, is_insert=False)
+            if new_doc != doc:
+                self._unindex(doc)
+                self._docs[doc['_id']] = new_doc
+                self._index(new_doc)
+                modified += 1
+
+        upserted_id = None
+        if not docs and upsert:
+            doc = {}
+            for key, value in filter.items():
+                if not key.startswith('$') and not is_operator(value):
+                    set_field(doc, key, deepcopy(value), filter)
+            apply_update(doc, update, filter, is_insert=True)
+            doc.setdefault('_id', bson.ObjectId())
+            self._insert(doc)
+            upserted_id = doc['_id']
+
+        return Result(matched_count=len(docs), modified_count=modified,
+                      upserted_id=upserted_id)
+
+    @synchronized
+    def _delete(self, filter, multi):
+        """Delete the matching documents."""
+        docs = self._find(filter)
+        if not multi:
+            docs = docs[:1]
+
+        for doc in docs:
+            self._unindex(doc)
+            del self._docs[doc['_id']]
+            del self._seq_ids[self._seqs.pop(doc['_id'])]
+
+        return Result(deleted_count=len(docs))
+
+
+class MemoryCursor(object):
+    """A minimal pymongo Cursor over a list of MemoryCollection documents."""
+
+    def __init__(self, docs, projection=None):
+        """Initialization routines.
+
+        Arguments:
+            docs (list): The matching documents, in natural order.
+            projection (dict): Fields to include or exclude.
+        """
+        self._docs = docs
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        """Sort on a key or a list of (key, direction) pairs."""
+        if isinstance(key_or_list, string_types):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        """Skip the first skip documents."""
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        """Return at most limit documents; 0 means no limit."""
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        """Accepted for compatibility; everything is already in memory."""
+        return self
+
+    def __iter__(self):
+        docs = self._docs
+        if self._sort:
+            docs = sort(docs, self._sort)
+
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+
+        for doc in docs:
+            yield project(doc, self._projection)
+
+
+class Result(object):
+    """The counts and ids that pymongo's write results expose."""
+
+    acknowledged = True
+
+    def __init__(self, **kwargs):
+        self.inserted_id = None
+        self.upserted_id = None
+        self.upserted_ids = {}
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.__dict__.update(kwargs)
+
+
+def is_operator(value):
+    """Indicate if value is a dict of $operators, e.g. {'$in': [...]}."""
+    return (isinstance(value, dict) and bool(value) and
+            all(key.startswith('$') for key in value))
+
+
+def get_field(doc, key):
+    """Return the (possibly dotted) field key of doc || MISSING."""
+    value = doc
+    for part in key.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and \
+                int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+    return value
+
+
+def set_field(doc, key, value, filter):
+    """Set the (possibly dotted) field key of doc. A '$' part is the index
+    of the array element that matched filter.
+    """
+    parts = key.split('.')
+    target = doc
+    for i, part in enumerate(parts[:-1]):
+        target = step_into(target, part, parts[:i], filter)
+
+    last = parts[-1]
+    if isinstance(target, list):
+        target[array_index(target, last, parts[:-1], filter)] = value
+    else:
+        target[last] = value
+
+
+def step_into(target, part, parents, filter):
+    """Return the container at part of target, creating dicts as needed."""
+    if isinstance(target, list):
+        return target[array_index(target, part, parents, filter)]
+    return target.setdefault(part, {})
+
+
+def array_index(array, part, parents, filter):
+    """Resolve a numeric or positional ('$') array index."""
+    if part != '$':
+        return int(part)
+
+    cond = filter.get('.'.join(parents), MISSING)
+    for i, element in enumerate(array):
+        if is_operator(cond) and match_operators(element, cond) or \
+                not is_operator(cond) and element == cond:
+            return i
+
+    raise ValueError('MemoryCollection: positional update did not match')
+
+
+def unset_field(doc, key):
+    """Remove the (possibly dotted) field key from doc."""
+    parts = key.split('.')
+    parent = get_field(doc, '.'.join(parts[:-1])) if parts[:-1] else doc
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+
+
+def match(doc, filter):
+    """Indicate if a document matches a query filter."""
+    for key, cond in filter.items():
+        if key == '$or':
+            if not any(match(doc, sub) for sub in cond):
+                return False
+        elif key == '$and':
+            if not all(match(doc, sub) for sub in cond):
+                return False
+        elif key == '$nor':
+            if any(match(doc, sub) for sub in cond):
+                return False
+        elif key.startswith('$'):
+            raise NotImplementedError('MemoryCollection: unsupported query '
+                                      'operator %s' % key)
+        elif is_operator(cond):
+            if not match_operators(get_field(doc, key), cond):
+                return False
+        elif not equals(get_field(doc, key), cond):
+            return False
+
+    return True
+
+
+def equals(value, cond):
+    """Equality the way MongoDB matches it, including array membership and
+    None matching missing fields.
+    """
+    if value is MISSING:
+        return cond is None
+    if value == cond:
+        return True
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return False
+
+
+def match_operators(value, cond):
+    """Indicate if a field value satisfies a dict of $operators."""
+    for op, arg in cond.items():
+        if op == '$in':
+            ok = any(equals(value, item) for item in arg)
+        elif op == '$nin':
+            ok = not any(equals(value, item) for item in arg)
+        elif op == '$ne':
+            ok = not equals(value, arg)
+        elif op == '$eq':
+            ok = equals(value, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            ok = any(compare(item, op, arg) for item in elements(value))
+        elif op == '$exists':
+            ok = (value is not MISSING) == bool(arg)
+        elif op == '$size':
+            ok = isinstance(value, list) and len(value) == arg
+        elif op == '$regex':
+            flags = 0
+            for option in cond.get('$options', ''):
+                flags |= REGEX_FLAGS.get(option, 0)
+            regex = re.compile(arg, flags)
+            ok = any(isinstance(item, string_types) and regex.search(item)
+                     for item in elements(value))
+        elif op == '$options':
+            continue
+        elif op == '$not':
+            ok = not match_operators(value, arg)
+        else:
+            raise NotImplementedError('MemoryCollection: unsupported query '
+                                      'operator %s' % op)
+        if not ok:
+            return False
+
+    return True
+
+
+def elements(value):
+    """Return the values a comparison applies to (array elements too)."""
+    if value is MISSING:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def compare(value, op, arg):
+    """Compare two values of the same kind; mismatched kinds never match."""
+    if value is None or arg is None or \
+            isinstance(value, string_types) != isinstance(arg, string_types):
+        return False
+    try:
+        if op == '$gt':
+            return value > arg
+        if op == '$gte':
+            return value >= arg
+        if op == '$lt':
+            return value < arg
+        return value <= arg
+    except TypeError:
+        return False
+
+
+def path_bounds(cond):
+    """Return the (low, high) range of paths a path condition is limited to
+    (high may be None) || None if the condition is not a range or an
+    anchored regex.
+    """
+    if '$regex' in cond:
+        if len(cond) != 1:
+            return None
+        prefix = regex_prefix(cond['$regex'])
+        if not prefix:
+            return None
+        return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+    low = cond.get('$gte', cond.get('$gt'))
+    if low is None or not set(cond) <= set(['$gt', '$gte', '$lt', '$lte']):
+        return None
+
+    return low, cond.get('$lt', cond.get('$lte'))
+
+
+def regex_prefix(pattern):
+    """Return the literal text an anchored regex must start with || None."""
+    if not isinstance(pattern, string_types) or not pattern.startswith('^'):
+        return None
+
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                prefix.append(pattern[i + 1])
+                i += 2
+                continue
+            break
+        if char in REGEX_METACHARS:
+            break
+        prefix.append(char)
+        i += 1
+
+    # A quantifier makes the last literal optional, and a top level
+    # alternation makes the whole prefix optional.
+    if pattern[i:i + 1] in ('*', '?', '{'):
+        prefix = prefix[:-1]
+    if has_top_level_alternation(pattern):
+        return None
+
+    return ''.join(prefix)
+
+
+def has_top_level_alternation(pattern):
+    """Indicate if a regex has a '|' outside of any group or class."""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            i += 2
+            continue
+        if in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+
+    return False
+
+
+def project(doc, projection):
+    """Return a copy of doc with only the fields projection asks for. Only
+    the projected fields are copied, so leaving out a large field is cheap.
+    """
+    if not projection:
+        return deepcopy(doc)
+
+    slices = {}
+    included = set()
+    excluded = set()
+    for key, value in projection.items():
+        if isinstance(value, dict) and '$slice' in value:
+            slices[key] = value['$slice']
+        elif value:
+            included.add(key)
+        else:
+            excluded.add(key)
+
+    if included:
+        included.update(slices)
+        if '_id' not in excluded:
+            included.add('_id')
+        result = {}
+        for key in included:
+            value = get_field(doc, key)
+            if value is not MISSING:
+                set_field(result, key, value, {})
+        result = deepcopy(result)
+    else:
+        result = deepcopy(dict((key, value) for key, value in doc.items()
+                               if key not in excluded))
+        for key in excluded:
+            unset_field(result, key)
+
+    for key, spec in slices.items():
+        value = get_field(result, key)
+        if isinstance(value, list):
+            if isinstance(spec, list):
+                start, count = spec
+                value = value[start:start + count]
+            elif spec >= 0:
+                value = value[:spec]
+            else:
+                value = value[spec:]
+            set_field(result, key, value, {})
+
+    return result
+
+
+def apply_update(doc, update, filter, is_insert):
+    """Apply an update document (or a replacement) to doc in place."""
+    if not any(key.startswith('$') for key in update):
+        _id = doc.get('_id', MISSING)
+        doc.clear()
+        doc.update(deepcopy(update))
+        if _id is not MISSING:
+            doc['_id'] = _id
+        return
+
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not is_insert:
+            continue
+        for key, value in fields.items():
+            value = deepcopy(value)
+            if op in ('$set', '$setOnInsert'):
+                set_field(doc, key, value, filter)
+            elif op == '$unset':
+                unset_field(doc, key)
+            elif op == '$inc':
+                current = get_field(doc, key)
+                set_field(doc, key,
+                          value if current is MISSING else current + value,
+                          filter)
+            elif op in ('$max', '$min'):
+                current = get_field(doc, key)
+                if current is MISSING or compare(value, '$gt' if op == '$max'
+                                                 else '$lt', current):
+                    set_field(doc, key, value, filter)
+            elif op in ('$addToSet', '$push'):
+                array = get_field(doc, key)
+                if array is MISSING:
+                    array = []
+                    set_field(doc, key, array, filter)
+                items = value['$each'] if is_operator(value) else [value]
+                for item in items:
+                    if op == '$push' or item not in array:
+                        array.append(item)
+            elif op == '$pull':
+                array = get_field(doc, key)
+                if isinstance(array, list):
+                    array[:] = [item for item in array
+                                if not (match_operators(item, value)
+                                        if is_operator(value)
+                                        else item == value)]
+            else:
+                raise NotImplementedError('MemoryCollection: unsupported '
+                                          'update operator %s' % op)
+
+
+def evaluate(expr, doc):
+    """Evaluate an aggregation expression against a document."""
+    if isinstance(expr, string_types) and expr.startswith('$'):
+        value = get_field(doc, expr[1:])
+        return None if value is MISSING else value
+
+    if is_operator(expr) and len(expr) == 1:
+        (op, args), = expr.items()
+        if op == '$literal':
+            return args
+        args = [evaluate(arg, doc) for arg in
+                (args if isinstance(args, list) else [args])]
+        if op == '$split':
+            string, separator = args
+            return string.split(separator) \
+                if isinstance(string, string_types) else None
+        if op == '$arrayElemAt':
+            array, index = args
+            if isinstance(array, list) and -len(array) <= index < len(array):
+                return array[index]
+            return None
+        if op == '$size':
+            return len(args[0])
+        if op == '$concat':
+            return ''.join(args) if None not in args else None
+        raise NotImplementedError('MemoryCollection: unsupported expression '
+                                  'operator %s' % op)
+
+    if isinstance(expr, dict):
+        return dict((key, evaluate(value, doc)) for key, value in expr.items())
+
+    if isinstance(expr, list):
+        return [evaluate(value, doc) for value in expr]
+
+    return expr
+
+
+def project_expression(doc, spec):
+    """Apply a $project stage to a document."""
+    if all(value in (0, False) for value in spec.values()):
+        return project(doc, spec)
+
+    result = {}
+    if spec.get('_id', 1):
+        result['_id'] = doc.get('_id')
+
+    for key, value in spec.items():
+        if key == '_id' and value in (0, 1, True, False):
+            continue
+        if value is True or value == 1:
+            field = get_field(doc, key)
+            if field is not MISSING:
+                set_field(result, key, field, {})
+        elif value not in (0, False):
+            set_field(result, key, evaluate(value, doc), {})
+
+    return result
+
+
+def group(docs, spec):
+    """Apply a $group stage to a list of documents."""
+    groups = {}
+    order = []
+
+    for doc in docs:
+        key = evaluate(spec['_id'], doc)
+        hashable = repr(key)
+        if hashable not in groups:
+            groups[hashable] = {'_id': key}
+            order.append(hashable)
+        result = groups[hashable]
+
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (op, expr), = accumulator.items()
+            value = evaluate(expr, doc)
+            if op == '$sum':
+                result[field] = result.get(field, 0) + \
+                    (value if isinstance(value, (int, float)) else 0)
+            elif op == '$first':
+                result.setdefault(field, value)
+            elif op == '$last':
+                result[field] = value
+            elif op == '$push':
+                result.setdefault(field, []).append(value)
+            elif op in ('$max', '$min'):
+                if field not in result or compare(
+                        value, '$gt' if op == '$max' else '$lt',
+                        result[field]):
+                    result[field] = value
+            else:
+                raise NotImplementedError('MemoryCollection: unsupported '
+                                          'accumulator %s' % op)
+
+    return [groups[key] for key in order]
+
+
+def sort(docs, keys):
+    """Return docs sorted on a list of (key, direction) pairs."""
+    docs = list(docs)
+    for key, direction in reversed(keys):
+        docs.sort(key=lambda doc: sort_key(get_field(doc, key)),
+                  reverse=direction == pymongo.DESCENDING)
+    return docs
+
+
+def sort_key(value):
+    """Order missing/None values first and keep mixed types comparable."""
+    if value is MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, string_types):
+        return (2, value)
+    return (3, value)
@@ -24,12 +24,62 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+from collections import OrderedDict
+from functools import partial
+from io import BytesIO
 from lxml import etree
 from pprint import pformat
 
+import atexit
 import bson
+import logging
 import pydot
 import pymongo
+import re
+import threading
+import time
+import weakref
+
+from . import parallel
+from .backends import MemoryBackend, MongoBackend
+from .cache import NodeCache
+from .instrument import InstrumentedCollection, operation
+from .node import NodeSession
+from .sketch import HeavyHitters
+from .snapshot import TreeSnapshot
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+logger = logging.getLogger('mongotree')
+
+# Trees with buffer_hits, whose pending hits are flushed at exit.
+_buffering_trees = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_buffering_trees():
+    for tree in list(_buffering_trees):
+        try:
+            tree.flush()
+        except Exception:
+            logger.exception('buffer_hits: flush at exit failed')
+
+
+def _flush_periodically(tree_ref, interval, stopped):
+    """Flush a tree every interval seconds, until stopped is set or the tree
+    is garbage collected."""
+    while not stopped.wait(interval):
+        tree = tree_ref()
+        if tree is None:
+            return
+        try:
+            tree.flush()
+        except Exception:
+            logger.exception('buffer_hits: interval flush failed')
+        del tree
 
 
 class MongoTree(object):
@@ -38,8 +88,42 @@ class MongoTree(object):
 
     SEPARATOR = '|$|'
 
+    # Maximum number of ObjectIds sent in a single $in query.
+    IN_BATCH_SIZE = 1000
+
+    # Maximum number of paths buffer_hits remembers to exist; the least
+    # recently upserted ones are forgotten first.
+    KNOWN_PATHS_SIZE = 100000
+
+    # (keys, options) of the indexes that ensure_indexes() provisions.
+    INDEXES = (
+        # Node lookups by path (get_node_by_path, path_exists, upsert, ...)
+        # and path prefix scans within a tree (get_subtree, remove).
+        ([('identifier', pymongo.ASCENDING), ('path', pymongo.ASCENDING)],
+         {'unique': True}),
+        # Root and parent lookups (get_roots).
+        ([('identifier', pymongo.ASCENDING), ('parent', pymongo.ASCENDING)],
+         {}),
+        # The most hit nodes of a tree, ties by path (top_paths).
+        ([('identifier', pymongo.ASCENDING), ('hits', pymongo.DESCENDING),
+          ('path', pymongo.ASCENDING)], {}),
+    )
+
+    # Index for queries on the ancestors stored by materialize_ancestors.
+    ANCESTORS_INDEX = ([('identifier', pymongo.ASCENDING),
+                        ('ancestors', pymongo.ASCENDING)], {})
+
+    # Index of the obj collection used with separate_objs (upsert, remove).
+    OBJS_INDEX = ([('identifier', pymongo.ASCENDING),
+                   ('path', pymongo.ASCENDING)], {})
+
     def __init__(self, host='localhost', port=27017, db_name='mongotree',
-                 uri=None, identifier='mongotree'):
+                 uri=None, identifier='mongotree', buffer_hits=False,
+                 flush_size=1000, flush_interval=None, ensure_indexes=False,
+                 materialize_ancestors=False, cache_size=0, cache_ttl=None,
+                 backend=None, pool_size=100, write_concern=None,
+                 read_preference=None, secondary_reads=False, sketch_size=0,
+                 instrumentation=None, separate_objs=False):
         """Initialization routines.
 
         Arguments:
@@ -48,58 +132,270 @@ class MongoTree(object):
             db_name (string): The database name on the MongoDB instance.
             uri (string): The connection URI for the mongodb instance.
             identifier (string): A member of the key for all reads/writes.
+            buffer_hits (bool): Buffer the hit increments of upserts to
+                existing paths in memory and write them out with flush().
+            flush_size (int): Flush once this many nodes have pending hits.
+            flush_interval (float): Flush every this many seconds, from a
+                background thread that close() stops. Default: never.
+            ensure_indexes (bool): Run ensure_indexes() on construction.
+            materialize_ancestors (bool): Store the ObjectIds of all ancestors
+                (root first) and the depth on new nodes. See
+                migrate_ancestors().
+            cache_size (int): Keep up to this many nodes read by path or
+                ObjectId in an LRU cache. Default: no cache.
+            cache_ttl (float): Seconds a cached node stays valid.
+                Default: until it is written through this instance.
+            backend (MongoBackend | MemoryBackend): Where the nodes are
+                stored. Default: a MongoBackend built from host, port,
+                db_name, uri and the client options below.
+            pool_size (int): The maximum number of pooled connections. Trees
+                using the same URI share one client and pool.
+            write_concern (dict): Write concern options, e.g. {'w': 1}.
+            read_preference (pymongo.ReadPreference): Where reads go.
+            secondary_reads (bool): Let the read-only helpers (counts,
+                traversals, subtrees, dot graphs, ...) read from
+                secondaries. Point lookups used around writes stay on the
+                primary.
+            sketch_size (int): Track the most hit paths of the upserts made
+                through this instance in a HeavyHitters sketch of this many
+                paths, see top_paths(). Default: no sketch.
+            instrumentation (Instrumentation): Count the queries, documents
+                and bytes of every public method and time the collection
+                calls they make. Default: no instrumentation.
+            separate_objs (bool): Store the obj of nodes as documents of
+                the obj collection of the backend, referenced by the obj_id
+                of the node, so reads of the nodes do not transfer it. See
+                get_obj().
         """
-        if uri:
-            # NOTE: pymongo requires you to have the 'optional'
-            # username:password in the URI. Arg!
-            self.mongo = pymongo.Connection().from_url(uri=uri)
-            self.db = self.mongo.db_name
-        else:
-            self.mongo = pymongo.Connection(host=host, port=port)
-            self.db = self.mongo[db_name]
+        if backend is None:
+            backend = MongoBackend(host=host, port=port, db_name=db_name,
+                                   uri=uri, pool_size=pool_size,
+                                   write_concern=write_concern,
+                                   read_preference=read_preference,
+                                   secondary_reads=secondary_reads)
+
+        self.backend = backend
+        self.collection = backend.collection
+        self.read_collection = backend.read_collection
+        self.obj_collection = backend.obj_collection
+        self.mongo = backend.client
+        self.db = backend.db
+
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self.collection = InstrumentedCollection(self.collection,
+                                                     instrumentation)
+            self.read_collection = InstrumentedCollection(
+                self.read_collection, instrumentation)
+            self.obj_collection = InstrumentedCollection(
+                self.obj_collection, instrumentation)
 
         self.identifier = identifier
 
+        self.buffer_hits = buffer_hits
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.materialize_ancestors = materialize_ancestors
+        self.separate_objs = separate_objs
+
+        self.cache = None
+        if cache_size:
+            self.cache = NodeCache(size=cache_size, ttl=cache_ttl)
+
+        self.sketch = None
+        if sketch_size:
+            self.sketch = HeavyHitters(capacity=sketch_size)
+
+        # Write-behind state for buffer_hits: path -> hits not yet written,
+        # and the paths known to already exist in the collection (an LRU of
+        # up to KNOWN_PATHS_SIZE).
+        self._pending_hits = {}
+        self._known_paths = OrderedDict()
+        self._last_flush = time.time()
+        self._buffer_lock = threading.Lock()
+
+        self._flush_stopped = None
+        if buffer_hits:
+            _buffering_trees.add(self)
+            if flush_interval is not None:
+                self._flush_stopped = threading.Event()
+                flusher = threading.Thread(
+                    target=_flush_periodically,
+                    args=(weakref.ref(self), flush_interval,
+                          self._flush_stopped))
+                flusher.daemon = True
+                flusher.start()
+
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the interval flushes of flush_interval and flush the
+        buffered hits."""
+        if self._flush_stopped is not None:
+            self._flush_stopped.set()
+        self.flush()
+
     def __repr__(self):
         s = []
         for root in self.get_roots():
             s.extend(self.traverse(root))
         return pformat(s)
 
-    def get_node_by_objectid(self, object_id):
+    def _join_path(self, path):
+        """Return a path as a string.
+
+        Arguments:
+            path (string | list of tokens): The path that will be on a node.
+
+        Returns:
+            string. The tokens of path joined with SEPARATOR.
+        """
+        if isinstance(path, string_types):
+            return path
+
+        return self.SEPARATOR.join(path)
+
+    def _projection(self, fields, *required):
+        """Build the projection of a query from a fields argument.
+
+        Arguments:
+            fields (sequence): The fields to read (_id is always read).
+                Default: all.
+            required (strings): Fields the method itself needs.
+
+        Returns:
+            dict || None.
+        """
+        if fields is None:
+            return None
+        return dict((field, True) for field in tuple(fields) + required)
+
+    @operation
+    def ensure_indexes(self):
+        """Create the indexes in INDEXES that are missing on the collection
+        (and OBJS_INDEX on the obj collection, with separate_objs).
+
+        Returns:
+            dict. The names of the indexes that were 'created' and of those
+            that were 'existing' already.
+        """
+        report = {'created': [], 'existing': []}
+
+        indexes = self.INDEXES
+        if self.materialize_ancestors:
+            indexes += (self.ANCESTORS_INDEX,)
+
+        collections = [(self.collection, indexes)]
+        if self.separate_objs:
+            collections.append((self.obj_collection, (self.OBJS_INDEX,)))
+
+        for collection, indexes in collections:
+            existing_keys = {}
+            for name, info in collection.index_information().items():
+                existing_keys[tuple(info['key'])] = name
+
+            for keys, options in indexes:
+                name = existing_keys.get(tuple(keys))
+                if name:
+                    report['existing'].append(name)
+                else:
+                    name = collection.create_index(keys, **options)
+                    report['created'].append(name)
+
+        return report
+
+    @operation
+    def get_node_by_objectid(self, object_id, fields=None):
         """Return a node with an id_ of object_id.
         
         Arguments:
             object_id (string | bson.objectid.ObjectId): The key of the id_ 
             lookup. If a string is provided, an ObjectId object will try to be
             derived.
+            fields (sequence): Only read these fields. Default: all, and use
+                the cache.
         
         Returns:
             A dict representing a node || None.
         """
         if not isinstance(object_id, bson.ObjectId):
             object_id = bson.objectid.ObjectId(object_id)
-            
+
         key = {'_id': object_id}
-        
-        return self.db.treefoo.find_one(key) or None
+
+        if fields is not None:
+            return self.collection.find_one(key, self._projection(fields))
+
+        if self.cache is not None:
+            node = self.cache.get_by_objectid(object_id)
+            if node:
+                return node
+
+        node = self.collection.find_one(key) or None
+
+        if node and self.cache is not None:
+            self.cache.put(node)
+
+        return node
     
-    def get_node_by_path(self, path):
+    def session(self, obj=False):
+        """Return a NodeSession, which reads nodes as lazy Node views that
+        load their children, parent and obj on first access and are
+        memoized for the life of the session.
+
+        Arguments:
+            obj (bool): Read obj along with the nodes. Default: only when
+                it is accessed.
+
+        Returns:
+            NodeSession.
+        """
+        return NodeSession(self, obj=obj)
+
+    @operation
+    def get_node_by_path(self, path, pending=False, lazy=False,
+                         fields=None):
         """Return a node at specific path.
 
         Arguments:
             path (string | list of tokens): The path that will be on a node.
+            pending (bool): Include buffered hits that are not flushed yet.
+            lazy (bool): Return a Node of a new session() instead of a
+                dict; pending and the cache do not apply.
+            fields (sequence): Only read these fields. Default: all, and use
+                the cache.
 
         Returns:
             A dict representing a node || None.
         """
-        if hasattr(path, '__iter__'):
-            path = self.SEPARATOR.join(path)
+        if lazy:
+            return self.session().get_node_by_path(path)
+
+        path = self._join_path(path)
             
-        key = {'identifier': self.identifier, 'path': path}
-        
-        return self.db.treefoo.find_one(key) or None
+        node = None
+        if self.cache is not None and fields is None:
+            node = self.cache.get_by_path(self.identifier, path)
+
+        if not node:
+            key = {'identifier': self.identifier, 'path': path}
+            node = self.collection.find_one(key, self._projection(fields))
+            if node and self.cache is not None and fields is None:
+                self.cache.put(node)
 
+        if node and pending and 'hits' in node:
+            node['hits'] += self._pending_hits.get(path, 0)
+
+        return node
+
+    @operation
     def path_exists(self, path):
         """Check if a nodes exists at a specified path.
 
@@ -109,160 +405,846 @@ class MongoTree(object):
         Returns:
             bool.
         """
-        if hasattr(path, '__iter__'):
-            path = self.SEPARATOR.join(path)
-            
+        path = self._join_path(path)
+
+        if self.cache is not None:
+            return self.get_node_by_path(path) is not None
+
         key = {'identifier': self.identifier, 'path': path}
         
-        return bool(self.db.treefoo.find_one(key))
+        return bool(self.collection.find_one(key, {'_id': True}))
 
-    def get_dotgraph(self, roots=None):
+    @operation
+    def get_dotgraph(self, roots=None, max_depth=None, max_nodes=None):
         """Generate a dot graph of the tree at a root via Graphviz.
 
         Arguments:
-            roots (sequence): Roots to start graphing from.
+            roots (sequence): Root nodes to start graphing from.
                 Default: all roots.
-                
+            max_depth (int): Leave out nodes deeper than this below their
+                root. Default: no limit.
+            max_nodes (int): Stop after this many nodes. Default: no limit.
+
         Returns:
             A pydot object representing a tree of nodes.
         """
-        if roots and not getattr(roots, '__iter__', False):
+        graph = pydot.Dot(graph_type='digraph')
+
+        for node, parent in self._iter_graph(roots, max_depth, max_nodes):
+            graph.add_node(pydot.Node(str(node['_id']), label=node['label']))
+            if parent is not None:
+                graph.add_edge(pydot.Edge(str(parent), str(node['_id'])))
+
+        return graph
+
+    @operation
+    def iter_dotgraph(self, roots=None, max_depth=None, max_nodes=None,
+                      workers=None, processes=False, progress=None,
+                      cancel=None):
+        """Yield the graph of get_dotgraph() as lines of DOT text, without
+        building it in memory first, e.g. to write a large tree to a file:
+
+            >>> with open('tree.dot', 'w') as f:
+            ...     f.writelines(mtree.iter_dotgraph())
+
+        Arguments:
+            roots, max_depth, max_nodes: See get_dotgraph().
+            workers (int): Export the subtree of every root on a pool of
+                this many workers (see map_roots()); max_nodes then applies
+                per root. Default: export in this thread.
+            processes, progress, cancel: See map_roots().
+
+        Returns:
+            generator of strings, each ending with a newline.
+        """
+        yield 'digraph G {\n'
+
+        if workers:
+            function = partial(parallel.dot_lines, max_depth=max_depth,
+                               max_nodes=max_nodes)
+            for root, lines in self.map_roots(
+                    function, roots=roots, workers=workers,
+                    processes=processes, progress=progress, cancel=cancel):
+                for line in lines:
+                    yield line
+        else:
+            for line in self._dot_lines(roots, max_depth, max_nodes):
+                yield line
+
+        yield '}\n'
+
+    def _dot_lines(self, roots, max_depth, max_nodes):
+        """Yield the DOT node and edge lines of a graph export."""
+        def quote(s):
+            return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+        for node, parent in self._iter_graph(roots, max_depth, max_nodes):
+            yield '%s [label=%s];\n' % (quote(str(node['_id'])),
+                                        quote(node['label']))
+            if parent is not None:
+                yield '%s -> %s;\n' % (quote(str(parent)),
+                                       quote(str(node['_id'])))
+
+    def _subtrees_key(self, roots, max_depth=None):
+        """Build a query matching some root nodes and their descendants.
+
+        Arguments:
+            roots (sequence): The root nodes. Default: the whole tree.
+            max_depth (int): Only match nodes up to this many levels below
+                the roots.
+
+        Returns:
+            dict. A query for the collection.
+        """
+        if not roots:
+            return {'identifier': self.identifier}
+
+        subtrees = []
+        for root in roots:
+            subtrees.append({'_id': root['_id']})
+            if max_depth is None or max_depth > 0:
+                subtrees.append(self._prefix_key(root['path'],
+                                                 identifier=root['identifier'],
+                                                 max_depth=max_depth))
+
+        return {'$or': subtrees}
+
+    def _iter_graph(self, roots, max_depth, max_nodes):
+        """Yield the nodes of a graph export, each with the _id of the parent
+        it hangs from in the graph (None for roots).
+
+        All selected subtrees are read with one query, sorted by path so
+        parents come before their children. Every node is yielded once.
+        """
+        if roots and (isinstance(roots, string_types) or
+                      not getattr(roots, '__iter__', False)):
             raise ValueError('get_dotgraph: roots argument must be a sequence')
 
-        def add_children_nodes(node):
-            """Give a parent node, create the edges between parent and children.
-            """
-            for child in node['children']:
-                child = self.db.treefoo.find_one({'_id': child})
+        root_ids = set(root['_id'] for root in roots) if roots else None
 
-                parentNode = pydot.Node(str(node['_id']), label=node['label'])
-                graph.add_node(parentNode)
+        key = self._subtrees_key(roots, max_depth)
+        cursor = self.read_collection.find(key, {'label': True,
+                                                 'parent': True})
+        cursor = cursor.sort('path', pymongo.ASCENDING)
+        if max_nodes is not None and max_depth is None:
+            cursor = cursor.limit(max_nodes)
 
-                childNode = pydot.Node(str(child['_id']), label=child['label'])
-                graph.add_node(childNode)
+        # _id -> depth below its root, of every node yielded so far.
+        depths = {}
 
-                edge = pydot.Edge(str(node['_id']), str(child['_id']))
-                graph.add_edge(edge)
+        for node in cursor:
+            if max_nodes is not None and len(depths) >= max_nodes:
+                break
 
-        graph = pydot.Dot(graph_type='digraph')
+            parent = node['parent']
+            if parent in depths:
+                depth = depths[parent] + 1
+            elif (parent is None if root_ids is None
+                  else node['_id'] in root_ids):
+                parent, depth = None, 0
+            else:
+                # Below a node that was cut off by max_depth.
+                continue
+
+            if max_depth is not None and depth > max_depth:
+                continue
 
-        roots = roots or self.get_roots()
-        for node in self.get_roots():
-            self.traverse(node, function=add_children_nodes)
+            depths[node['_id']] = depth
+            yield node, parent
 
-        #graph.write_png('example1_graph.png')
+    def map_roots(self, function, roots=None, workers=4, processes=False,
+                  progress=None, cancel=None):
+        """Run function(tree, root) for many roots at once on a thread or
+        process pool, e.g. to process thousands of independent roots at the
+        throughput of the cluster rather than one after another.
 
-        return graph
+        Arguments:
+            function (callable): Called as function(tree, root). It must be
+                picklable (e.g. a module level function or a partial of one)
+                to run on processes.
+            roots (list): Default: all roots, ordered by path.
+            workers (int): The size of the pool.
+            processes (bool): Use processes, each with its own client,
+                instead of threads sharing the pooled client of this tree.
+                Needs a MongoBackend.
+            progress (callable): Called as progress(done, total) whenever a
+                root is finished.
+            cancel (callable): Checked whenever a root is finished; once it
+                returns True the remaining roots are dropped.
+
+        Returns:
+            list of (root, result) pairs, in the order of roots, whatever
+            order the workers finish in.
+        """
+        if roots is None:
+            roots = sorted(self.iter_roots(), key=lambda root: root['path'])
+
+        return parallel.map_roots(self, function, roots, workers=workers,
+                                  processes=processes, progress=progress,
+                                  cancel=cancel)
+
+    def traverse_roots(self, roots=None, workers=4, processes=False,
+                       progress=None, cancel=None):
+        """Traverse the subtrees of many roots in parallel. See map_roots().
 
-    def traverse(self, node, function=None, nodes=None):
+        Returns:
+            list of (root, nodes) pairs, nodes as returned by traverse().
+        """
+        return self.map_roots(parallel.traverse_root, roots=roots,
+                              workers=workers, processes=processes,
+                              progress=progress, cancel=cancel)
+
+    @operation
+    def traverse(self, node, function=None, nodes=None, fields=None):
         """Traverse the tree, optionally running a function on each node.
 
+        The subtree under node is fetched one level at a time (a single $in
+        query per level) and then walked depth-first, so nodes are visited in
+        the same order as they appear in each node's children.
+
         Arguments:
             node (dict): A dict representing a parent node that will have its
                 children traversed (if there are any).
             function (function): A function to run on a node when it is
                 traversed.
-            nodes (list): Holds all nodes that have been recursively traversed.
+            nodes (list): Holds all nodes that have been traversed.
+            fields (sequence): Only read these fields (and children) of the
+                descendants. Default: all.
 
         Returns:
             list. A list of all nodes that were traversed.
         """
         if nodes is None:
             nodes = []
-        nodes.append(node)
 
-        if function:
-            function(node)
+        for node in self.iter_traverse(node, prefetch=True, fields=fields):
+            nodes.append(node)
 
-        # Recursively traverse each child.
-        for child in node['children']:
-            child = self.db.treefoo.find_one({'_id': child})
-            self.traverse(child, function=function, nodes=nodes)
+            if function:
+                function(node)
 
         return nodes
 
-    def node_count(self, roots=None):
+    @operation
+    def iter_traverse(self, node, order='pre', batch_size=None,
+                      prefetch=False, fields=None):
+        """Yield a node and its descendants.
+
+        Arguments:
+            node (dict): A dict representing the top node of the subtree.
+            order (string): 'pre' to go depth-first (a node, then the subtree
+                of each of its children in order) or 'bfs' to go level by
+                level.
+            batch_size (int): The number of ObjectIds per $in query.
+                Default: IN_BATCH_SIZE.
+            prefetch (bool): For 'pre', load the whole subtree up front with
+                one query per level instead of one query per parent node.
+            fields (sequence): Only read these fields (and children) of the
+                descendants. Default: all.
+
+        Returns:
+            generator of dicts representing nodes.
+        """
+        projection = self._projection(fields, 'children')
+        if order == 'bfs':
+            return self._iter_bfs(node, batch_size, projection)
+        elif order == 'pre':
+            return self._iter_preorder(node, batch_size, prefetch,
+                                       projection)
+
+        raise ValueError('iter_traverse: order must be "pre" or "bfs"')
+
+    def _iter_bfs(self, node, batch_size, projection=None):
+        """Yield a subtree level by level, keeping only one level of ObjectIds
+        in memory.
+        """
+        yield node
+
+        frontier = list(node['children'])
+        while frontier:
+            next_frontier = []
+            for child in self._find_by_objectids(frontier, batch_size,
+                                                 projection=projection):
+                yield child
+                next_frontier.extend(child['children'])
+            frontier = next_frontier
+
+    def _iter_preorder(self, node, batch_size, prefetch, projection=None):
+        """Yield a subtree depth-first. Unless prefetching, only the children
+        of the nodes on the current path are held in memory.
+        """
+        if prefetch:
+            descendants = self._load_subtree(node, projection)
+
+            def children_of(node):
+                return [descendants[child] for child in node['children']
+                        if child in descendants]
+        else:
+            def children_of(node):
+                return list(self._find_by_objectids(
+                    node['children'], batch_size, projection=projection))
+
+        return self._walk_preorder(node, children_of)
+
+    def _walk_preorder(self, node, children_of):
+        """Yield a subtree depth-first without recursion.
+
+        Arguments:
+            node (dict): A dict representing the top node of the subtree.
+            children_of (function): Returns the child nodes of a node.
+
+        Returns:
+            generator of dicts representing nodes.
+        """
+        stack = [iter([node])]
+        while stack:
+            for node in stack[-1]:
+                yield node
+                if node['children']:
+                    stack.append(iter(children_of(node)))
+                break
+            else:
+                stack.pop()
+
+    def _load_subtree(self, node, projection=None):
+        """Fetch all descendants of a node with one query per tree level.
+
+        Arguments:
+            node (dict): A dict representing the top node of the subtree.
+            projection (dict): The fields to read. Default: all.
+
+        Returns:
+            dict. The descendant nodes keyed by their _id.
+        """
+        descendants = {}
+        frontier = list(node['children'])
+
+        while frontier:
+            next_frontier = []
+            for child in self._find_by_objectids(frontier,
+                                                 projection=projection):
+                if child['_id'] in descendants:
+                    continue
+                descendants[child['_id']] = child
+                next_frontier.extend(child['children'])
+            frontier = next_frontier
+
+        return descendants
+
+    def _find_by_objectids(self, object_ids, batch_size=None,
+                           collection=None, projection=None):
+        """Yield the nodes for a list of ObjectIds, batch_size per query.
+
+        Arguments:
+            object_ids (list of bson.objectid.ObjectId): The ids to fetch.
+            batch_size (int): Default: IN_BATCH_SIZE.
+            collection (Collection): Default: read_collection.
+            projection (dict): The fields to read. Default: all.
+
+        Returns:
+            generator of dicts representing nodes, in the order of object_ids
+            (ids that do not exist are skipped).
+        """
+        batch_size = batch_size or self.IN_BATCH_SIZE
+        collection = collection or self.read_collection
+
+        for i in range(0, len(object_ids), batch_size):
+            batch = object_ids[i:i + batch_size]
+            key = {'_id': {'$in': batch}}
+            nodes = dict((node['_id'], node)
+                         for node in collection.find(key, projection))
+            for object_id in batch:
+                if object_id in nodes:
+                    yield nodes[object_id]
+
+    @operation
+    def node_count(self, roots=None, per_root=False):
         """Return how many nodes there are in the tree starting at a root.
 
+        Counting is done by the server, no nodes are transferred.
+
         Arguments:
             roots (sequence): Optional. Instead of all roots, specify nodes to
             start the traversal from.
+            per_root (bool): Break the count down by root.
 
         Returns:
-            int
+            int || dict of root path -> int if per_root.
         """
-        n = 0
-        roots = roots or self.get_roots()
+        if not roots:
+            if per_root:
+                return self._count_per_root()
+            key = {'identifier': self.identifier}
+            return self.read_collection.count_documents(key)
+
+        counts = OrderedDict()
         for root in roots:
-            n += len(self.traverse(root))
+            counts[root['path']] = self.subtree_count(root['path'])
 
-        return n
+        if per_root:
+            return counts
+
+        return sum(counts.values())
 
-    def get_roots(self):
+    @operation
+    def subtree_count(self, path):
+        """Return how many nodes there are in the subtree at a path.
+
+        Arguments:
+            path (string | list of tokens): The path of the subtree's top node.
+
+        Returns:
+            int. 0 if there is no node at path.
+        """
+        path = self._join_path(path)
+
+        # The node itself or anything below it.
+        key = {'$or': [{'identifier': self.identifier, 'path': path},
+                       self._prefix_key(path)]}
+
+        return self.read_collection.count_documents(key)
+
+    def _count_per_root(self):
+        """Count the nodes of every tree with a single aggregation.
+
+        Returns:
+            dict. root path -> int.
+        """
+        # A root's path is the first token of the paths of all its nodes.
+        pipeline = [{'$match': {'identifier': self.identifier}},
+                    {'$project': {'tokens': {'$split': ['$path',
+                                                        self.SEPARATOR]}}},
+                    {'$group': {'_id': {'$arrayElemAt': ['$tokens', 0]},
+                                'count': {'$sum': 1}}}]
+
+        return dict((row['_id'], row['count'])
+                    for row in self.read_collection.aggregate(pipeline))
+
+    @operation
+    def snapshot(self, roots=None):
+        """Load trees into a compact, read-only TreeSnapshot for analytics
+        in memory: traversals, counts, leaves and top hits.
+
+        The nodes are read with one query, without their obj.
+
+        Arguments:
+            roots (sequence): Root nodes of the subtrees to load.
+                Default: the whole tree.
+
+        Returns:
+            TreeSnapshot.
+        """
+        if roots and (isinstance(roots, string_types) or
+                      not getattr(roots, '__iter__', False)):
+            raise ValueError('snapshot: roots argument must be a sequence')
+
+        projection = {'label': 1, 'children': 1, 'hits': 1, 'path': 1}
+        cursor = self.read_collection.find(self._subtrees_key(roots),
+                                           projection)
+
+        return TreeSnapshot(cursor.sort('path', pymongo.ASCENDING),
+                            self.SEPARATOR)
+
+    @operation
+    def get_roots(self, lazy=False, fields=None):
         """Get the root nodes that contain the start of a tree.
 
+        Arguments:
+            lazy (bool): Return Nodes of a new session() instead of dicts.
+            fields (sequence): Only read these fields. Default: all.
+
         Returns:
             A list of nodes with no parents (the "Top" nodes).
         """
+        if lazy:
+            return self.session().get_roots()
+        return list(self.iter_roots(fields=fields))
+
+    @operation
+    def iter_roots(self, batch_size=None, fields=None):
+        """Yield the root nodes that contain the start of a tree.
+
+        Arguments:
+            batch_size (int): The number of nodes per cursor batch.
+                Default: the server's.
+            fields (sequence): Only read these fields. Default: all.
+
+        Returns:
+            generator of nodes with no parents (the "Top" nodes).
+        """
         key = {'identifier': self.identifier, 'parent': None}
-        return [row for row in self.db.treefoo.find(key)]
+        cursor = self.read_collection.find(key, self._projection(fields))
 
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        for row in cursor:
+            yield row
+
+    @operation
     def upsert(self, path, obj=None, hit_inc=1):
         """Add a node to the tree.
 
         Arguments:
             path (string | list of tokens): The path that will be on a node.
-            obj (pickle): A pickled object stored as a blob on a node.
+            obj (pickle): A pickled object stored as a blob on a node (or
+                apart from it, see separate_objs).
+            hit_inc (int): Incremenet the nodes hit counter.
+
+        The nodes along the path are written with one bulk of upserts (see
+        upsert_many()), so a path that already exists costs one round trip
+        and a new one at most three, however deep it is. Concurrent upserts
+        of overlapping paths are safe, given the unique (identifier, path)
+        index of ensure_indexes().
+
+        With buffer_hits enabled, upserting a path that is already known to
+        exist without an obj only buffers the hits (see flush()); the obj of
+        its nodes is left as is.
+        """
+        path = self._join_path(path)
+
+        if self.buffer_hits:
+            if not obj and self._known_path(path):
+                self._buffer_hit(path, hit_inc)
+                return
+            self._remember_path(path)
+
+        self.upsert_many([path], objs=[obj], hit_inc=hit_inc)
+
+    def _known_path(self, path):
+        """Check if a path is known to exist, marking it recently used."""
+        with self._buffer_lock:
+            if path not in self._known_paths:
+                return False
+            self._known_paths[path] = self._known_paths.pop(path)
+            return True
+
+    def _remember_path(self, path):
+        """Remember that a path exists, forgetting the least recently used
+        path beyond KNOWN_PATHS_SIZE."""
+        with self._buffer_lock:
+            self._known_paths.pop(path, None)
+            self._known_paths[path] = True
+            if len(self._known_paths) > self.KNOWN_PATHS_SIZE:
+                self._known_paths.popitem(last=False)
+
+    def _buffer_hit(self, path, hit_inc):
+        """Add hit_inc to the pending hits of every node along a path.
+
+        Arguments:
+            path (string): The path of an existing node.
             hit_inc (int): Incremenet the nodes hit counter.
         """
-        if hasattr(path, '__iter__'):
-            path = self.SEPARATOR.join(path)
-            
         current_path = ''
-        parent_objid = None
+        with self._buffer_lock:
+            for token in path.split(self.SEPARATOR):
+                if current_path:
+                    current_path = self.SEPARATOR.join((current_path, token))
+                else:
+                    current_path = token
+                self._pending_hits[current_path] = \
+                    self._pending_hits.get(current_path, 0) + hit_inc
+                if self.sketch is not None:
+                    self.sketch.add(current_path, hit_inc)
+
+        if len(self._pending_hits) >= self.flush_size:
+            self.flush()
+        elif (self.flush_interval is not None and
+              time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    @operation
+    def flush(self):
+        """Write buffered hits to the db as one bulk of $inc updates.
+
+        If the write fails, the hits that were not written are buffered
+        again before the error is raised. After an error that does not tell
+        which updates were applied (e.g. a lost connection), all of them
+        are, so a later flush may count some twice rather than lose them.
 
-        for token in path.split(self.SEPARATOR):
+        Returns:
+            int. The number of nodes that were updated.
+        """
+        with self._buffer_lock:
+            self._last_flush = time.time()
+            pending_hits, self._pending_hits = self._pending_hits, {}
+
+        if not pending_hits:
+            return 0
+
+        paths = list(pending_hits)
+        requests = []
+        for path in paths:
+            key = {'identifier': self.identifier, 'path': path}
+            requests.append(pymongo.UpdateOne(
+                key, {'$inc': {'hits': pending_hits[path]}}))
+            if self.cache is not None:
+                self.cache.invalidate_path(self.identifier, path)
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception as e:
+            unwritten = paths
+            if isinstance(e, pymongo.errors.BulkWriteError):
+                unwritten = [paths[error['index']]
+                             for error in e.details.get('writeErrors', [])]
+            with self._buffer_lock:
+                for path in unwritten:
+                    self._pending_hits[path] = \
+                        self._pending_hits.get(path, 0) + pending_hits[path]
+            raise
+
+        return len(requests)
+
+    @operation
+    def upsert_many(self, paths, objs=None, hit_inc=1, ordered=True,
+                    hit_incs=None):
+        """Add many nodes to the tree using bulk writes.
+
+        The paths are first merged into an in-memory prefix trie, so a node
+        shared by many paths is written once with its hit increments summed.
+        The resulting hits, children and parent of each node are the same as
+        calling upsert() on every path in turn.
+
+        All nodes are upserted in one bulk with client-picked ObjectIds set
+        on insert. Only if new nodes hang off existing ones are the ids of
+        those looked up and the new nodes linked, in one more query and
+        bulk.
 
-            if current_path:
-                # Concatenate current_path with the incoming token.
-                current_path = self.SEPARATOR.join((current_path, token))
+        Arguments:
+            paths (sequence): The paths (string | list of tokens) to add.
+            objs (sequence): Optional. A pickled object for each path.
+            hit_inc (int): Incremenet the nodes hit counter, once per path.
+            ordered (bool): Whether to use an ordered or unordered bulk write.
+            hit_incs (sequence): Optional. A hit increment for each path,
+                used instead of hit_inc.
+        """
+        # path -> {'label', 'parent' (path), 'hits', 'obj'}, parents first.
+        nodes = OrderedDict()
+
+        for i, path in enumerate(paths):
+            path = self._join_path(path)
+
+            obj = objs[i] if objs else None
+            inc = hit_incs[i] if hit_incs else hit_inc
+            current_path = ''
+            parent_path = None
+
+            for token in path.split(self.SEPARATOR):
+                if current_path:
+                    current_path = self.SEPARATOR.join((current_path, token))
+                else:
+                    current_path = token
+
+                node = nodes.get(current_path)
+                if node is None:
+                    node = {'label': token, 'parent': parent_path, 'hits': 0}
+                    nodes[current_path] = node
+
+                node['hits'] += inc
+
+                # As with upsert(), the last path through a node sets its obj.
+                if obj and current_path == path:
+                    node['obj'] = obj
+                else:
+                    node['obj'] = None
+
+                parent_path = current_path
+
+        if not nodes:
+            return
+
+        if self.cache is not None:
+            for path in nodes:
+                self.cache.invalidate_path(self.identifier, path)
+
+        if self.sketch is not None:
+            for path, node in nodes.items():
+                self.sketch.add(path, node['hits'])
+
+        if self.separate_objs:
+            self._write_objs(nodes)
+
+        # Pick an id for every node and write them all in one bulk: nodes
+        # that exist only get their hits and obj updated, the others are
+        # inserted with the picked ids and can reference their parents
+        # within the same batch.
+        object_ids = dict((path, bson.ObjectId()) for path in nodes)
+
+        requests = []
+        ancestors = {}
+        ancestor_paths = {}
+        for path, node in nodes.items():
+            parent = node['parent']
+            if parent is not None:
+                ancestors[path] = ancestors[parent] + [object_ids[parent]]
+                ancestor_paths[path] = ancestor_paths[parent] + [parent]
+                parent = object_ids[parent]
             else:
-                # Initialize current_path to the incoming token.
-                current_path = token
+                ancestors[path] = []
+                ancestor_paths[path] = []
+
+            key = {'identifier': self.identifier, 'path': path}
+            values = {'$inc': {'hits': node['hits']},
+                      '$set': {'obj': node['obj']},
+                      '$setOnInsert': {'_id': object_ids[path],
+                                       'label': node['label'],
+                                       'parent': parent,
+                                       'children': []}}
+            if self.separate_objs:
+                values['$set'] = {'obj': None, 'obj_id': node['obj_id']}
+            if self.materialize_ancestors:
+                values['$setOnInsert']['ancestors'] = ancestors[path]
+                values['$setOnInsert']['depth'] = len(ancestors[path])
+            requests.append(pymongo.UpdateOne(key, values, upsert=True))
+
+        upserted = self._bulk_upsert(requests, ordered)
+        created = [path for path in nodes if object_ids[path] in upserted]
+        if not created:
+            return
+
+        # Nodes that already existed (or that a concurrent writer created
+        # first) kept their own ids. Find the ones the new nodes reference as
+        # parent (or ancestor) ...
+        referenced = OrderedDict()
+        for path in created:
+            parent = nodes[path]['parent']
+            while parent is not None and object_ids[parent] not in upserted:
+                referenced[parent] = True
+                if not self.materialize_ancestors:
+                    break
+                parent = nodes[parent]['parent']
+
+        referenced = list(referenced)
+        requests = []
+        for i in range(0, len(referenced), self.IN_BATCH_SIZE):
+            key = {'identifier': self.identifier,
+                   'path': {'$in': referenced[i:i + self.IN_BATCH_SIZE]}}
+            for row in self.collection.find(key, {'path': 1}):
+                picked_id = object_ids[row['path']]
+                object_ids[row['path']] = row['_id']
+
+                # ... and repoint the new nodes to their real ids.
+                requests.append(pymongo.UpdateMany(
+                    {'identifier': self.identifier, 'parent': picked_id},
+                    {'$set': {'parent': row['_id']}}))
+
+        if self.materialize_ancestors and referenced:
+            for path in created:
+                real = [object_ids[p] for p in ancestor_paths[path]]
+                if real != ancestors[path]:
+                    requests.append(pymongo.UpdateOne(
+                        {'_id': object_ids[path]},
+                        {'$set': {'ancestors': real}}))
+
+        # Link the new nodes to their parents, keeping insertion order.
+        children = OrderedDict()
+        for path in created:
+            parent = nodes[path]['parent']
+            if parent is not None:
+                children.setdefault(object_ids[parent], []).append(
+                    object_ids[path])
+
+        for parent, child_ids in children.items():
+            requests.append(pymongo.UpdateOne(
+                {'_id': parent},
+                {'$addToSet': {'children': {'$each': child_ids}}}))
+
+        if requests:
+            self.collection.bulk_write(requests, ordered=ordered)
+
+    def _write_objs(self, nodes):
+        """Replace the objs of upserted nodes in the obj collection (see
+        separate_objs) with one bulk write, setting the obj_id of each node
+        to its new obj document, or None.
 
-            # Try to find the row for this node.
-            key = {'identifier': self.identifier, 'path': current_path}
+        Arguments:
+            nodes (OrderedDict): path -> node, as built by upsert_many().
+        """
+        paths = list(nodes)
+        requests = []
+        for i in range(0, len(paths), self.IN_BATCH_SIZE):
+            requests.append(pymongo.DeleteMany(
+                {'identifier': self.identifier,
+                 'path': {'$in': paths[i:i + self.IN_BATCH_SIZE]}}))
+
+        for path, node in nodes.items():
+            node['obj_id'] = None
+            if node['obj']:
+                node['obj_id'] = bson.ObjectId()
+                requests.append(pymongo.InsertOne(
+                    {'_id': node['obj_id'], 'identifier': self.identifier,
+                     'path': path, 'obj': node['obj']}))
+
+        self.obj_collection.bulk_write(requests)
+
+    @operation
+    def get_obj(self, node):
+        """Get the obj of a node, wherever it is stored (see separate_objs).
+
+        Arguments:
+            node (node | string | list of tokens): The node, or path of the
+                node. A node read without its obj and obj_id fields is read
+                again.
 
-            # Values we want to store on the created/updated node.
-            values = {}
+        Returns:
+            The obj of the node || None.
+        """
+        if not isinstance(node, dict):
+            key = {'identifier': self.identifier,
+                   'path': self._join_path(node)}
+            node = self.read_collection.find_one(key, {'obj': True,
+                                                       'obj_id': True})
+        elif 'obj' not in node and 'obj_id' not in node:
+            node = self.read_collection.find_one({'_id': node['_id']},
+                                                 {'obj': True,
+                                                  'obj_id': True})
 
-            # Increment the hit counter.
-            # TODO - needs to not be here. If this is desired, it needs to
-            # be passed in generically.
-            values.setdefault('$inc', {})['hits'] = hit_inc
+        if not node:
+            return None
 
-            # Create a new row for the node if it doesn't exist.
-            if not self.db.treefoo.find_one(key):
-                values.setdefault('$set', {})['label'] = token
-                values['$set']['parent'] = parent_objid
-                values['$set']['children'] = []
+        if node.get('obj_id') is not None:
+            row = self.obj_collection.find_one({'_id': node['obj_id']},
+                                               {'obj': True})
+            return row['obj'] if row else None
 
-            # Blob data associated with the node.
-            if obj and current_path == path:
-                values.setdefault('$set', {})['obj'] = obj
-            else:
-                values.setdefault('$set', {})['obj'] = None
+        return node.get('obj')
 
-            # Write to the db/collection.
-            self.db.treefoo.update(key, values, upsert=True)
+    def _bulk_upsert(self, requests, ordered=True):
+        """Run a bulk of upserts, retrying the ones that failed because a
+        concurrent writer inserted the same node first.
 
-            # Update the parent node to include this node as a child.
-            if current_path:
-                obj_id = self.db.treefoo.find_one(key, {'_id': 1})['_id']
-                key = {'_id': parent_objid}
-                values = {'$addToSet': {'children': obj_id}}
-                self.db.treefoo.update(key, values, upsert=True)
-                parent_objid = obj_id
+        Arguments:
+            requests (list of pymongo.UpdateOne): Upserts keyed on
+                (identifier, path).
+            ordered (bool): Whether to use an ordered or unordered bulk write.
+
+        Returns:
+            set. The _ids of the documents that were inserted.
+        """
+        upserted = set()
+
+        while requests:
+            try:
+                result = self.collection.bulk_write(requests, ordered=ordered)
+            except pymongo.errors.BulkWriteError as e:
+                errors = e.details['writeErrors']
+                if any(error['code'] != 11000 for error in errors):
+                    raise
+                upserted.update(row['_id'] for row in e.details['upserted'])
+
+                # The retried upserts will match the winner's documents.
+                failed = [error['index'] for error in errors]
+                if ordered:
+                    requests = requests[failed[0]:]
+                else:
+                    requests = [requests[i] for i in failed]
+                continue
+
+            upserted.update(result.upserted_ids.values())
+            break
+
+        return upserted
 
     def valid_node(self, node):
         """Indicate if a node is "valid", where valid indicates that it has all
@@ -274,9 +1256,13 @@ class MongoTree(object):
         Returns:
             bool
         """
-        node_keys = node.keys()
         valid_keys = ('label', 'path', 'parent', 'children', 'hits', 'obj',
                       'identifier', '_id')
+        # Keys only present on some nodes (see materialize_ancestors and
+        # separate_objs).
+        optional_keys = ('ancestors', 'depth', 'obj_id')
+
+        node_keys = [key for key in node.keys() if key not in optional_keys]
 
         if len(node_keys) != len(valid_keys):
             return False
@@ -287,102 +1273,768 @@ class MongoTree(object):
 
         return True
 
+    @operation
     def remove(self, node):
         """Remove a node from the tree. If it has children, remove those, too.
 
+        The whole subtree is deleted and the node is pulled from its parent's
+        children in a single bulk write.
+
         Arguments:
             node (dict):  A dict representing a node.
+
+        Returns:
+            int. The number of nodes that were removed.
         """
         if not self.valid_node(node):
             raise ValueError('MongoTree::remove:> node used for the node '
                              'argument is not valid.')
 
-        for child in node['children']:
-            child = self.db.treefoo.find_one({'_id': child})
-            if not child:
-                continue
-            self.remove(child)
+        # Removed paths have to go through a full upsert() again.
+        with self._buffer_lock:
+            self._known_paths.clear()
+
+        if self.cache is not None:
+            self.cache.invalidate_path(node['identifier'], node['path'])
+            self.cache.invalidate_prefix(node['identifier'],
+                                         node['path'] + self.SEPARATOR)
+            self.cache.invalidate_objectid(node['parent'])
+
+        key = {'$or': [{'_id': node['_id']},
+                       self._prefix_key(node['path'],
+                                        identifier=node['identifier'])]}
+        requests = [pymongo.DeleteMany(key)]
+
+        if node['parent'] is not None:
+            requests.append(pymongo.UpdateOne(
+                {'_id': node['parent']},
+                {'$pull': {'children': node['_id']}}))
 
-        self.db.treefoo.remove({'_id': node['_id']})
+        deleted = self.collection.bulk_write(requests).deleted_count
 
-    def get_parent(self, path):
+        if self.separate_objs:
+            self.obj_collection.delete_many({'$or': [
+                {'identifier': node['identifier'], 'path': node['path']},
+                self._prefix_key(node['path'],
+                                 identifier=node['identifier'])]})
+
+        return deleted
+
+    def _prefix_key(self, path, identifier=None, max_depth=None):
+        """Build a query matching every node below a path.
+
+        The path prefix is matched as the range [path + SEPARATOR,
+        path + SEPARATOR with its last character incremented), which the
+        (identifier, path) index answers with a bounded scan, and needs no
+        escaping of the tokens.
+
+        Arguments:
+            path (string | list of tokens): The path of the top node.
+            identifier (string): Default: the identifier of this tree.
+            max_depth (int): Only match nodes up to this many (at least 1)
+                levels below path. Default: no limit.
+
+        Returns:
+            dict. A query for the collection.
+        """
+        prefix = self._join_path(path) + self.SEPARATOR
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        key = {'identifier': identifier or self.identifier,
+               'path': {'$gte': prefix, '$lt': upper}}
+
+        if max_depth is not None:
+            # Within the range, allow at most max_depth - 1 more separators.
+            sep = re.escape(self.SEPARATOR)
+            token = r'(?:(?!%s)[\s\S])*' % sep
+            key['path']['$regex'] = '^%s%s(?:%s%s){0,%d}$' % (
+                re.escape(prefix), token, sep, token, max_depth - 1)
+
+        return key
+
+    @operation
+    def get_parent(self, path, fields=None):
         """Get the parent of a node.
 
         Arguments:
              path (string | list of tokens): The path that will be on a node.
+             fields (sequence): Only read these fields. Default: all.
 
         Returns:
             A dict representing a node || None.
         """
-        if hasattr(path, '__iter__'):
-            path = self.SEPARATOR.join(path)
+        path = self._join_path(path)
             
         key = {'identifier': self.identifier, 'path': path}
-        result = self.db.treefoo.find_one(key)
+        result = self.read_collection.find_one(key, {'parent': True})
 
         if result:
             parent = result['parent']
-            node = self.db.treefoo.find_one({'_id': parent})
+            node = self.read_collection.find_one({'_id': parent},
+                                                 self._projection(fields))
             return node
 
         return None
 
-    def get_children(self, path):
+    @operation
+    def get_ancestors(self, path, fields=None):
+        """Get all ancestors of a node with a single query.
+
+        Arguments:
+             path (string | list of tokens): The path that will be on a node.
+             fields (sequence): Only read these fields (and path).
+                Default: all.
+
+        Returns:
+            list. The ancestors of the node, starting with its root.
+        """
+        path = self._join_path(path).split(self.SEPARATOR)
+
+        prefixes = [self.SEPARATOR.join(path[:i]) for i in range(1, len(path))]
+        if not prefixes:
+            return []
+
+        key = {'identifier': self.identifier, 'path': {'$in': prefixes}}
+        projection = self._projection(fields, 'path')
+        ancestors = dict((node['path'], node)
+                         for node in self.read_collection.find(key,
+                                                               projection))
+
+        return [ancestors[prefix] for prefix in prefixes if prefix in ancestors]
+
+    @operation
+    def get_depth(self, path):
+        """Get the depth of a node, where roots have a depth of 0.
+
+        Arguments:
+             path (string | list of tokens): The path that will be on a node.
+
+        Returns:
+            int || None if there is no node at path.
+        """
+        path = self._join_path(path)
+
+        key = {'identifier': self.identifier, 'path': path}
+        node = self.read_collection.find_one(key, {'depth': 1})
+
+        if not node:
+            return None
+
+        if 'depth' in node:
+            return node['depth']
+
+        return path.count(self.SEPARATOR)
+
+    @operation
+    def get_subtree(self, node, fields=None):
+        """Get a node and all of its descendants with a single query.
+
+        Arguments:
+            node (dict):  A dict representing a node.
+            fields (sequence): Only read these fields of the descendants.
+                Default: all.
+
+        Returns:
+            list. The node followed by its descendants.
+        """
+        key = self._prefix_key(node['path'], identifier=node['identifier'])
+        cursor = self.read_collection.find(key, self._projection(fields))
+
+        return [node] + [row for row in cursor]
+
+    @operation
+    def get_descendants(self, path, max_depth=None, fields=None):
+        """Get the nodes below a path, parents before their children.
+
+        Arguments:
+            path (string | list of tokens): The path of the top node.
+            max_depth (int): Only get nodes up to this many levels below
+                path, e.g. 1 for the children. Default: no limit.
+            fields (sequence): Only read these fields. Default: all.
+
+        Returns:
+            list of nodes, sorted by path.
+        """
+        if max_depth is not None and max_depth < 1:
+            return []
+
+        key = self._prefix_key(path, max_depth=max_depth)
+        cursor = self.read_collection.find(key, self._projection(fields))
+        cursor = cursor.sort('path', pymongo.ASCENDING)
+
+        return list(cursor)
+
+    @operation
+    def count_descendants(self, path, max_depth=None):
+        """Count the nodes below a path on the server.
+
+        Arguments:
+            path (string | list of tokens): The path of the top node.
+            max_depth (int): Only count nodes up to this many levels below
+                path. Default: no limit.
+
+        Returns:
+            int.
+        """
+        if max_depth is not None and max_depth < 1:
+            return 0
+
+        key = self._prefix_key(path, max_depth=max_depth)
+
+        return self.read_collection.count_documents(key)
+
+    @operation
+    def migrate_ancestors(self):
+        """Set the ancestors and depth of every node in the tree, e.g. on a
+        collection that was built before materialize_ancestors was used.
+
+        Returns:
+            int. The number of nodes that were updated.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+
+        # Reads stay on the primary, since their results are written back.
+        n = 0
+        ancestors = {}
+        level = list(self.collection.find({'identifier': self.identifier,
+                                           'parent': None}))
+
+        for root in level:
+            ancestors[root['_id']] = []
+
+        while level:
+            requests = []
+            child_ids = []
+
+            for node in level:
+                values = {'ancestors': ancestors[node['_id']],
+                          'depth': len(ancestors[node['_id']])}
+                requests.append(pymongo.UpdateOne({'_id': node['_id']},
+                                                  {'$set': values}))
+
+                for child in node['children']:
+                    ancestors[child] = ancestors[node['_id']] + [node['_id']]
+                    child_ids.append(child)
+
+                # Ancestors are only needed one level down.
+                del ancestors[node['_id']]
+
+            self.collection.bulk_write(requests, ordered=False)
+            n += len(requests)
+
+            level = list(self._find_by_objectids(child_ids,
+                                                 collection=self.collection))
+
+        return n
+
+    @operation
+    def get_children(self, path, skip=0, limit=None, fields=None):
         """Get all children of a node.
 
+        The children are fetched with one $in query per IN_BATCH_SIZE of
+        them, and returned in the order of the node's children.
+
         Arguments:
              path (string | list of tokens): The path that will be on a node.
+             skip (int): The number of children to skip.
+             limit (int): The maximum number of children to return.
+                Default: all of them.
+             fields (sequence): Only read these fields of the children.
+                Default: all, and use the cache.
 
         Returns:
             list. All children of the node with path=parent_path.
         """
-        if hasattr(path, '__iter__'):
-            path = self.SEPARATOR.join(path)
+        path = self._join_path(path)
 
-        node = self.get_node_by_path(path)
-        
-        if not node:
+        if limit is not None and limit <= 0:
+            # The server rejects a $slice of no elements.
             return []
-        
-        return [self.get_node_by_objectid(child) for child in node['children']]
+
+        if limit is None:
+            # Only the children of an uncached node are needed.
+            parent_fields = None if self.cache is not None else ['children']
+            node = self.get_node_by_path(path, fields=parent_fields)
+            child_ids = node['children'][skip:] if node else []
+        else:
+            # Only transfer the requested page of a (wide) children array,
+            # and none of the other fields.
+            key = {'identifier': self.identifier, 'path': path}
+            node = self.read_collection.find_one(
+                key, {'_id': 1, 'children': {'$slice': [skip, limit]}})
+            child_ids = node['children'] if node else []
+
+        children = {}
+        missing = child_ids
+        use_cache = self.cache is not None and fields is None
+
+        if use_cache:
+            missing = []
+            for child_id in child_ids:
+                child = self.cache.get_by_objectid(child_id)
+                if child:
+                    children[child_id] = child
+                else:
+                    missing.append(child_id)
+
+        for child in self._find_by_objectids(
+                missing, projection=self._projection(fields)):
+            children[child['_id']] = child
+            if use_cache:
+                self.cache.put(child)
+
+        return [children[child_id] for child_id in child_ids
+                if child_id in children]
     
-    def get_leaf_nodes(self, root):
+    @operation
+    def top_paths(self, k, under=None, leaves_only=False, sketch=False):
+        """Get the most hit nodes.
+
+        Served by the (identifier, hits, path) index of ensure_indexes(),
+        which is read in hits order until k nodes match.
+
+        Arguments:
+            k (int): How many nodes to get.
+            under (string | list of tokens): Only consider the nodes below
+                this path. Default: the whole tree.
+            leaves_only (bool): Only consider leaves.
+            sketch (bool): Answer from the in-process sketch (see
+                sketch_size) without querying the db. Its hits only count
+                the upserts made through this instance, and may be
+                overestimated for rarely hit paths.
+
+        Returns:
+            list of (path, hits) pairs, most hits first.
+        """
+        if k <= 0:
+            return []
+
+        if sketch:
+            if self.sketch is None:
+                raise ValueError('top_paths: no sketch, set sketch_size')
+            if leaves_only:
+                raise ValueError('top_paths: the sketch does not know '
+                                 'which nodes are leaves')
+
+            prefix = None
+            if under is not None:
+                prefix = self._join_path(under) + self.SEPARATOR
+
+            rows = self.sketch.top(k, filter=lambda path: prefix is None or
+                                   path.startswith(prefix))
+            return [(path, hits) for path, hits, error in rows]
+
+        if under is not None:
+            key = self._prefix_key(under)
+        else:
+            key = {'identifier': self.identifier}
+
+        if leaves_only:
+            key['children'] = []
+
+        cursor = self.read_collection.find(key, {'path': 1, 'hits': 1})
+        cursor = cursor.sort([('hits', pymongo.DESCENDING),
+                              ('path', pymongo.ASCENDING)]).limit(k)
+
+        return [(node['path'], node['hits']) for node in cursor]
+
+    @operation
+    def get_leaf_nodes(self, root, fields=None):
         """Get all leaf nodes.
-        
+
         Arguments:
-            root (node): The root node to start finding leaves from.
-            leaves (list): A collection of leaf nodes that the recursive 
-                function uses to keep track of nodes.
-            
+            root (node | string | list of tokens): The node, or path of the
+                node, to start finding leaves from.
+            fields (sequence): Only read these fields. Default: all.
+
         Returns:
             list of leaf nodes.
-        """        
-        results = self.db.treefoo.find({'path':
-                                {'$regex': '^%s%s' % (root, self.SEPARATOR)},
-                              'children': []})
-        
-        return [row for row in results]
+        """
+        return list(self.iter_leaves(root, fields=fields))
 
-    def fromXml(self, xml):
-        """Build a tree from an XML string.
+    @operation
+    def iter_leaves(self, root, batch_size=None, fields=None):
+        """Yield all leaf nodes.
 
         Arguments:
-            xml (string): A string of valid XML.
+            root (node | string | list of tokens): The node, or path of the
+                node, to start finding leaves from.
+            batch_size (int): The number of nodes per cursor batch.
+                Default: the server's.
+            fields (sequence): Only read these fields. Default: all.
+
+        Returns:
+            generator of leaf nodes below root.
         """
-        root = etree.fromstring(xml)
+        if isinstance(root, dict):
+            key = self._prefix_key(root['path'],
+                                   identifier=root['identifier'])
+        else:
+            key = self._prefix_key(root)
+        key['children'] = []
 
-        def add_nodes(root, path=None):
-            """Get all parent/children node combinations and add to the
-            tree collection.
-            """
-            if path is None:
-                path = []
+        cursor = self.read_collection.find(key, self._projection(fields))
 
-            nodes = path + [root,]
-            self.upsert([node.tag for node in nodes])
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
 
-            for child in root.getchildren():
-                add_nodes(child, path=nodes)
+        for row in cursor:
+            yield row
 
-        add_nodes(root)
+    @operation
+    def fromXml(self, xml, batch_size=1000, progress=None):
+        """Build a tree from XML, one path per element (its tag and the tags
+        of its ancestors).
 
+        The document is streamed with iterparse: only the stack of open
+        elements is kept, processed elements are cleared, and repeated paths
+        are merged into batches written with upsert_many(). Memory use
+        depends on the depth of the document, not its size.
+
+        Arguments:
+            xml (string | file): A string of valid XML, or the file name or
+                file object of an XML document.
+            batch_size (int): Write once this many distinct paths are seen.
+            progress (callable): Called with the stats (see Returns) after
+                every batch.
+
+        Returns:
+            dict. {'elements': elements read, 'paths': paths written (a path
+            repeated across batches counts once per batch), 'seconds': time
+            taken, 'elements_per_second': throughput}.
+        """
+        if isinstance(xml, (bytes, string_types)):
+            if not isinstance(xml, bytes):
+                xml = xml.encode('utf-8')
+            if xml.lstrip().startswith(b'<'):
+                xml = BytesIO(xml)
+            else:
+                xml = xml.decode('utf-8')
+
+        stats = {'elements': 0, 'paths': 0, 'seconds': 0.0,
+                 'elements_per_second': 0.0}
+        started = time.time()
+
+        # path -> hits, in document order so parents come first.
+        batch = OrderedDict()
+        stack = []
+
+        def update_stats():
+            stats['seconds'] = time.time() - started
+            if stats['seconds']:
+                stats['elements_per_second'] = (stats['elements'] /
+                                                stats['seconds'])
+
+        def write_batch():
+            self.upsert_many(list(batch), hit_incs=list(batch.values()))
+            stats['paths'] += len(batch)
+            batch.clear()
+            update_stats()
+            if progress:
+                progress(dict(stats))
+
+        for event, element in etree.iterparse(xml, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element.tag)
+                path = self.SEPARATOR.join(stack)
+                batch[path] = batch.get(path, 0) + 1
+                stats['elements'] += 1
+                continue
+
+            stack.pop()
+
+            # Drop the element and the siblings before it, which were all
+            # processed already.
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+            if len(batch) >= batch_size:
+                write_batch()
+
+        if batch:
+            write_batch()
+
+        update_stats()
+        return stats
+
+    def _iter_sorted(self, path=None, batch_size=None):
+        """Yield the nodes of the tree, or of the subtree at path, sorted by
+        path, with the fields iter_diff() compares and their obj resolved.
+
+        The nodes are read with one cursor over the (identifier, path)
+        index; with separate_objs, the objs of every batch_size nodes are
+        read with one more query.
+        """
+        batch_size = batch_size or self.IN_BATCH_SIZE
+
+        key = {'identifier': self.identifier}
+        if path is not None:
+            key = {'$or': [{'identifier': self.identifier,
+                            'path': self._join_path(path)},
+                           self._prefix_key(path)]}
+
+        projection = {'path': True, 'label': True, 'parent': True,
+                      'hits': True, 'obj': True, 'obj_id': True}
+        cursor = self.read_collection.find(key, projection)
+        cursor = cursor.sort('path', pymongo.ASCENDING).batch_size(batch_size)
+
+        if not self.separate_objs:
+            for node in cursor:
+                yield node
+            return
+
+        batch = []
+        for node in cursor:
+            batch.append(node)
+            if len(batch) >= batch_size:
+                for node in self._resolve_objs(batch):
+                    yield node
+                batch = []
+
+        for node in self._resolve_objs(batch):
+            yield node
+
+    def _resolve_objs(self, nodes):
+        """Replace the obj of nodes with an obj_id by the obj it refers to.
+
+        Returns:
+            list. The nodes.
+        """
+        obj_ids = [node['obj_id'] for node in nodes
+                   if node.get('obj_id') is not None]
+        if obj_ids:
+            objs = dict((row['_id'], row['obj']) for row in
+                        self.obj_collection.find({'_id': {'$in': obj_ids}}))
+            for node in nodes:
+                if node.get('obj_id') is not None:
+                    node['obj'] = objs.get(node['obj_id'])
+        return nodes
+
+    @operation
+    def iter_diff(self, other, path=None, batch_size=None):
+        """Yield what differs between this tree and another one, which may
+        have another identifier or live in another collection or database.
+
+        Both trees are read with cursors sorted by path and merged as they
+        stream, so only a batch of nodes per tree is held in memory. Buffered
+        hits (see buffer_hits) that are not flushed yet are not compared.
+
+        Arguments:
+            other (MongoTree): The tree to compare against.
+            path (string | list of tokens): Only compare the node at path
+                and its descendants. Default: the whole trees.
+            batch_size (int): The number of nodes per cursor batch.
+                Default: IN_BATCH_SIZE.
+
+        Returns:
+            generator of (change, node, other_node) tuples in path order,
+            where change is 'added' (the node is missing from other, and
+            other_node is None), 'removed' (other_node is missing from this
+            tree, and node is None) or 'changed' (their hits or obj differ).
+        """
+        mine = self._iter_sorted(path, batch_size)
+        theirs = other._iter_sorted(path, batch_size)
+
+        node = next(mine, None)
+        other_node = next(theirs, None)
+
+        while node is not None or other_node is not None:
+            if other_node is None or (node is not None and
+                                      node['path'] < other_node['path']):
+                yield 'added', node, None
+                node = next(mine, None)
+            elif node is None or other_node['path'] < node['path']:
+                yield 'removed', None, other_node
+                other_node = next(theirs, None)
+            else:
+                if (node['hits'] != other_node['hits'] or
+                        node.get('obj') != other_node.get('obj')):
+                    yield 'changed', node, other_node
+                node = next(mine, None)
+                other_node = next(theirs, None)
+
+    @operation
+    def diff(self, other, path=None, batch_size=None):
+        """Compare this tree with another one. See iter_diff().
+
+        Returns:
+            dict. The paths that are 'added', 'removed' and 'changed' in this
+            tree relative to other.
+        """
+        result = {'added': [], 'removed': [], 'changed': []}
+
+        for change, node, other_node in self.iter_diff(other, path,
+                                                       batch_size):
+            result[change].append((node or other_node)['path'])
+
+        return result
+
+    @operation
+    def sync_to(self, other, path=None, batch_size=None):
+        """Make another tree equal to this one, writing only what differs
+        (see iter_diff()) with one bulk write per batch_size changes.
+
+        Nodes added to other hang from the same paths as here; children
+        appended to a node of other that already exists are appended after
+        its own children.
+
+        Arguments:
+            other (MongoTree): The tree to write to.
+            path (string | list of tokens): Only sync the node at path and
+                its descendants. The parent of path must exist in other.
+                Default: the whole trees.
+            batch_size (int): The number of nodes per cursor batch and
+                changes per bulk write. Default: IN_BATCH_SIZE.
+
+        Returns:
+            dict. The number of nodes 'added', 'removed' and 'changed' in
+            other.
+        """
+        batch_size = batch_size or self.IN_BATCH_SIZE
+        counts = {'added': 0, 'removed': 0, 'changed': 0}
+
+        changes = []
+        for change in self.iter_diff(other, path, batch_size):
+            changes.append(change)
+            counts[change[0]] += 1
+            if len(changes) >= batch_size:
+                other._apply_changes(changes)
+                changes = []
+
+        if changes:
+            other._apply_changes(changes)
+
+        return counts
+
+    def _apply_changes(self, changes):
+        """Write a batch of iter_diff() changes to this tree with one bulk
+        write (and, with separate_objs, one more for the objs).
+
+        The changes are in path order, so the parent of an added node was
+        either added before it or already exists here.
+
+        Arguments:
+            changes (list): (change, node, other_node) tuples, where node
+                comes from the source tree and other_node from this one.
+        """
+        added = OrderedDict()
+        removed = OrderedDict()
+        changed = []
+
+        for change, source, node in changes:
+            if change == 'added':
+                added[source['path']] = {
+                    '_id': bson.ObjectId(), 'identifier': self.identifier,
+                    'label': source['label'], 'path': source['path'],
+                    'parent': None, 'children': [], 'hits': source['hits'],
+                    'obj': source.get('obj')}
+            elif change == 'removed':
+                removed[node['_id']] = node
+            else:
+                changed.append((source, node))
+
+        def parent_path(path):
+            if self.SEPARATOR not in path:
+                return None
+            return path.rsplit(self.SEPARATOR, 1)[0]
+
+        # The parents of added nodes that exist here already.
+        lookup = list(set(parent_path(path) for path in added) -
+                      set(added) - set([None]))
+        parents = {}
+        for i in range(0, len(lookup), self.IN_BATCH_SIZE):
+            key = {'identifier': self.identifier,
+                   'path': {'$in': lookup[i:i + self.IN_BATCH_SIZE]}}
+            for row in self.collection.find(key, {'path': True,
+                                                  'ancestors': True}):
+                parents[row['path']] = row
+
+        # Link the added nodes to their parents: those added in this batch
+        # on insert, the others with $addToSet.
+        links = OrderedDict()
+        for path, doc in added.items():
+            parent_at = parent_path(path)
+            ancestors = []
+            if parent_at is not None:
+                if parent_at in added:
+                    parent = added[parent_at]
+                    parent['children'].append(doc['_id'])
+                elif parent_at in parents:
+                    parent = parents[parent_at]
+                    links.setdefault(parent['_id'], []).append(doc['_id'])
+                else:
+                    raise ValueError('sync_to: the parent of %s is missing '
+                                     'from the target tree' % path)
+                doc['parent'] = parent['_id']
+                ancestors = parent.get('ancestors')
+                if ancestors is not None:
+                    ancestors = ancestors + [parent['_id']]
+
+            if self.materialize_ancestors and ancestors is not None:
+                doc['ancestors'] = ancestors
+                doc['depth'] = len(ancestors)
+
+        objs = {}
+        if self.separate_objs:
+            nodes = OrderedDict()
+            for path, doc in added.items():
+                nodes[path] = {'obj': doc['obj']}
+            for source, node in changed:
+                nodes[node['path']] = {'obj': source.get('obj')}
+            for node in removed.values():
+                nodes[node['path']] = {'obj': None}
+            if nodes:
+                self._write_objs(nodes)
+            objs = dict((path, node['obj_id'])
+                        for path, node in nodes.items())
+            for path, doc in added.items():
+                doc['obj'] = None
+                doc['obj_id'] = objs[path]
+
+        requests = [pymongo.InsertOne(doc) for doc in added.values()]
+
+        for parent, child_ids in links.items():
+            requests.append(pymongo.UpdateOne(
+                {'_id': parent},
+                {'$addToSet': {'children': {'$each': child_ids}}}))
+
+        for source, node in changed:
+            values = {'hits': source['hits'], 'obj': source.get('obj')}
+            if self.separate_objs:
+                values = {'hits': source['hits'], 'obj': None,
+                          'obj_id': objs[node['path']]}
+            requests.append(pymongo.UpdateOne({'_id': node['_id']},
+                                              {'$set': values}))
+
+        removed_ids = list(removed)
+        for i in range(0, len(removed_ids), self.IN_BATCH_SIZE):
+            requests.append(pymongo.DeleteMany(
+                {'_id': {'$in': removed_ids[i:i + self.IN_BATCH_SIZE]}}))
+
+        pulls = OrderedDict()
+        for node in removed.values():
+            if node['parent'] is not None and node['parent'] not in removed:
+                pulls.setdefault(node['parent'], []).append(node['_id'])
+        for parent, child_ids in pulls.items():
+            requests.append(pymongo.UpdateOne(
+                {'_id': parent}, {'$pull': {'children': {'$in': child_ids}}}))
+
+        if removed:
+            with self._buffer_lock:
+                self._known_paths.clear()
+
+        if self.cache is not None:
+            paths = list(added)
+            paths.extend(node['path'] for source, node in changed)
+            paths.extend(node['path'] for node in removed.values())
+            for path in paths:
+                self.cache.invalidate_path(self.identifier, path)
+            for parent in list(links) + list(pulls):
+                self.cache.invalidate_objectid(parent)
+
+        if requests:
+            self.collection.bulk_write(requests)
@@ -0,0 +1,257 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from .instrument import operation
+
+# Marks a relation that is not loaded yet (None is a loaded "no parent").
+_UNSET = object()
+
+
+class Node(object):
+    """A lazy, read-only view of a node document.
+
+    The children, parent and (unless the session was built with obj=True)
+    obj are loaded on first access, through the NodeSession the node
+    belongs to. Other fields are read with node['field'] or the properties.
+    """
+
+    __slots__ = ('_session', '_doc', '_batch', '_children', '_parent',
+                 '_obj')
+
+    def __init__(self, session, doc):
+        self._session = session
+        self._doc = doc
+        # The nodes loaded by the same query, whose relations are loaded
+        # along with this node's.
+        self._batch = None
+        self._children = _UNSET
+        self._parent = _UNSET
+        self._obj = _UNSET
+        if session.with_obj and doc.get('obj_id') is None:
+            self._obj = doc.get('obj')
+
+    def __repr__(self):
+        return 'Node(%r)' % (self._doc['path'],)
+
+    def __getitem__(self, key):
+        if key == 'obj':
+            return self.obj
+        return self._doc[key]
+
+    @property
+    def id(self):
+        """The ObjectId of the node."""
+        return self._doc['_id']
+
+    @property
+    def label(self):
+        return self._doc['label']
+
+    @property
+    def path(self):
+        return self._doc['path']
+
+    @property
+    def hits(self):
+        return self._doc['hits']
+
+    @property
+    def is_leaf(self):
+        """True if the node has no children (without loading them)."""
+        return not self._doc['children']
+
+    @property
+    def children(self):
+        """The child Nodes, in order."""
+        if self._children is _UNSET:
+            self._session.load_children(self)
+        return self._children
+
+    @property
+    def parent(self):
+        """The parent Node || None for a root."""
+        if self._parent is _UNSET:
+            self._session.load_parent(self)
+        return self._parent
+
+    @property
+    def obj(self):
+        """The object stored on the node."""
+        if self._obj is _UNSET:
+            self._session.load_obj(self)
+        return self._obj
+
+    def to_dict(self):
+        """Return the node as a dict, like the non-lazy methods do. obj is
+        only included if it is loaded."""
+        doc = dict(self._doc)
+        if self._obj is not _UNSET:
+            doc['obj'] = self._obj
+        return doc
+
+
+class NodeSession(object):
+    """Builds and memoizes the Node views of one tree.
+
+    A node is read at most once per session; navigating from it loads the
+    children (or parents) of its siblings in the same query, so walking a
+    tree level by level costs a query per level rather than per node.
+    """
+
+    def __init__(self, tree, obj=False):
+        """Initialization routines.
+
+        Arguments:
+            tree (MongoTree): The tree to read.
+            obj (bool): Read obj along with the nodes. Default: project it
+                away and load it per node on access.
+        """
+        self.tree = tree
+        self.instrumentation = tree.instrumentation
+        self.with_obj = obj
+        self.projection = None if obj else {'obj': False}
+
+        # _id -> Node, and (identifier, path) -> Node
+        self._nodes = {}
+        self._paths = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def clear(self):
+        """Forget all nodes read so far."""
+        self._nodes = {}
+        self._paths = {}
+
+    def _wrap(self, docs):
+        """Return the Nodes of docs, as one batch of siblings."""
+        batch = []
+        for doc in docs:
+            node = self._nodes.get(doc['_id'])
+            if node is None:
+                node = self._nodes[doc['_id']] = Node(self, doc)
+                self._paths[(doc['identifier'], doc['path'])] = node
+                node._batch = batch
+            batch.append(node)
+        return batch
+
+    @operation
+    def get_node_by_path(self, path):
+        """Return the Node at a path.
+
+        Arguments:
+            path (string | list of tokens): The path of the node.
+
+        Returns:
+            Node || None.
+        """
+        key = {'identifier': self.tree.identifier,
+               'path': self.tree._join_path(path)}
+        node = self._paths.get((key['identifier'], key['path']))
+        if node is not None:
+            return node
+        doc = self.tree.read_collection.find_one(key, self.projection)
+        return self._wrap([doc])[0] if doc else None
+
+    @operation
+    def get_node_by_objectid(self, object_id):
+        """Return the Node with an ObjectId.
+
+        Returns:
+            Node || None.
+        """
+        if object_id in self._nodes:
+            return self._nodes[object_id]
+        doc = self.tree.read_collection.find_one({'_id': object_id},
+                                                 self.projection)
+        return self._wrap([doc])[0] if doc else None
+
+    @operation
+    def get_roots(self):
+        """Return the root Nodes of the tree.
+
+        Returns:
+            list of Nodes.
+        """
+        key = {'identifier': self.tree.identifier, 'parent': None}
+        return self._wrap(self.tree.read_collection.find(key,
+                                                         self.projection))
+
+    @operation
+    def load_children(self, node):
+        """Load the children of node, and of as many of its siblings as fit
+        in one query of IN_BATCH_SIZE ids."""
+        loading = []
+        ids = []
+        siblings = [n for n in node._batch or () if n is not node]
+        for sibling in [node] + siblings:
+            if sibling._children is not _UNSET:
+                continue
+            child_ids = sibling._doc['children']
+            if loading and len(ids) + len(child_ids) > \
+                    self.tree.IN_BATCH_SIZE:
+                break
+            loading.append(sibling)
+            ids.extend(child_ids)
+
+        missing = [object_id for object_id in ids
+                   if object_id not in self._nodes]
+        self._wrap(self.tree._find_by_objectids(missing,
+                                                projection=self.projection))
+
+        for parent in loading:
+            parent._children = [self._nodes[object_id]
+                                for object_id in parent._doc['children']
+                                if object_id in self._nodes]
+            for child in parent._children:
+                if child._parent is _UNSET:
+                    child._parent = parent
+
+    @operation
+    def load_parent(self, node):
+        """Load the parent of node and of its siblings."""
+        loading = [node] + [n for n in node._batch or ()
+                            if n is not node and n._parent is _UNSET]
+
+        missing = []
+        for child in loading:
+            parent_id = child._doc['parent']
+            if parent_id is not None and parent_id not in self._nodes \
+                    and parent_id not in missing:
+                missing.append(parent_id)
+        self._wrap(self.tree._find_by_objectids(missing,
+                                                projection=self.projection))
+
+        for child in loading:
+            parent_id = child._doc['parent']
+            child._parent = None if parent_id is None else \
+                self._nodes.get(parent_id)
+
+    @operation
+    def load_obj(self, node):
+        """Load the obj of node."""
+        node._obj = self.tree.get_obj(node._doc)
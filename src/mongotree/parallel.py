@@ -0,0 +1,140 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from multiprocessing.pool import Pool, ThreadPool
+
+from .backends import MongoBackend
+
+
+# The trees built by process pool workers, keyed by their config.
+_worker_trees = {}
+
+
+def tree_config(tree):
+    """Return what a worker process needs to rebuild a tree.
+
+    Arguments:
+        tree (MongoTree): A tree on a MongoBackend.
+
+    Returns:
+        dict. Picklable keyword arguments for worker_tree().
+    """
+    if not isinstance(tree.backend, MongoBackend):
+        raise ValueError('map_roots: process pools need a MongoBackend; '
+                         'use threads for other backends')
+
+    return {'identifier': tree.identifier,
+            'materialize_ancestors': tree.materialize_ancestors,
+            'backend_options': tree.backend.options}
+
+
+def worker_tree(config):
+    """Return the tree of this worker process for a config, building it (and
+    through it, a client of its own) on first use."""
+    from .mongotree import MongoTree
+
+    key = repr(sorted(config.items()))
+    if key not in _worker_trees:
+        backend = MongoBackend(**config['backend_options'])
+        _worker_trees[key] = MongoTree(
+            identifier=config['identifier'],
+            materialize_ancestors=config['materialize_ancestors'],
+            backend=backend)
+    return _worker_trees[key]
+
+
+def traverse_root(tree, root):
+    """Traverse the subtree of a root. See MongoTree.traverse_roots()."""
+    return tree.traverse(root)
+
+
+def dot_lines(tree, root, max_depth=None, max_nodes=None):
+    """Return the DOT lines of the subtree of a root. See
+    MongoTree.iter_dotgraph()."""
+    return list(tree._dot_lines([root], max_depth, max_nodes))
+
+
+def _run_in_thread(task):
+    tree, function, index, root = task
+    return index, function(tree, root)
+
+
+def _run_in_process(task):
+    config, function, index, root = task
+    return index, function(worker_tree(config), root)
+
+
+def map_roots(tree, function, roots, workers=4, processes=False,
+              progress=None, cancel=None):
+    """Run function(tree, root) for every root on a pool of workers.
+
+    Thread workers share the tree, and with it the pooled client of its
+    URI, so each gets connections of its own. Process workers rebuild the
+    tree, with a client of their own, from tree_config(); function, the
+    roots and the results must then be picklable.
+
+    Arguments:
+        tree (MongoTree): The tree the roots belong to.
+        function (callable): Called as function(tree, root).
+        roots (list): The root nodes.
+        workers (int): The size of the pool.
+        processes (bool): Use a process pool instead of a thread pool.
+        progress (callable): Called as progress(done, total) in the calling
+            thread whenever a root is finished.
+        cancel (callable): Polled in the calling thread whenever a root is
+            finished; once it returns True, the pool is stopped and the
+            roots not finished yet are left out of the results.
+
+    Returns:
+        list of (root, result) pairs in the order of roots.
+    """
+    if processes:
+        pool = Pool(workers)
+        config = tree_config(tree)
+        runner = _run_in_process
+    else:
+        pool = ThreadPool(workers)
+        config = tree
+        runner = _run_in_thread
+
+    tasks = [(config, function, i, root) for i, root in enumerate(roots)]
+    results = {}
+
+    try:
+        for index, result in pool.imap_unordered(runner, tasks):
+            results[index] = result
+            if progress:
+                progress(len(results), len(tasks))
+            if cancel and cancel():
+                break
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return [(root, results[i]) for i, root in enumerate(roots)
+            if i in results]
@@ -0,0 +1,121 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import heapq
+import threading
+
+from .cache import synchronized
+
+
+class HeavyHitters(object):
+    """A thread-safe SpaceSaving sketch of the keys with the highest counts.
+
+    At most capacity keys are tracked. A new key replaces the one with the
+    lowest count and takes over that count as its error, so counts are
+    overestimated by at most their error, and every key whose true count is
+    above total / capacity is tracked.
+    """
+
+    def __init__(self, capacity=1000):
+        """Initialization routines.
+
+        Arguments:
+            capacity (int): The number of keys to track.
+        """
+        self.capacity = capacity
+        self.total = 0
+        self._lock = threading.RLock()
+        # key -> [count, error], and a min-heap of (count, key) with one
+        # entry per key; counts only grow, so an entry may be stale (lower
+        # than the key's count) until it reaches the top.
+        self._counts = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    @synchronized
+    def add(self, key, count=1):
+        """Count a key.
+
+        Arguments:
+            key (hashable): The key, e.g. a path.
+            count (int): The increment.
+        """
+        self.total += count
+
+        entry = self._counts.get(key)
+        if entry is not None:
+            entry[0] += count
+            return
+
+        error = 0
+        if len(self._counts) >= self.capacity:
+            error = self._evict()
+
+        self._counts[key] = [error + count, error]
+        heapq.heappush(self._heap, (error + count, key))
+
+    def _evict(self):
+        """Drop the key with the lowest count.
+
+        Returns:
+            int. Its count.
+        """
+        while True:
+            count, key = heapq.heappop(self._heap)
+            current = self._counts[key][0]
+            if current == count:
+                del self._counts[key]
+                return count
+            heapq.heappush(self._heap, (current, key))
+
+    @synchronized
+    def top(self, k=None, filter=None):
+        """Return the keys with the highest counts.
+
+        Arguments:
+            k (int): How many keys to return. Default: all tracked keys.
+            filter (callable): Only consider keys for which it returns True.
+
+        Returns:
+            list of (key, count, error) tuples, highest count first. The
+            true count of a key is between count - error and count.
+        """
+        rows = ((key, count, error)
+                for key, (count, error) in self._counts.items()
+                if filter is None or filter(key))
+        rows = sorted(rows, key=lambda row: (-row[1], row[0]))
+
+        return rows if k is None else rows[:k]
+
+    @synchronized
+    def clear(self):
+        """Forget all keys."""
+        self.total = 0
+        self._counts = {}
+        self._heap = []
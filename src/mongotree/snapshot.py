@@ -0,0 +1,250 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from array import array
+
+import heapq
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class TreeSnapshot(object):
+    """A read-only, compact copy of (part of) a tree, see MongoTree.snapshot().
+
+    Nodes are numbered 0..n-1, parents before their children. Their parent,
+    first child, next sibling (-1 for none), hits and label are kept in
+    parallel arrays of machine integers, and every distinct label is stored
+    once, so a node costs a few dozen bytes instead of a decoded document,
+    plus an entry in the (parent, label) table find() looks children up in.
+    """
+
+    def __init__(self, nodes, separator):
+        """Initialization routines.
+
+        Arguments:
+            nodes (iterable): Node documents with _id, children, label, hits
+                and path, every parent before its children. A node whose
+                parent is not among them is a root of the snapshot.
+            separator (string): The path separator of the tree.
+        """
+        self.separator = separator
+
+        self.parents = array('l')
+        self.hits = array('l')
+        self.labels = array('l')
+
+        # The distinct labels, and label -> its index there.
+        self.label_table = []
+        self._label_ids = {}
+
+        # The roots of the snapshot, with root -> path and path -> root.
+        self.roots = []
+        self.root_paths = {}
+        self._roots_by_path = {}
+
+        # (parent, label index) -> child, to look up the paths below the
+        # roots one token at a time.
+        self._children_by_label = {}
+
+        # The position of every node in its parent's children, used to
+        # link the siblings in order once everything is loaded.
+        positions = array('l')
+        # _id -> (parent node, position) of children not loaded yet.
+        pending = {}
+
+        for node in nodes:
+            i = len(self.parents)
+            parent, position = pending.pop(node['_id'], (-1, 0))
+
+            label = node['label']
+            if label not in self._label_ids:
+                self._label_ids[label] = len(self.label_table)
+                self.label_table.append(label)
+            label = self._label_ids[label]
+
+            self.parents.append(parent)
+            self.hits.append(node.get('hits', 0))
+            self.labels.append(label)
+            positions.append(position)
+
+            if parent == -1:
+                self.roots.append(i)
+                self.root_paths[i] = node['path']
+                self._roots_by_path[node['path']] = i
+            else:
+                self._children_by_label[(parent, label)] = i
+
+            for n, child in enumerate(node.get('children', ())):
+                pending[child] = (i, n)
+
+        n = len(self.parents)
+        self.first_children = array('l', [-1]) * n
+        self.next_siblings = array('l', [-1]) * n
+
+        # Link the children back to front, so each ends up first.
+        order = sorted(range(n), key=lambda i: (self.parents[i], positions[i]))
+        for i in reversed(order):
+            parent = self.parents[i]
+            if parent != -1:
+                self.next_siblings[i] = self.first_children[parent]
+                self.first_children[parent] = i
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __repr__(self):
+        return '<TreeSnapshot of %d nodes, %d roots>' % (len(self),
+                                                         len(self.roots))
+
+    def find(self, path):
+        """Return the node at a path.
+
+        Arguments:
+            path (string | list of tokens): The path of the node.
+
+        Returns:
+            int || None if the path is not in the snapshot.
+        """
+        if isinstance(path, string_types):
+            path = path.split(self.separator)
+        path = list(path)
+
+        # Find the snapshot root the path starts at, then walk down.
+        for n in range(1, len(path) + 1):
+            i = self._roots_by_path.get(self.separator.join(path[:n]))
+            if i is None:
+                continue
+            for token in path[n:]:
+                label = self._label_ids.get(token)
+                i = self._children_by_label.get((i, label))
+                if i is None:
+                    return None
+            return i
+
+        return None
+
+    def label(self, i):
+        """Return the label of node i."""
+        return self.label_table[self.labels[i]]
+
+    def path(self, i):
+        """Return the path of node i, as on the tree."""
+        tokens = []
+        while self.parents[i] != -1:
+            tokens.append(self.label(i))
+            i = self.parents[i]
+        tokens.append(self.root_paths[i])
+        tokens.reverse()
+        return self.separator.join(tokens)
+
+    def children(self, i):
+        """Yield the children of node i, in order."""
+        child = self.first_children[i]
+        while child != -1:
+            yield child
+            child = self.next_siblings[child]
+
+    def is_leaf(self, i):
+        """Return whether node i has no children."""
+        return self.first_children[i] == -1
+
+    def depth(self, i):
+        """Return how many levels node i is below its snapshot root."""
+        depth = 0
+        while self.parents[i] != -1:
+            i = self.parents[i]
+            depth += 1
+        return depth
+
+    def traverse(self, i=None):
+        """Yield node i and its descendants in pre-order.
+
+        Arguments:
+            i (int): Default: every root, one after another.
+        """
+        if i is None:
+            for root in self.roots:
+                for node in self.traverse(root):
+                    yield node
+            return
+
+        parents = self.parents
+        first_children = self.first_children
+        next_siblings = self.next_siblings
+
+        yield i
+        node = first_children[i]
+        while node != -1:
+            yield node
+            if first_children[node] != -1:
+                node = first_children[node]
+                continue
+            # Climb up to the first ancestor (below i) with a next sibling.
+            while node != i and next_siblings[node] == -1:
+                node = parents[node]
+            if node == i:
+                break
+            node = next_siblings[node]
+
+    def count(self, i=None):
+        """Return the number of nodes in the subtree of node i.
+
+        Arguments:
+            i (int): Default: every node.
+        """
+        if i is None:
+            return len(self)
+        return sum(1 for _ in self.traverse(i))
+
+    def leaves(self, i=None):
+        """Yield the leaves at or below node i, in pre-order.
+
+        Arguments:
+            i (int): Default: the whole snapshot.
+        """
+        first_children = self.first_children
+        for node in self.traverse(i):
+            if first_children[node] == -1:
+                yield node
+
+    def top(self, k, i=None, leaves_only=False):
+        """Return the k nodes with the most hits.
+
+        Arguments:
+            k (int): How many nodes to return.
+            i (int): Only consider the subtree of node i. Default: all.
+            leaves_only (bool): Only consider leaves.
+
+        Returns:
+            list of (hits, node) pairs, most hits first.
+        """
+        nodes = self.leaves(i) if leaves_only else self.traverse(i)
+        hits = self.hits
+        return heapq.nlargest(k, ((hits[node], node) for node in nodes))
@@ -23,3 +23,14 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import os
+
+from mongotree import backends
+
+
+def make_backend(db_name):
+    """Build the backend named by the MONGOTREE_TEST_BACKEND environment
+    variable: 'mongo' (the default, needs a running mongod) or 'memory'."""
+    if os.environ.get('MONGOTREE_TEST_BACKEND') == 'memory':
+        return backends.MemoryBackend()
+    return backends.MongoBackend(db_name=db_name)
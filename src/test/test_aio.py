@@ -0,0 +1,115 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+try:
+    import asyncio
+    from mongotree.aio import AsyncMongoTree
+except (ImportError, SyntaxError):
+    asyncio = None
+
+from mongotree import mongotree
+
+from . import make_backend
+
+
+@unittest.skipIf(asyncio is None, 'asyncio requires Python 3.5+')
+class AsyncMongoTreeTest(unittest.TestCase):
+    """Tests the AsyncMongoTree front end."""
+
+    def setUp(self):
+        """Initialization."""
+        self.backend = make_backend('mongotree_test')
+        self.tree = mongotree.MongoTree(identifier='mongotest',
+                                        backend=self.backend)
+        self.atree = AsyncMongoTree(self.tree, max_workers=4)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        """Cleanup."""
+        self.wait(self.atree.close())
+        self.loop.close()
+        self.backend.drop()
+
+    def drop_db(self):
+        """Drop a collection."""
+        self.tree.collection.drop()
+
+    def wait(self, coroutine):
+        """Run a coroutine to completion on the test loop."""
+        return self.loop.run_until_complete(coroutine)
+
+    def test_upsert(self):
+        """Upserts go through the wrapped tree."""
+        self.wait(self.atree.upsert(['select', 'id']))
+        self.wait(self.atree.upsert(['select', 'id'], obj='x'))
+
+        node = self.wait(self.atree.get_node_by_path(['select', 'id']))
+        assert node['hits'] == 2
+        assert node['obj'] == 'x'
+        assert self.wait(self.atree.path_exists(['select']))
+        assert self.wait(self.atree.node_count()) == 2
+
+        self.drop_db()
+
+    def test_traverse(self):
+        """Async traversal matches the synchronous one."""
+        self.tree.IN_BATCH_SIZE = 2
+        self.tree.upsert_many([['a', 'b', 'c'], ['a', 'b', 'd'],
+                               ['a', 'e'], ['a', 'f', 'g'], ['a', 'h']])
+
+        root = self.tree.get_node_by_path(['a'])
+        seen = []
+        nodes = self.wait(self.atree.traverse(root, seen.append))
+
+        assert nodes == self.tree.traverse(root)
+        assert seen == nodes
+        assert [n['label'] for n in nodes] == \
+            ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+
+        self.drop_db()
+
+    def test_get_children(self):
+        """Children come back in order across concurrent batches."""
+        self.tree.IN_BATCH_SIZE = 2
+        self.tree.upsert_many([['r', str(i)] for i in range(5)])
+
+        children = self.wait(self.atree.get_children(['r']))
+        assert [c['label'] for c in children] == [str(i) for i in range(5)]
+
+        children = self.wait(self.atree.get_children(['r'], skip=1, limit=2))
+        assert [c['label'] for c in children] == ['1', '2']
+
+        assert self.wait(self.atree.get_children(['nope'])) == []
+
+        self.drop_db()
+
+    def test_unknown_attribute(self):
+        """Only the listed blocking methods are wrapped."""
+        with self.assertRaises(AttributeError):
+            self.atree.no_such_method
@@ -0,0 +1,79 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import pymongo
+import unittest
+
+from mongotree import backends
+
+
+class MongoBackendTest(unittest.TestCase):
+    """Tests the client configuration of MongoBackend. The clients connect
+    lazily, so no server is needed."""
+
+    def tearDown(self):
+        """Cleanup."""
+        backends.close_clients()
+
+    def test_shared_client(self):
+        """Backends with the same URI share one client."""
+        a = backends.MongoBackend(db_name='a')
+        b = backends.MongoBackend(host='localhost', port=27017, db_name='b')
+        c = backends.MongoBackend(uri='mongodb://127.0.0.1:27017/')
+        d = backends.MongoBackend(db_name='a', pool_size=5)
+
+        assert a.client is b.client
+        assert a.client is not c.client
+        assert a.client is not d.client
+        assert a.db.name == 'a'
+        assert b.db.name == 'b'
+
+    def test_uri_database(self):
+        """A database named in the URI is used."""
+        backend = backends.MongoBackend(uri='mongodb://localhost/trees',
+                                        db_name='ignored')
+        assert backend.db.name == 'trees'
+
+        backend = backends.MongoBackend(uri='mongodb://localhost/',
+                                        db_name='fallback')
+        assert backend.db.name == 'fallback'
+
+    def test_client_options(self):
+        """Write concern and read preferences end up on the collections."""
+        backend = backends.MongoBackend(
+            write_concern={'w': 'majority'},
+            read_preference=pymongo.ReadPreference.NEAREST)
+        assert backend.collection.write_concern.document == \
+            {'w': 'majority'}
+        assert backend.collection.read_preference == \
+            pymongo.ReadPreference.NEAREST
+        assert backend.read_collection is backend.collection
+
+        backend = backends.MongoBackend(secondary_reads=True)
+        assert backend.collection.read_preference == \
+            pymongo.ReadPreference.PRIMARY
+        assert backend.read_collection.read_preference == \
+            pymongo.ReadPreference.SECONDARY_PREFERRED
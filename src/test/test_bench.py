@@ -0,0 +1,67 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import unittest
+
+from mongotree import bench
+
+
+class BenchTest(unittest.TestCase):
+    """Tests the benchmark harness on a tiny scale."""
+
+    def test_workloads(self):
+        """The generators make the shapes they promise."""
+        deep = bench.deep_paths(20, depth=10)
+        assert len(deep) == 20
+        assert max(len(path) for path in deep) <= 12
+        assert all(path[0] == 'deep' for path in deep)
+
+        wide = bench.wide_paths(30, roots=3)
+        assert len(set(path[0] for path in wide)) == 3
+
+        sql = bench.sql_paths(50)
+        assert sql == bench.sql_paths(50)
+        assert set(path[0] for path in sql) <= \
+            set(['select', 'insert', 'update', 'delete'])
+
+    def test_run(self):
+        """run() measures every method of every workload."""
+        report = bench.run(backend='memory', scale=30, memory_sample=2)
+        json.dumps(report)
+
+        methods = set(result['method'] for result in report['results'])
+        assert set(['upsert', 'upsert_many', 'traverse', 'get_children',
+                    'remove', 'fromXml']) <= methods
+        assert set(result['workload'] for result in report['results']) == \
+            set(bench.WORKLOADS)
+
+        for result in report['results']:
+            assert result['ops'] > 0
+            assert result['round_trips_per_op'] >= 1
+            assert result['p50_ms'] <= result['p99_ms']
+
+        assert 'p99_ms' in bench.format_table(report)
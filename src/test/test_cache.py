@@ -0,0 +1,126 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import time
+import unittest
+
+import bson
+
+from mongotree.cache import NodeCache
+
+
+def make_node(path, identifier='mongotest'):
+    """Build a minimal node for the cache."""
+    return {'_id': bson.ObjectId(), 'identifier': identifier, 'path': path,
+            'children': []}
+
+
+class NodeCacheTest(unittest.TestCase):
+    """Tests the NodeCache class for saneness."""
+
+    def setUp(self):
+        """Initialization."""
+        self.cache = NodeCache(size=2)
+
+    def test_get(self):
+        """Nodes should be found by ObjectId and by path."""
+        node = make_node('select')
+        self.cache.put(node)
+
+        assert self.cache.get_by_objectid(node['_id']) == node
+        assert self.cache.get_by_path('mongotest', 'select') == node
+        assert self.cache.get_by_path('other', 'select') is None
+        assert self.cache.stats() == {'hits': 2, 'misses': 1,
+                                      'evictions': 0, 'size': 1}
+
+    def test_get_returns_copy(self):
+        """Changing a returned node should not change the cached node."""
+        node = make_node('select')
+        self.cache.put(node)
+
+        self.cache.get_by_objectid(node['_id'])['children'].append('x')
+
+        assert self.cache.get_by_objectid(node['_id'])['children'] == []
+
+    def test_get_wide_node(self):
+        """Hits copy the children list, not every ObjectId or the obj."""
+        node = make_node('select')
+        node['children'] = [bson.ObjectId() for _ in range(50000)]
+        node['obj'] = {'blob': ['x'] * 1000}
+        self.cache.put(node)
+
+        started = time.time()
+        for _ in range(10):
+            hit = self.cache.get_by_path('mongotest', 'select')
+        assert time.time() - started < 0.5
+
+        assert hit == node
+        assert hit['children'] is not node['children']
+        assert hit['children'][0] is node['children'][0]
+        assert hit['obj'] is node['obj']
+
+    def test_lru_eviction(self):
+        """The least recently used node should be evicted first."""
+        nodes = [make_node('a'), make_node('b'), make_node('c')]
+        self.cache.put(nodes[0])
+        self.cache.put(nodes[1])
+        self.cache.get_by_path('mongotest', 'a')
+        self.cache.put(nodes[2])
+
+        assert self.cache.get_by_path('mongotest', 'b') is None
+        assert self.cache.get_by_path('mongotest', 'a') is not None
+        assert self.cache.get_by_path('mongotest', 'c') is not None
+        assert self.cache.stats()['evictions'] == 1
+        assert len(self.cache) == 2
+
+    def test_ttl(self):
+        """Expired nodes should be misses."""
+        cache = NodeCache(size=2, ttl=0.01)
+        node = make_node('select')
+        cache.put(node)
+        time.sleep(0.02)
+
+        assert cache.get_by_objectid(node['_id']) is None
+        assert len(cache) == 0
+
+    def test_invalidate(self):
+        """Invalidation should drop both index entries of a node."""
+        cache = NodeCache(size=10)
+        nodes = [make_node('a'), make_node('a|$|b'), make_node('ab')]
+        for node in nodes:
+            cache.put(node)
+
+        cache.invalidate_prefix('mongotest', 'a|$|')
+        assert cache.get_by_objectid(nodes[1]['_id']) is None
+        assert len(cache) == 2
+
+        cache.invalidate_path('mongotest', 'a')
+        assert cache.get_by_objectid(nodes[0]['_id']) is None
+
+        cache.invalidate_objectid(nodes[2]['_id'])
+        assert cache.get_by_path('mongotest', 'ab') is None
+        assert len(cache) == 0
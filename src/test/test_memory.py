@@ -0,0 +1,172 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import unittest
+
+import pymongo
+
+from mongotree import backends
+from mongotree import memory
+
+
+class MemoryCollectionTest(unittest.TestCase):
+    """Tests the MemoryCollection class for saneness."""
+
+    def setUp(self):
+        """Initialization."""
+        self.backend = backends.MemoryBackend()
+        self.collection = self.backend.collection
+
+        for path in ('a', 'a|$|b', 'a|$|c', 'ab', 'b'):
+            self.collection.insert_one({'identifier': 'x', 'path': path,
+                                        'parent': None, 'children': [],
+                                        'hits': len(path)})
+
+    def paths(self, filter, **kwargs):
+        """Return the paths of the documents matching filter."""
+        return [doc['path'] for doc in self.collection.find(filter, **kwargs)]
+
+    def test_find_natural_order(self):
+        """Documents should come back in insertion order."""
+        assert self.paths({'identifier': 'x'}) == \
+            ['a', 'a|$|b', 'a|$|c', 'ab', 'b']
+        assert self.paths({'identifier': 'x', 'parent': None}) == \
+            ['a', 'a|$|b', 'a|$|c', 'ab', 'b']
+        assert self.paths({'identifier': 'x',
+                           'path': {'$in': ['b', 'a']}}) == ['a', 'b']
+
+    def test_find_operators(self):
+        """The supported query operators should behave like MongoDB's."""
+        assert self.paths({'hits': {'$gt': 2}}) == ['a|$|b', 'a|$|c']
+        assert self.paths({'$or': [{'path': 'b'}, {'hits': 2}]}) == \
+            ['ab', 'b']
+        assert self.paths({'path': {'$nin': ['a', 'b']},
+                           'hits': {'$lte': 2}}) == ['ab']
+        assert self.paths({'missing': None, 'path': 'b'}) == ['b']
+        assert self.paths({'missing': {'$exists': True}}) == []
+
+    def test_find_path_prefix(self):
+        """Anchored regexes and ranges on path should use the path index."""
+        regex = {'$regex': r'^a\|\$\|'}
+        assert memory.path_bounds(regex) == ('a|$|', 'a|$}')
+        assert self.paths({'identifier': 'x', 'path': regex}) == \
+            ['a|$|b', 'a|$|c']
+
+        regex = {'$regex': r'^a(\|\$\||$)'}
+        assert memory.path_bounds(regex) == ('a', 'b')
+        assert self.paths({'identifier': 'x', 'path': regex}) == \
+            ['a', 'a|$|b', 'a|$|c']
+
+        assert memory.path_bounds({'$regex': '^a|b'}) is None
+        assert self.paths({'identifier': 'x',
+                           'path': {'$regex': '^a|b'}}) == \
+            ['a', 'a|$|b', 'a|$|c', 'ab', 'b']
+
+        assert self.paths({'identifier': 'x',
+                           'path': {'$gte': 'a|$|', '$lt': 'b'}}) == \
+            ['a|$|b', 'a|$|c']
+
+    def test_cursor(self):
+        """Cursors should sort, skip, limit and project."""
+        cursor = self.collection.find({}, {'path': 1, '_id': 0})
+        cursor = cursor.sort('hits', pymongo.DESCENDING).skip(1).limit(2)
+        assert list(cursor) == [{'path': 'a|$|c'}, {'path': 'ab'}]
+
+        self.collection.update_one({'path': 'a'},
+                                   {'$push': {'children': {'$each': [1, 2]}}})
+        doc = self.collection.find_one({'path': 'a'},
+                                       {'children': {'$slice': [1, 5]}})
+        assert doc['children'] == [2]
+        assert doc['hits'] == 1
+        doc = self.collection.find_one(
+            {'path': 'a'}, {'_id': 1, 'children': {'$slice': [0, 1]}})
+        assert sorted(doc) == ['_id', 'children']
+        assert doc['children'] == [1]
+
+    def test_update(self):
+        """Update operators and upserts should behave like MongoDB's."""
+        result = self.collection.update_one(
+            {'identifier': 'x', 'path': 'c'},
+            {'$inc': {'hits': 2}, '$setOnInsert': {'children': [1]}},
+            upsert=True)
+        assert result.upserted_id is not None
+
+        self.collection.update_one(
+            {'identifier': 'x', 'path': 'c'},
+            {'$inc': {'hits': 2}, '$setOnInsert': {'children': []},
+             '$addToSet': {'ancestors': {'$each': [1, 2, 1]}}},
+            upsert=True)
+        doc = self.collection.find_one({'path': 'c'})
+        assert doc['hits'] == 4
+        assert doc['children'] == [1]
+        assert doc['ancestors'] == [1, 2]
+
+        self.collection.update_many({'ancestors': 2},
+                                    {'$set': {'ancestors.$': 3},
+                                     '$pull': {'children': 1}})
+        doc = self.collection.find_one({'path': 'c'})
+        assert doc['ancestors'] == [1, 3]
+        assert doc['children'] == []
+
+        # Results are copies.
+        doc['hits'] = 100
+        assert self.collection.find_one({'path': 'c'})['hits'] == 4
+
+    def test_bulk_write(self):
+        """bulk_write() should report counts and upserted ids."""
+        result = self.collection.bulk_write([
+            pymongo.UpdateOne({'identifier': 'x', 'path': 'new'},
+                              {'$set': {'hits': 1}}, upsert=True),
+            pymongo.UpdateMany({'identifier': 'x'}, {'$inc': {'hits': 1}}),
+            pymongo.DeleteMany({'path': {'$regex': '^a'}}),
+        ])
+        assert list(result.upserted_ids) == [0]
+        assert result.matched_count == 6
+        assert result.deleted_count == 4
+        assert self.paths({'identifier': 'x'}) == ['b', 'new']
+        assert self.collection.count_documents({'hits': 2}) == 2
+
+    def test_aggregate(self):
+        """aggregate() should support grouping on path tokens."""
+        pipeline = [{'$match': {'identifier': 'x'}},
+                    {'$project': {'tokens': {'$split': ['$path', '|$|']}}},
+                    {'$group': {'_id': {'$arrayElemAt': ['$tokens', 0]},
+                                'count': {'$sum': 1}}}]
+        counts = dict((row['_id'], row['count'])
+                      for row in self.collection.aggregate(pipeline))
+        assert counts == {'a': 3, 'ab': 1, 'b': 1}
+
+    def test_indexes(self):
+        """Indexes should be recorded and reported."""
+        name = self.collection.create_index([('path', 1)], unique=True)
+        info = self.collection.index_information()
+        assert info[name] == {'key': [('path', 1)], 'unique': True}
+        assert '_id_' in info
+
+    def tearDown(self):
+        """Denitialization."""
+        self.backend.drop()
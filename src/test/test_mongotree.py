@@ -24,17 +24,31 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import bson
+import io
 import json
 import jsonpickle
+import logging
+import pymongo
 import re
+import threading
+import time
 import unittest
 
+from mongotree import backends
 from mongotree import mongotree
+from mongotree.instrument import Instrumentation
+
+from . import make_backend
 
 
 # Used to find strings like: ObjectId('508d606afdbf6ddc32ad1225')
 OBJID_RE = r'ObjectId\(\'[a-z0-9]+\'\)'
 
+# Used to drop the prefix of unicode reprs, which depends on the Python
+# version and on whether the backend decodes strings.
+UNICODE_RE = r"\bu'"
+
 
 class MongoTreeTest(unittest.TestCase):
     """Tests the MongoTree class for saneness."""
@@ -43,12 +57,17 @@ class MongoTreeTest(unittest.TestCase):
         """Initialization."""
         self.db_name = 'mongotree_test'
         self.identifier = 'mongotest'
-        self.tree = mongotree.MongoTree(db_name=self.db_name,
-                                        identifier=self.identifier)
+        self.backend = make_backend(self.db_name)
+        self.tree = self.make_tree()
+
+    def make_tree(self, **kwargs):
+        """Build a MongoTree on the test backend."""
+        kwargs.setdefault('identifier', self.identifier)
+        return mongotree.MongoTree(backend=self.backend, **kwargs)
 
     def drop_db(self):
         """Drop a collection."""
-        self.tree.db.treefoo.drop()
+        self.tree.collection.drop()
 
     def test___init__(self):
         """Test initialization."""
@@ -61,8 +80,9 @@ class MongoTreeTest(unittest.TestCase):
         self.tree.upsert(path)
 
         r = re.sub(OBJID_RE, 'OBJID', repr(self.tree))
+        r = re.sub(UNICODE_RE, "'", r)
 
-        assert r == """[{u'_id': OBJID,
+        assert r == re.sub(UNICODE_RE, "'", """[{u'_id': OBJID,
   u'children': [OBJID],
   u'hits': 1,
   u'identifier': u'mongotest',
@@ -85,7 +105,25 @@ class MongoTreeTest(unittest.TestCase):
   u'label': u'from',
   u'obj': None,
   u'parent': OBJID,
-  u'path': u'select|$|*|$|from'}]"""
+  u'path': u'select|$|*|$|from'}]""")
+
+    def test_ensure_indexes(self):
+        """ensure_indexes() should only create the indexes that are missing.
+        """
+        self.tree.upsert(['select', '*'])
+
+        report = self.tree.ensure_indexes()
+        assert len(report['created']) == len(self.tree.INDEXES)
+        assert report['existing'] == []
+
+        report = self.tree.ensure_indexes()
+        assert report['created'] == []
+        assert len(report['existing']) == len(self.tree.INDEXES)
+
+        info = self.tree.collection.index_information()
+        assert info['identifier_1_path_1']['unique']
+
+        self.drop_db()
 
     def test_fromXml(self):
         """Test that a MongoTree can be properly formed with raw XML."""
@@ -124,6 +162,36 @@ class MongoTreeTest(unittest.TestCase):
 
         self.drop_db()
 
+    def test_fromXml_stream(self):
+        """fromXml() streams files in batches with the hits of upserting
+        every element's path."""
+        xml = (b'<q><a><b/><b/><c/></a><a><b/></a>' +
+               b'<d/>' * 10 + b'</q>')
+
+        expected = self.make_tree(identifier='expected')
+        for path in (['q'], ['q', 'a'], ['q', 'a', 'b'], ['q', 'a', 'b'],
+                     ['q', 'a', 'c'], ['q', 'a'], ['q', 'a', 'b']):
+            expected.upsert(path)
+        for i in range(10):
+            expected.upsert(['q', 'd'])
+
+        progress = []
+        stats = self.tree.fromXml(io.BytesIO(xml), batch_size=2,
+                                  progress=progress.append)
+
+        assert stats['elements'] == 17
+        assert 1 < len(progress) < stats['elements']
+        assert progress[-1]['paths'] == stats['paths']
+        assert stats['elements_per_second'] >= 0
+
+        def summary(tree):
+            return sorted((n['path'], n['hits'], len(n['children']))
+                          for n in tree.traverse(tree.get_roots()[0]))
+
+        assert summary(self.tree) == summary(expected)
+
+        self.drop_db()
+
     def test_upsert(self):
         """upsert() should save the correct information to the DB."""
         path = ['select',]
@@ -169,15 +237,548 @@ class MongoTreeTest(unittest.TestCase):
         self.tree.upsert(path, obj=pkl)
 
         node = self.tree.get_node_by_path(path)
-        
-        print 'NODE', node
-        
         assert pkl == node['obj']
 
         assert jsonpickle.decode(json.dumps(pkl)) == 'foobar'
 
         self.drop_db()
 
+    def assert_consistent(self, tree):
+        """Every node is linked both ways to its parent, exactly once."""
+        nodes = dict((n['_id'], n) for n in
+                     tree.collection.find({'identifier': tree.identifier}))
+        paths = [n['path'] for n in nodes.values()]
+        assert len(paths) == len(set(paths))
+
+        for node in nodes.values():
+            assert len(node['children']) == len(set(node['children']))
+            for child in node['children']:
+                assert nodes[child]['parent'] == node['_id']
+            if node['parent'] is not None:
+                parent = nodes[node['parent']]
+                assert node['_id'] in parent['children']
+                assert node['path'] == tree.SEPARATOR.join(
+                    (parent['path'], node['label']))
+
+        assert tree.collection.find_one({'_id': None}) is None
+
+    def test_upsert_concurrent(self):
+        """Threads upserting overlapping paths build one consistent tree."""
+        self.tree.ensure_indexes()
+        paths = [['select', str(i % 3), 'from', str(i % 5)] for i in range(60)]
+
+        def work(offset):
+            tree = self.make_tree()
+            for path in paths[offset::4]:
+                tree.upsert(path)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assert_consistent(self.tree)
+        assert self.tree.get_node_by_path(['select'])['hits'] == 60
+        assert self.tree.get_node_by_path(['select', '0', 'from', '0']
+                                          )['hits'] == 4
+        assert self.tree.node_count() == 1 + 3 + 3 + 15
+
+        self.drop_db()
+
+    def test_upsert_race(self):
+        """A writer that inserts the same nodes first (making our upserts
+        match or fail with a duplicate key) is merged into the tree."""
+        self.tree.upsert(['select'])
+        rival = self.make_tree()
+        collection = self.tree.collection
+
+        class RacingCollection(object):
+            """Lets the rival write right before our first bulk, and fails
+            that bulk after its first upsert like a duplicate key would."""
+            raced = False
+
+            def __getattr__(self, name):
+                return getattr(collection, name)
+
+            def bulk_write(self, requests, ordered=True):
+                if self.raced:
+                    return collection.bulk_write(requests, ordered=ordered)
+                self.raced = True
+                result = collection.bulk_write(requests[:1])
+                rival.upsert(['select', '*', 'from', 'bar'])
+                raise pymongo.errors.BulkWriteError({
+                    'writeErrors': [{'index': 1, 'code': 11000,
+                                     'errmsg': 'E11000'}],
+                    'upserted': [{'index': i, '_id': _id} for i, _id
+                                 in result.upserted_ids.items()]})
+
+        self.tree.collection = RacingCollection()
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.collection = collection
+
+        self.assert_consistent(self.tree)
+        assert self.tree.node_count() == 5
+        node = self.tree.get_node_by_path(['select', '*', 'from'])
+        assert node['hits'] == 2
+        assert [self.tree.get_node_by_objectid(c)['label']
+                for c in node['children']] == ['bar', 'foo']
+        assert self.tree.get_node_by_path(['select'])['hits'] == 3
+
+        self.drop_db()
+
+    def test_upsert_many(self):
+        """upsert_many() should leave the same nodes as upsert() in a loop."""
+        paths = [['select', '*', 'from', 'foo'],
+                 ['select', '*', 'from', 'bar'],
+                 ['select', 'id'],
+                 ['update', 'foo', 'set'],
+                 ['select', '*', 'from', 'foo']]
+        objs = [None, None, {'foo': 'bar'}, None, None]
+
+        looped = self.make_tree(identifier='mongotest_loop')
+        looped.upsert(['select', 'id', 'from'])
+        for path, obj in zip(paths, objs):
+            looped.upsert(path, obj=obj, hit_inc=2)
+
+        self.tree.upsert(['select', 'id', 'from'])
+        self.tree.upsert_many(paths, objs=objs, hit_inc=2)
+
+        def nodes_by_path(tree):
+            nodes = {}
+            for root in tree.get_roots():
+                for node in tree.traverse(root):
+                    nodes[node['path']] = node
+            ids = dict((node['_id'], path) for path, node in nodes.items())
+            return dict((path, (node['hits'], node['obj'],
+                                ids.get(node['parent']),
+                                [ids[child] for child in node['children']]))
+                        for path, node in nodes.items())
+
+        assert len(nodes_by_path(self.tree)) == 10
+        assert nodes_by_path(self.tree) == nodes_by_path(looped)
+
+        self.drop_db()
+
+    def test_upsert_buffer_hits(self):
+        """Buffered hits should only be written by flush()."""
+        tree = self.make_tree(buffer_hits=True, flush_size=3)
+        path = ['select', '*']
+
+        with tree:
+            tree.upsert(path)
+            tree.upsert(path, hit_inc=5)
+
+            assert tree.get_node_by_path(path)['hits'] == 1
+            assert tree.get_node_by_path(path, pending=True)['hits'] == 6
+            assert tree.get_node_by_path(['select'], pending=True)['hits'] == 6
+
+            # A third pending node reaches flush_size.
+            tree.upsert(['select', 'id'])
+            tree.upsert(['select', 'id'])
+            assert tree.get_node_by_path(['select'])['hits'] == 8
+            assert tree.get_node_by_path(['select', 'id'])['hits'] == 2
+
+            tree.upsert(path)
+
+        assert tree.get_node_by_path(['select'])['hits'] == 9
+        assert tree.get_node_by_path(path)['hits'] == 7
+        assert tree.flush() == 0
+
+        self.drop_db()
+
+    def test_upsert_flush_failure(self):
+        """Hits a failed flush did not write stay buffered."""
+        tree = self.make_tree(buffer_hits=True)
+        path = ['select', '*']
+        tree.upsert(path)
+        tree.upsert(path, hit_inc=5)
+        collection = tree.collection
+
+        class FailingCollection(object):
+            def __getattr__(self, name):
+                return getattr(collection, name)
+
+            def bulk_write(self, requests, ordered=True):
+                raise pymongo.errors.AutoReconnect('connection lost')
+
+        tree.collection = FailingCollection()
+        self.assertRaises(pymongo.errors.AutoReconnect, tree.flush)
+        tree.collection = collection
+
+        assert tree.get_node_by_path(path)['hits'] == 1
+        assert tree.get_node_by_path(path, pending=True)['hits'] == 6
+
+        # Of a partly failed bulk, only the failed updates are kept.
+        class PartlyFailingCollection(FailingCollection):
+            def bulk_write(self, requests, ordered=True):
+                collection.bulk_write(requests[1:], ordered=ordered)
+                raise pymongo.errors.BulkWriteError({
+                    'writeErrors': [{'index': 0, 'code': 1,
+                                     'errmsg': 'failed'}],
+                    'nInserted': 0, 'nUpserted': 0, 'nMatched': 1,
+                    'nModified': 1, 'nRemoved': 0, 'upserted': []})
+
+        tree.collection = PartlyFailingCollection()
+        self.assertRaises(pymongo.errors.BulkWriteError, tree.flush)
+        tree.collection = collection
+        assert len(tree._pending_hits) == 1
+
+        assert tree.flush() == 1
+        assert tree.get_node_by_path(['select'])['hits'] == 6
+        assert tree.get_node_by_path(path)['hits'] == 6
+
+        tree.close()
+        self.drop_db()
+
+    def test_upsert_flush_interval(self):
+        """Buffered hits are flushed on the interval without more upserts,
+        until the tree is closed."""
+        tree = self.make_tree(buffer_hits=True, flush_interval=0.05)
+        path = ['select', '*']
+        tree.upsert(path)
+        tree.upsert(path, hit_inc=4)
+
+        for _ in range(100):
+            if tree.get_node_by_path(path)['hits'] == 5:
+                break
+            time.sleep(0.02)
+        assert tree.get_node_by_path(path)['hits'] == 5
+
+        tree.close()
+        tree.upsert(path)
+        time.sleep(0.2)
+        assert tree.get_node_by_path(path)['hits'] == 5
+        assert tree.flush() == 2
+
+        self.drop_db()
+
+    def test_upsert_known_paths_bounded(self):
+        """buffer_hits remembers at most KNOWN_PATHS_SIZE paths."""
+        tree = self.make_tree(buffer_hits=True)
+        tree.KNOWN_PATHS_SIZE = 2
+        for label in 'abc':
+            tree.upsert([label])
+        tree.upsert(['b'])
+        tree.upsert(['a'])
+
+        assert list(tree._known_paths) == ['b', 'a']
+        # 'a' was forgotten, so its second upsert was written through.
+        assert tree.get_node_by_path(['a'])['hits'] == 2
+        assert tree.get_node_by_path(['b'])['hits'] == 1
+        assert tree.get_node_by_path(['b'], pending=True)['hits'] == 2
+
+        tree.close()
+        self.drop_db()
+
+    def test_materialize_ancestors(self):
+        """New nodes should store their ancestors and depth when asked to."""
+        tree = self.make_tree(materialize_ancestors=True)
+        tree.upsert(['select', '*', 'from'])
+        tree.upsert_many([['select', 'id', 'from'], ['select', '*', 'where']])
+
+        root = tree.get_node_by_path(['select'])
+        star = tree.get_node_by_path(['select', '*'])
+        node = tree.get_node_by_path(['select', 'id', 'from'])
+        assert root['ancestors'] == [] and root['depth'] == 0
+        assert star['ancestors'] == [root['_id']] and star['depth'] == 1
+        assert node['ancestors'][0] == root['_id'] and node['depth'] == 2
+
+        assert tree.get_depth(['select', 'id', 'from']) == 2
+        assert tree.get_depth(['select', 'nope']) is None
+        assert [n['label'] for n in tree.get_ancestors(node['path'])] == \
+            ['select', 'id']
+        assert len(tree.get_subtree(root)) == 6
+        assert len(tree.get_subtree(star)) == 3
+
+        tree.remove(star)
+        assert tree.node_count() == 3
+        assert not tree.path_exists(['select', '*', 'where'])
+
+        self.drop_db()
+
+    def test_remove_partly_materialized(self):
+        """Descendants added without materialize_ancestors should still be
+        read and removed with their subtree."""
+        tree = self.make_tree(materialize_ancestors=True)
+        tree.upsert(['a', 'b'])
+        self.tree.upsert(['a', 'b', 'c'])
+
+        root = tree.get_node_by_path(['a'])
+        assert 'ancestors' not in tree.get_node_by_path(['a', 'b', 'c'])
+        assert len(tree.get_subtree(root)) == 3
+
+        assert tree.remove(root) == 3
+        assert self.tree.node_count() == 0
+
+        self.drop_db()
+
+    def test_migrate_ancestors(self):
+        """migrate_ancestors() should add ancestors to an existing tree."""
+        self.tree.upsert(['select', '*', 'from'])
+        self.tree.upsert(['update', 'foo'])
+
+        assert self.tree.migrate_ancestors() == 5
+
+        root = self.tree.get_node_by_path(['select'])
+        node = self.tree.get_node_by_path(['select', '*', 'from'])
+        assert node['ancestors'] == [root['_id'], node['parent']]
+        assert node['depth'] == 2
+        assert self.tree.get_depth(['update', 'foo']) == 1
+        assert self.tree.valid_node(node)
+
+        self.drop_db()
+
+    def test_cache(self):
+        """Cached reads should be served from, and invalidated in, the cache.
+        """
+        tree = self.make_tree(cache_size=10)
+        tree.upsert(['select', '*', 'from'])
+
+        assert tree.get_node_by_path(['select', '*'])['hits'] == 1
+        assert tree.path_exists(['select', '*'])
+        assert len(tree.get_children(['select', '*'])) == 1
+        assert tree.cache.stats()['hits'] == 2
+
+        tree.upsert(['select', '*', 'where'])
+        node = tree.get_node_by_path(['select', '*'])
+        assert node['hits'] == 2
+        assert len(tree.get_children(['select', '*'])) == 2
+
+        tree.remove(node)
+        assert not tree.path_exists(['select', '*'])
+        assert tree.get_node_by_path(['select'])['children'] == []
+        assert tree.get_node_by_objectid(node['children'][0]) is None
+
+        self.drop_db()
+
+    def test_traverse(self):
+        """traverse() should visit nodes depth-first in children order."""
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id', 'from'])
+        self.tree.upsert(['select', '*', 'from', 'bar'])
+
+        visited = []
+        root = self.tree.get_roots()[0]
+        nodes = self.tree.traverse(root,
+                                   function=lambda n: visited.append(n['path']))
+
+        assert [node['path'] for node in nodes] == visited
+        assert visited == ['select',
+                           'select|$|*',
+                           'select|$|*|$|from',
+                           'select|$|*|$|from|$|foo',
+                           'select|$|*|$|from|$|bar',
+                           'select|$|id',
+                           'select|$|id|$|from']
+
+        self.drop_db()
+
+    def test_iter_traverse(self):
+        """iter_traverse() should stream nodes depth-first or level by level.
+        """
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id', 'from'])
+        self.tree.upsert(['select', '*', 'where'])
+
+        root = self.tree.get_roots()[0]
+
+        paths = [node['path'] for node in self.tree.iter_traverse(root)]
+        assert paths == [node['path'] for node in self.tree.traverse(root)]
+
+        paths = [node['path']
+                 for node in self.tree.iter_traverse(root, order='bfs',
+                                                     batch_size=1)]
+        assert paths == ['select',
+                         'select|$|*',
+                         'select|$|id',
+                         'select|$|*|$|from',
+                         'select|$|*|$|where',
+                         'select|$|id|$|from',
+                         'select|$|*|$|from|$|foo']
+
+        self.assertRaises(ValueError, self.tree.iter_traverse, root, 'post')
+
+        self.drop_db()
+
+    def test_iter_roots_and_leaves(self):
+        """iter_roots() and iter_leaves() should match their list versions.
+        """
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id'])
+        self.tree.upsert(['update', 'foo'])
+
+        roots = list(self.tree.iter_roots(batch_size=1))
+        assert [root['label'] for root in roots] == ['select', 'update']
+
+        leaves = list(self.tree.iter_leaves('select', batch_size=1))
+        assert leaves == self.tree.get_leaf_nodes('select')
+        assert sorted(leaf['label'] for leaf in leaves) == ['foo', 'id']
+
+        self.drop_db()
+
+    def test_prefix_queries(self):
+        """Prefix queries escape tokens and stay within their tree."""
+        self.tree.upsert(['a.b', '*', 'x'])
+        self.tree.upsert(['a.b', '*', 'y', 'z'])
+        self.tree.upsert(['a.b', '+'])
+        self.tree.upsert(['axb', 'q'])
+        self.tree.upsert(['a.b|', 'q'])
+        other = self.make_tree(identifier='other')
+        other.upsert(['a.b', '*', 'w'])
+
+        labels = sorted(leaf['label']
+                        for leaf in self.tree.get_leaf_nodes(['a.b']))
+        assert labels == ['+', 'x', 'z']
+
+        root = self.tree.get_node_by_path(['a.b'])
+        assert len(self.tree.get_leaf_nodes(root)) == 3
+        assert self.tree.get_leaf_nodes(['a.b', '+']) == []
+
+        paths = [n['path'] for n in self.tree.get_descendants(['a.b'])]
+        assert paths == ['a.b|$|*', 'a.b|$|*|$|x', 'a.b|$|*|$|y',
+                         'a.b|$|*|$|y|$|z', 'a.b|$|+']
+
+        nodes = self.tree.get_descendants('a.b', max_depth=1)
+        assert [n['label'] for n in nodes] == ['*', '+']
+        nodes = self.tree.get_descendants('a.b', max_depth=2)
+        assert [n['label'] for n in nodes] == ['*', 'x', 'y', '+']
+        assert self.tree.get_descendants('a.b', max_depth=0) == []
+
+        assert self.tree.count_descendants(['a.b']) == 5
+        assert self.tree.count_descendants(['a.b'], max_depth=2) == 4
+        assert self.tree.count_descendants(['a.b', '*'], max_depth=1) == 2
+        assert self.tree.count_descendants(['nope']) == 0
+        assert self.tree.subtree_count(['a.b']) == 6
+        assert other.count_descendants(['a.b']) == 2
+
+        # Tokens may span lines.
+        self.tree.upsert(['n', 'x\ny', 'z\n'])
+        nodes = self.tree.get_descendants(['n'], max_depth=1)
+        assert [n['label'] for n in nodes] == ['x\ny']
+        assert self.tree.count_descendants(['n'], max_depth=2) == 2
+
+        self.drop_db()
+
+    def test_top_paths(self):
+        """top_paths() should get the most hit nodes from the db or the
+        sketch."""
+        tree = self.make_tree(sketch_size=100)
+        tree.ensure_indexes()
+        tree.upsert(['select', '*', 'from', 'foo'], hit_inc=3)
+        tree.upsert(['select', 'id', 'from', 'foo'])
+        tree.upsert(['select', '*', 'from', 'bar'], hit_inc=2)
+        tree.upsert(['update', 'foo'], hit_inc=4)
+
+        assert tree.top_paths(3) == [('select', 6), ('select|$|*', 5),
+                                     ('select|$|*|$|from', 5)]
+        assert tree.top_paths(2, leaves_only=True) == \
+            [('update|$|foo', 4), ('select|$|*|$|from|$|foo', 3)]
+        assert tree.top_paths(1, under=['select', 'id']) == \
+            [('select|$|id|$|from', 1)]
+        assert tree.top_paths(0) == []
+
+        assert tree.top_paths(3, sketch=True) == tree.top_paths(3)
+        assert tree.top_paths(2, under='update', sketch=True) == \
+            [('update|$|foo', 4)]
+        self.assertRaises(ValueError, tree.top_paths, 1, leaves_only=True,
+                          sketch=True)
+        self.assertRaises(ValueError, self.tree.top_paths, 1, sketch=True)
+
+        self.drop_db()
+
+    def test_snapshot(self):
+        """snapshot() should hold the same tree as the collection."""
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id', 'from', 'foo'])
+        self.tree.upsert(['select', '*', 'from', 'bar'])
+        self.tree.upsert(['update', 'foo'], hit_inc=5)
+
+        snapshot = self.tree.snapshot()
+        assert len(snapshot) == self.tree.node_count() == 10
+
+        nodes = []
+        for root in self.tree.get_roots():
+            nodes.extend(self.tree.traverse(root))
+        assert [snapshot.path(i) for i in snapshot.traverse()] == \
+            [node['path'] for node in nodes]
+        assert [snapshot.hits[i] for i in snapshot.traverse()] == \
+            [node['hits'] for node in nodes]
+
+        select = snapshot.find(['select'])
+        assert snapshot.count(select) == 8
+        assert [snapshot.path(i) for i in snapshot.leaves(select)] == \
+            [leaf['path'] for leaf in nodes[:8] if not leaf['children']]
+        assert [(hits, snapshot.label(i)) for hits, i in snapshot.top(2)] == \
+            [(5, 'foo'), (5, 'update')]
+        assert snapshot.find('select|$|nope') is None
+
+        star = self.tree.get_node_by_path(['select', '*'])
+        snapshot = self.tree.snapshot(roots=[star])
+        assert len(snapshot) == 4
+        assert snapshot.path(snapshot.roots[0]) == 'select|$|*'
+        i = snapshot.find(['select', '*', 'from', 'bar'])
+        assert snapshot.label(i) == 'bar'
+        assert snapshot.depth(i) == 2
+        assert snapshot.find(['select']) is None
+
+        self.drop_db()
+
+    def test_traverse_roots(self):
+        """traverse_roots() should fan out over the roots and return the
+        results in root order, with progress and cancellation hooks."""
+        for verb in ('update', 'select', 'insert', 'delete'):
+            self.tree.upsert([verb, 'foo', 'bar'])
+            self.tree.upsert([verb, 'baz'])
+
+        progress = []
+        results = self.tree.traverse_roots(
+            workers=3, progress=lambda done, total: progress.append(done))
+
+        assert [root['label'] for root, nodes in results] == \
+            ['delete', 'insert', 'select', 'update']
+        for root, nodes in results:
+            assert nodes == self.tree.traverse(root)
+        assert sorted(progress) == [1, 2, 3, 4]
+
+        results = self.tree.traverse_roots(workers=1, cancel=lambda: True)
+        assert len(results) == 1
+
+        if isinstance(self.tree.backend, backends.MemoryBackend):
+            with self.assertRaises(ValueError):
+                self.tree.traverse_roots(processes=True)
+        else:
+            results = self.tree.traverse_roots(workers=2, processes=True)
+            assert [len(nodes) for root, nodes in results] == [4, 4, 4, 4]
+
+        lines = list(self.tree.iter_dotgraph(workers=2))
+        assert lines == list(self.tree.iter_dotgraph())
+
+        self.drop_db()
+
+    def test_node_count(self):
+        """node_count() and subtree_count() should count on the server."""
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id'])
+        self.tree.upsert(['update', 'foo'])
+        self.tree.upsert(['selected'])
+
+        assert self.tree.node_count() == 8
+        assert self.tree.node_count(per_root=True) == {'select': 5,
+                                                        'update': 2,
+                                                        'selected': 1}
+
+        roots = [self.tree.get_node_by_path(['select', '*'])]
+        assert self.tree.node_count(roots=roots) == 3
+        assert self.tree.node_count(roots=roots, per_root=True) == \
+            {'select|$|*': 3}
+
+        assert self.tree.subtree_count(['select']) == 5
+        assert self.tree.subtree_count(['select', 'id']) == 1
+        assert self.tree.subtree_count(['nope']) == 0
+
+        self.drop_db()
+
     def test_get_roots(self):
         """get_roots() should only return nodes with no parents."""
         path = ['select', '*', 'from', 'foo']
@@ -208,7 +809,7 @@ class MongoTreeTest(unittest.TestCase):
         self.drop_db()
 
     def test_get_dotgraph(self):
-        """"""
+        """Every node and edge is in the graph exactly once."""
         path = ['select', '*', 'from', 'foo']
         self.tree.upsert(path)
         path = ['select', '*', 'from', 'bar']
@@ -216,24 +817,59 @@ class MongoTreeTest(unittest.TestCase):
         path = ['select', 'id', 'from', 'baz']
         self.tree.upsert(path)
 
-        graph = self.tree.get_dotgraph().to_string()
+        graph = self.tree.get_dotgraph()
+
+        labels = sorted(node.get_label().strip('"')
+                        for node in graph.get_nodes())
+        assert labels == sorted(['select', '*', 'from', 'foo', 'bar', 'id',
+                                 'from', 'baz'])
+
+        nodes = dict((str(n['_id']), n)
+                     for n in self.tree.traverse(self.tree.get_roots()[0]))
+        edges = sorted((nodes[e.get_source().strip('"')]['path'],
+                        nodes[e.get_destination().strip('"')]['path'])
+                       for e in graph.get_edges())
+        assert edges == sorted((nodes[str(n['parent'])]['path'], n['path'])
+                               for n in nodes.values() if n['parent'])
+
+        self.drop_db()
+
+    def test_get_dotgraph_limits(self):
+        """get_dotgraph() honors roots, max_depth and max_nodes, and
+        iter_dotgraph() streams the same graph as DOT text."""
+        self.tree.upsert(['select', '*', 'from', 'foo'])
+        self.tree.upsert(['select', 'id'])
+        self.tree.upsert(['insert', 'into', 'foo'])
+
+        def labels(graph):
+            return sorted(node.get_label().strip('"')
+                          for node in graph.get_nodes())
+
+        insert = self.tree.get_node_by_path(['insert'])
+        star = self.tree.get_node_by_path(['select', '*'])
+
+        graph = self.tree.get_dotgraph(roots=[insert])
+        assert labels(graph) == ['foo', 'insert', 'into']
+        assert len(graph.get_edges()) == 2
 
-        lines = graph.split('\n')
+        graph = self.tree.get_dotgraph(roots=[insert, star], max_depth=1)
+        assert labels(graph) == ['*', 'from', 'insert', 'into']
+        assert len(graph.get_edges()) == 2
 
-        assert lines[1].split()[1] == '[label=select];'
-        assert lines[2].split()[1] == '[label="*"];'
-        assert lines[4].split()[1] == '[label=select];'
-        assert lines[5].split()[1] == '[label=id];'
-        assert lines[7].split()[1] == '[label="*"];'
-        assert lines[8].split()[1] == '[label=from];'
-        assert lines[10].split()[1] == '[label=from];'
-        assert lines[11].split()[1] == '[label=foo];'
-        assert lines[13].split()[1] == '[label=from];'
-        assert lines[14].split()[1] == '[label=bar];'
-        assert lines[16].split()[1] == '[label=id];'
-        assert lines[17].split()[1] == '[label=from];'
-        assert lines[19].split()[1] == '[label=from];'
-        assert lines[20].split()[1] == '[label=baz];'
+        graph = self.tree.get_dotgraph(max_depth=0)
+        assert labels(graph) == ['insert', 'select']
+        assert not graph.get_edges()
+
+        graph = self.tree.get_dotgraph(max_nodes=3)
+        assert labels(graph) == ['foo', 'insert', 'into']
+        assert len(graph.get_edges()) == 2
+
+        lines = list(self.tree.iter_dotgraph(roots=[insert]))
+        assert lines[0] == 'digraph G {\n'
+        assert lines[-1] == '}\n'
+        assert len([l for l in lines if '[label=' in l]) == 3
+        assert len([l for l in lines if ' -> ' in l]) == 2
+        assert '[label="insert"];\n' in lines[1]
 
         self.drop_db()
 
@@ -267,6 +903,27 @@ class MongoTreeTest(unittest.TestCase):
 
         self.drop_db()
 
+    def test_get_children_paged(self):
+        """get_children() should keep the children order and page them."""
+        labels = ['c%d' % i for i in range(5)]
+        for label in labels:
+            self.tree.upsert(['select', label])
+
+        children = self.tree.get_children(['select'])
+        assert [child['label'] for child in children] == labels
+
+        children = self.tree.get_children(['select'], skip=1, limit=2)
+        assert [child['label'] for child in children] == ['c1', 'c2']
+
+        children = self.tree.get_children(['select'], skip=4)
+        assert [child['label'] for child in children] == ['c4']
+
+        assert self.tree.get_children(['select'], skip=5, limit=2) == []
+        assert self.tree.get_children(['select'], limit=0) == []
+        assert self.tree.get_children(['nope'], limit=2) == []
+
+        self.drop_db()
+
     def test_get_children_with_invalid_path(self):
         """Supplying no args should blow up. Need a node or a path."""
         path = ['select', 'foo', 'from', 'yeah', 'man']
@@ -275,6 +932,25 @@ class MongoTreeTest(unittest.TestCase):
 
         self.drop_db()
 
+    def test_get_children_dangling(self):
+        """Ids of children that no longer exist are skipped."""
+        self.tree.upsert_many([['a', 'b'], ['a', 'c']])
+        self.tree.collection.update_one(
+            {'identifier': self.identifier, 'path': 'a'},
+            {'$push': {'children': bson.ObjectId()}})
+
+        children = self.tree.get_children(['a'])
+        assert [child['label'] for child in children] == ['b', 'c']
+
+        node = self.tree.get_node_by_path(['a'])
+        assert [n['label'] for n in self.tree.traverse(node)] == \
+            ['a', 'b', 'c']
+
+        node = self.tree.get_node_by_path(['a'], lazy=True)
+        assert [child.label for child in node.children] == ['b', 'c']
+
+        self.drop_db()
+
     def test_get_node_by_path(self):
         """Get a node belonging to a path."""
         path1 = ['select', 'foo', 'from']
@@ -319,6 +995,33 @@ class MongoTreeTest(unittest.TestCase):
 
         self.drop_db()
 
+    def test_remove_updates_parent(self):
+        """remove() should return the count and unlink the node's parent."""
+        self.tree.upsert(['select', 'foo', 'from', 'bar'])
+        self.tree.upsert(['select', 'foo', 'from', 'baz'])
+        self.tree.upsert(['select', 'foobar'])
+
+        node = self.tree.get_node_by_path(['select', 'foo'])
+        assert self.tree.remove(node) == 4
+
+        root = self.tree.get_node_by_path(['select'])
+        assert len(root['children']) == 1
+        assert self.tree.get_children(['select'])[0]['label'] == 'foobar'
+        assert self.tree.node_count() == 2
+
+        self.drop_db()
+
+    def test_remove_deep_tree(self):
+        """remove() should not recurse, whatever the depth of the subtree."""
+        path = ['token%d' % i for i in range(1100)]
+        self.tree.upsert_many([path])
+
+        root = self.tree.get_roots()[0]
+        assert self.tree.remove(root) == len(path)
+        assert self.tree.get_roots() == []
+
+        self.drop_db()
+
     def test_remove_invalid_node(self):
         """Specifying an invalid node should throw ValueError exception."""
         path1 = ['select', 'foo', 'from', 'bar']
@@ -344,6 +1047,216 @@ class MongoTreeTest(unittest.TestCase):
 
         self.drop_db()
 
+    def test_fields(self):
+        """Read methods only transfer the requested fields."""
+        self.tree.upsert_many([['a', 'b', 'c'], ['a', 'd']],
+                              objs=[{'big': 'x' * 100}, None])
+        structure = ['label', 'path']
+
+        node = self.tree.get_node_by_path(['a'], fields=structure)
+        assert sorted(node) == ['_id', 'label', 'path']
+        assert sorted(self.tree.get_node_by_objectid(node['_id'],
+                                                     fields=['hits'])) == \
+            ['_id', 'hits']
+
+        children = self.tree.get_children(['a'], fields=structure)
+        assert [child['label'] for child in children] == ['b', 'd']
+        assert all('obj' not in child for child in children)
+
+        root = self.tree.get_node_by_path(['a'])
+        nodes = self.tree.traverse(root, fields=structure)
+        assert [n['label'] for n in nodes] == ['a', 'b', 'c', 'd']
+        assert all(sorted(n) == ['_id', 'children', 'label', 'path']
+                   for n in nodes[1:])
+
+        for nodes in (self.tree.get_roots(fields=structure),
+                      self.tree.get_descendants(['a'], fields=structure),
+                      self.tree.get_ancestors(['a', 'b', 'c'],
+                                              fields=['label']),
+                      self.tree.get_leaf_nodes(['a'], fields=structure),
+                      self.tree.get_subtree(root, fields=structure)[1:],
+                      [self.tree.get_parent(['a', 'b'], fields=structure)]):
+            assert nodes
+            assert all('obj' not in n and 'hits' not in n for n in nodes)
+
+        self.drop_db()
+
+    def test_separate_objs(self):
+        """With separate_objs, objs are stored apart from their nodes."""
+        tree = self.make_tree(separate_objs=True)
+        assert 'identifier_1_path_1' in \
+            tree.ensure_indexes()['created']
+        obj = {'big': 'x' * 1000}
+
+        tree.upsert(['a', 'b'], obj=obj)
+        node = tree.get_node_by_path(['a', 'b'])
+        assert node['obj'] is None and node['obj_id'] is not None
+        assert tree.valid_node(node)
+        assert tree.get_obj(node) == obj
+        assert tree.get_obj(['a', 'b']) == obj
+        assert tree.get_obj(['a']) is None
+        assert tree.get_node_by_path(['a', 'b'], lazy=True).obj == obj
+
+        # Objs are replaced (or reset) by later upserts, like inline ones.
+        tree.upsert(['a', 'b'], obj={'small': 1})
+        assert tree.get_obj(['a', 'b']) == {'small': 1}
+        assert tree.obj_collection.count_documents({}) == 1
+        tree.upsert(['a', 'b', 'c'], obj=obj)
+        assert tree.get_obj(['a', 'b']) is None
+        assert tree.get_obj(['a', 'b', 'c']) == obj
+
+        tree.remove(tree.get_node_by_path(['a']))
+        assert tree.obj_collection.count_documents({}) == 0
+
+        self.drop_db()
+
+    def test_diff_and_sync(self):
+        """sync_to() makes another tree equal by writing the diff."""
+        self.tree.upsert_many([['a', 'b', 'c'], ['a', 'b', 'd'], ['a', 'e'],
+                               ['f']], objs=[None, {'x': 1}, None, None])
+        target = self.make_tree(identifier='target')
+        assert target.diff(self.tree) == \
+            {'added': [], 'removed': self.tree.diff(target)['added'],
+             'changed': []}
+
+        assert self.tree.sync_to(target, batch_size=2) == \
+            {'added': 6, 'removed': 0, 'changed': 0}
+        assert self.tree.diff(target) == \
+            {'added': [], 'removed': [], 'changed': []}
+        assert target.get_obj(['a', 'b', 'd']) == {'x': 1}
+        self.assert_consistent(target)
+
+        # Change hits and objs, add and remove nodes on the source side.
+        self.tree.upsert(['a', 'e', 'g'], obj={'y': 2})
+        self.tree.upsert(['a', 'b', 'd'], obj={'x': 3})
+        self.tree.remove(self.tree.get_node_by_path(['a', 'b']))
+        sep = self.tree.SEPARATOR
+
+        diff = self.tree.diff(target)
+        assert diff['added'] == [sep.join(['a', 'e', 'g'])]
+        assert diff['removed'] == [sep.join(p) for p in
+                                   (['a', 'b'], ['a', 'b', 'c'],
+                                    ['a', 'b', 'd'])]
+        assert diff['changed'] == ['a', sep.join(['a', 'e'])]
+        assert [change for change, node, other in
+                self.tree.iter_diff(target, path=['a', 'e'])] == \
+            ['changed', 'added']
+
+        assert self.tree.sync_to(target, batch_size=2) == \
+            {'added': 1, 'removed': 3, 'changed': 2}
+        assert self.tree.diff(target) == \
+            {'added': [], 'removed': [], 'changed': []}
+        assert target.get_node_by_path(['a', 'e'])['hits'] == 2
+        assert target.get_obj(['a', 'e', 'g']) == {'y': 2}
+        self.assert_consistent(target)
+
+        # The parent of a synced subtree has to exist in the target.
+        self.tree.upsert(['h', 'i'])
+        self.assertRaises(ValueError, self.tree.sync_to, target,
+                          path=['h', 'i'])
+
+        self.drop_db()
+
+    def test_sync_to_other_storage(self):
+        """Trees sync across backends and storage options."""
+        self.tree.upsert_many([['a', 'b'], ['a', 'c', 'd']],
+                              objs=[{'x': 1}, {'y': 2}])
+        target = mongotree.MongoTree(identifier='target',
+                                     backend=backends.MemoryBackend(),
+                                     materialize_ancestors=True,
+                                     separate_objs=True)
+
+        self.tree.sync_to(target)
+        assert self.tree.diff(target)['added'] == []
+        assert target.get_obj(['a', 'c', 'd']) == {'y': 2}
+        d = target.get_node_by_path(['a', 'c', 'd'])
+        assert d['depth'] == 2
+        assert [n['label'] for n in target.get_subtree(
+            target.get_node_by_path(['a']))] == ['a', 'b', 'c', 'd']
+
+        self.tree.upsert(['a', 'b'], obj={'x': 5})
+        assert self.tree.sync_to(target)['changed'] == 2
+        assert target.get_obj(['a', 'b']) == {'x': 5}
+        assert target.obj_collection.count_documents({}) == 2
+
+        # And back again.
+        self.tree.remove(self.tree.get_node_by_path(['a']))
+        assert target.sync_to(self.tree)['added'] == 4
+        assert self.tree.get_obj(['a', 'b']) == {'x': 5}
+        self.assert_consistent(self.tree)
+
+        self.drop_db()
+
+    def test_instrumentation(self):
+        """Instrumented trees count the queries, documents and bytes of
+        every public method and report each call."""
+        reports = []
+        metrics = Instrumentation(callback=reports.append)
+        tree = self.make_tree(instrumentation=metrics)
+
+        tree.upsert_many([['a', 'b', 'c'], ['a', 'd']])
+        assert [r['method'] for r in reports] == ['upsert_many']
+        assert reports[0]['queries'] >= 1
+
+        # upsert() calls upsert_many(); the call counts towards upsert.
+        tree.upsert(['a', 'e'])
+        assert [r['method'] for r in reports[1:]] == ['upsert']
+
+        children = tree.get_children(['a'])
+        report = reports[-1]
+        assert report['method'] == 'get_children'
+        assert report['docs'] >= len(children) == 3
+        assert report['bytes'] > 0
+        assert report['stages']['client']['seconds'] >= 0
+        assert sum(stage['calls'] for stage in report['stages'].values()) \
+            == report['queries']
+
+        # Generators are one call from the first item to the last.
+        del reports[:]
+        roots = list(tree.iter_roots())
+        assert len(roots) == 1
+        assert [r['method'] for r in reports] == ['iter_roots']
+        assert reports[0]['docs'] == 1
+
+        # So are methods that return a generator.
+        del reports[:]
+        nodes = list(tree.iter_traverse(roots[0], order='bfs'))
+        assert [r['method'] for r in reports] == ['iter_traverse']
+        assert reports[0]['queries'] == 2
+        assert reports[0]['docs'] == len(nodes) - 1 == 4
+
+        stats = metrics.stats()
+        assert stats['upsert_many']['calls'] == 1
+        assert stats['get_children']['docs'] == report['docs']
+        assert metrics.queries == sum(s['queries'] for s in stats.values())
+
+        metrics.reset()
+        assert metrics.stats() == {} and metrics.queries == 0
+
+        self.drop_db()
+
+    def test_instrumentation_slow_log(self):
+        """Operations over slow_ms are logged."""
+        metrics = Instrumentation(slow_ms=0, count_bytes=False)
+        tree = self.make_tree(instrumentation=metrics)
+        tree.upsert(['a', 'b'])
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('mongotree')
+        logger.addHandler(handler)
+        try:
+            tree.get_node_by_path(['a', 'b'])
+        finally:
+            logger.removeHandler(handler)
+
+        assert len(records) == 1
+        assert 'get_node_by_path' in records[0].getMessage()
+        assert metrics.stats()['get_node_by_path']['bytes'] == 0
+
+        self.drop_db()
+
     def test_valid_node_with_valid(self):
         """Should return True if the dict contains all the necessary keys."""
         node = {'identifier': 'foobar',
@@ -391,4 +1304,4 @@ class MongoTreeTest(unittest.TestCase):
 
     def tearDown(self):
         """Denitialization."""
-        self.tree.mongo.drop_database(self.db_name)
+        self.backend.drop()
@@ -0,0 +1,132 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import unittest
+
+from mongotree import mongotree
+from mongotree.instrument import Instrumentation
+from mongotree.node import Node
+
+from . import make_backend
+
+
+class NodeSessionTest(unittest.TestCase):
+    """Tests the lazy Node views for saneness."""
+
+    def setUp(self):
+        """Initialization."""
+        self.backend = make_backend('mongotree_test')
+        self.metrics = Instrumentation()
+        self.tree = mongotree.MongoTree(identifier='nodetest',
+                                        backend=self.backend,
+                                        instrumentation=self.metrics)
+        self.tree.upsert_many([['a', 'b', 'd'], ['a', 'b', 'e'],
+                               ['a', 'c', 'f'], ['a', 'c', 'g'], ['h']])
+        self.tree.upsert(['a', 'b'], obj={'big': 'x' * 1000})
+        self.metrics.reset()
+
+    def drop_db(self):
+        """Drop a collection."""
+        self.tree.collection.drop()
+
+    def test_navigation(self):
+        """Children and parents load on access and are memoized."""
+        session = self.tree.session()
+        a = session.get_node_by_path(['a'])
+        assert isinstance(a, Node)
+        assert a.label == 'a' and a['path'] == 'a' and not a.is_leaf
+        assert a.parent is None
+
+        b, c = a.children
+        assert [b.label, c.label] == ['b', 'c']
+        assert b.parent is a and c.parent is a
+        queries = self.metrics.queries
+        assert session.get_node_by_path(['a', 'b']) is b
+        assert session.get_node_by_path(['a']) is a
+        assert self.metrics.queries == queries
+        assert session.get_node_by_objectid(b.id) is b
+
+        # Loading the children of b loads those of its sibling c too.
+        queries = self.metrics.queries
+        assert [n.label for n in b.children] == ['d', 'e']
+        assert [n.label for n in c.children] == ['f', 'g']
+        assert self.metrics.queries == queries + 1
+        assert c.children[0].parent is c
+        assert c.children[0].children == []
+
+        assert [n.label for n in session.get_roots()] == ['a', 'h']
+        assert session.get_roots()[0] is a
+
+        self.drop_db()
+
+    def test_parents_batched(self):
+        """Parents of siblings are read in one query."""
+        session = self.tree.session()
+        a, h = session.get_roots()
+        leaves = a.children[0].children + a.children[1].children
+
+        session.clear()
+        assert len(session) == 0
+        d = session.get_node_by_objectid(leaves[0].id)
+        assert d.parent.label == 'b'
+        assert d.parent.parent.label == 'a'
+        assert d.parent.parent.parent is None
+
+        self.drop_db()
+
+    def test_obj(self):
+        """obj is projected away unless requested."""
+        b = self.tree.get_node_by_path(['a', 'b'], lazy=True)
+        assert 'obj' not in b.to_dict()
+        queries = self.metrics.queries
+        assert b.obj == {'big': 'x' * 1000}
+        assert b['obj'] is b.obj
+        assert self.metrics.queries == queries + 1
+        assert b.to_dict()['obj'] == b.obj
+
+        b = self.tree.session(obj=True).get_node_by_path(['a', 'b'])
+        queries = self.metrics.queries
+        assert b.obj == {'big': 'x' * 1000}
+        assert self.metrics.queries == queries
+
+        assert self.tree.get_node_by_path(['nope'], lazy=True) is None
+        assert [n.label for n in self.tree.get_roots(lazy=True)] == \
+            ['a', 'h']
+
+        self.drop_db()
+
+    def test_slots(self):
+        """Nodes carry no instance dict."""
+        node = self.tree.get_node_by_path(['h'], lazy=True)
+        assert not hasattr(node, '__dict__')
+        assert repr(node).startswith('Node(')
+
+        self.drop_db()
+
+    def tearDown(self):
+        """Denitialization."""
+        self.backend.drop()
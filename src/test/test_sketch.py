@@ -0,0 +1,77 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import random
+import unittest
+
+from mongotree.sketch import HeavyHitters
+
+
+class HeavyHittersTest(unittest.TestCase):
+    """Tests the HeavyHitters class for saneness."""
+
+    def test_exact_under_capacity(self):
+        """Counts are exact while all keys fit."""
+        sketch = HeavyHitters(capacity=10)
+        for key, count in (('a', 3), ('b', 1), ('a', 2), ('c', 4)):
+            sketch.add(key, count)
+
+        assert sketch.top() == [('a', 5, 0), ('c', 4, 0), ('b', 1, 0)]
+        assert sketch.top(1) == [('a', 5, 0)]
+        assert sketch.top(filter=lambda key: key != 'a')[0] == ('c', 4, 0)
+        assert sketch.total == 10
+
+    def test_eviction(self):
+        """A new key replaces the smallest one and inherits its count as
+        error."""
+        sketch = HeavyHitters(capacity=2)
+        sketch.add('a', 5)
+        sketch.add('b', 1)
+        sketch.add('b', 2)
+        sketch.add('c')
+
+        assert len(sketch) == 2
+        assert sketch.top() == [('a', 5, 0), ('c', 4, 3)]
+
+        sketch.clear()
+        assert sketch.top() == [] and sketch.total == 0
+
+    def test_heavy_hitters_found(self):
+        """Keys above total / capacity are always tracked."""
+        rnd = random.Random(42)
+        stream = ['hot%d' % (i % 3) for i in range(3000)]
+        stream += ['cold%d' % rnd.randint(0, 5000) for i in range(3000)]
+        rnd.shuffle(stream)
+
+        sketch = HeavyHitters(capacity=50)
+        for key in stream:
+            sketch.add(key)
+
+        top = sketch.top(3)
+        assert sorted(key for key, count, error in top) == \
+            ['hot0', 'hot1', 'hot2']
+        for key, count, error in top:
+            assert count - error <= 1000 <= count
@@ -0,0 +1,101 @@
+"""
+Lyle Scott, III
+lyle@digitalfoo.net
+http://digitalfoo.net
+
+Copyright (c) 2012 Lyle Scott, III
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+from mongotree.snapshot import TreeSnapshot
+
+
+def node(_id, path, children=(), hits=1):
+    """Build a node document as snapshot() reads them."""
+    return {'_id': _id, 'path': path, 'label': path.split('|$|')[-1],
+            'children': list(children), 'hits': hits}
+
+
+class TreeSnapshotTest(unittest.TestCase):
+    """Tests the TreeSnapshot class for saneness."""
+
+    def setUp(self):
+        """Initialization."""
+        # a -> (b -> (d, e), c), and f; sorted by path like snapshot() reads.
+        self.snapshot = TreeSnapshot([
+            node(1, 'a', [3, 2], hits=4),
+            node(3, 'a|$|b', [5, 4], hits=3),
+            node(4, 'a|$|b|$|d', hits=1),
+            node(5, 'a|$|b|$|e', hits=2),
+            node(2, 'a|$|c', hits=1),
+            node(6, 'f', hits=7),
+        ], '|$|')
+
+    def test_structure(self):
+        """Children keep the order of the children arrays."""
+        s = self.snapshot
+        assert len(s) == 6
+        assert [s.label(i) for i in s.roots] == ['a', 'f']
+        assert [s.label(i) for i in s.traverse()] == \
+            ['a', 'b', 'e', 'd', 'c', 'f']
+        assert [s.label(i) for i in s.children(s.find('a'))] == ['b', 'c']
+        assert [s.label(i) for i in s.leaves()] == ['e', 'd', 'c', 'f']
+        assert s.path(s.find(['a', 'b', 'e'])) == 'a|$|b|$|e'
+        assert s.depth(s.find('a|$|b|$|e')) == 2
+        assert s.is_leaf(s.find('f'))
+        assert s.find(['a', 'x']) is None
+        assert s.find(['x']) is None
+
+    def test_find(self):
+        """find() looks children up by label below any snapshot root."""
+        labels = ['c%d' % n for n in range(1000)]
+        s = TreeSnapshot(
+            [node(1, 'a|$|b', range(2, 1002))] +
+            [node(n + 2, 'a|$|b|$|' + label, [n + 2000])
+             for n, label in enumerate(labels)] +
+            [node(n + 2000, 'a|$|b|$|%s|$|c0' % label)
+             for n, label in enumerate(labels)], '|$|')
+        assert len(s.label_table) == len(labels) + 1
+
+        assert s.path(s.find(['a', 'b', 'c999'])) == 'a|$|b|$|c999'
+        assert s.path(s.find('a|$|b|$|c7|$|c0')) == 'a|$|b|$|c7|$|c0'
+        assert s.find(['a', 'b', 'c0', 'c1']) is None
+        assert s.find(['a', 'b', 'x']) is None
+        assert s.find(['a']) is None
+
+    def test_counts(self):
+        """Counts and top hits run over the arrays."""
+        s = self.snapshot
+        assert s.count() == 6
+        assert s.count(s.find('a|$|b')) == 3
+        assert [s.label(i) for _, i in s.top(2)] == ['f', 'a']
+        assert [s.label(i) for _, i in s.top(2, leaves_only=True)] == \
+            ['f', 'e']
+        assert [h for h, _ in s.top(5, i=s.find('a|$|b'))] == [3, 2, 1]
+        assert len(s.label_table) == 6
+
+    def test_empty(self):
+        """An empty snapshot has no roots."""
+        s = TreeSnapshot([], '|$|')
+        assert len(s) == 0
+        assert list(s.traverse()) == []
+        assert s.top(3) == []